@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""Startup-time benchmark for the keymaster command line.
+
+Runs each command below in a fresh interpreter several times against a
+small temporary database and reports the median wall-clock time, plus the
+import time of keymaster.cli.key_cli from "python -X importtime".  Exits
+with status 1 if anything is over its budget.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--scale F] [--json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from keymaster.key_password import Password     # pylint: disable=wrong-import-position
+from keymaster.key_password import PasswordDB   # pylint: disable=wrong-import-position
+
+
+# name -> (keymaster arguments, budget in ms); "{db}" is replaced by the test db path.
+# "agent" runs are made with an agent serving the test db.
+COMMANDS = {
+    "help": (["--help"], 120),
+    "hint": (["--no-agent", "-d", "{db}", "hint", "nick1"], 200),
+    "list-one": (["--no-agent", "-d", "{db}", "list", "nick1"], 200),
+    "hint-agent": (["-d", "{db}", "hint", "nick1"], 120),
+}
+IMPORT_BUDGET_MS = 60
+_NUM_PASSWORDS = 100
+
+
+def main():
+    """Run the benchmark and report."""
+    args = parse_args(sys.argv[1:])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = _create_db(tmp_dir)
+        env = dict(os.environ, KEYMASTER_AGENT_SOCK=os.path.join(tmp_dir, "agent.sock"),
+                   PYTHONPATH=REPO_ROOT)
+        results = {"import_ms": _import_time_ms(env)}
+        results["commands"] = {name: time_command(cmd_args, db_path, env, args.runs)
+                               for name, (cmd_args, _) in COMMANDS.items() if not name.endswith("-agent")}
+        agent = _start_agent(db_path, env)
+        try:
+            results["commands"].update({name: time_command(cmd_args, db_path, env, args.runs)
+                                        for name, (cmd_args, _) in COMMANDS.items() if name.endswith("-agent")})
+        finally:
+            agent.terminate()
+            agent.wait()
+    over_budget = _over_budget(results, args.scale)
+    if args.json:
+        print(json.dumps(dict(results, over_budget=over_budget), indent=2))
+    else:
+        print("import keymaster.cli.key_cli: %.1f ms (budget %d)" % (results["import_ms"], IMPORT_BUDGET_MS))
+        for name, median_ms in results["commands"].items():
+            print("%-12s %7.1f ms (budget %d)" % (name, median_ms, COMMANDS[name][1]))
+        for name in over_budget:
+            print("OVER BUDGET: " + name, file=sys.stderr)
+    sys.exit(1 if over_budget else 0)
+
+
+def _create_db(tmp_dir):
+    """Create a small test database and return its path."""
+    db_path = os.path.join(tmp_dir, "bench.db")
+    pass_db = PasswordDB(db_path, create_new_db=True)
+    pass_db.bulk_insert(Password("nick%d" % i, "user", "host", hint="hint") for i in range(_NUM_PASSWORDS))
+    pass_db.close_db()
+    return db_path
+
+
+def _import_time_ms(env):
+    """Cumulative import time of keymaster.cli.key_cli, from python -X importtime."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import keymaster.cli.key_cli"],
+                          env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in proc.stderr.splitlines():
+        fields = line.split("|")
+        if fields[-1].strip() == "keymaster.cli.key_cli":
+            return int(fields[1]) / 1000
+    raise RuntimeError("keymaster.cli.key_cli not in -X importtime output")
+
+
+def time_command(cmd_args, db_path, env, runs):
+    """Median wall-clock time in ms of running keymaster with cmd_args."""
+    cmd = [sys.executable, "-m", "keymaster.cli.key_cli"] + [arg.format(db=db_path) for arg in cmd_args]
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(times)
+
+
+def _start_agent(db_path, env):
+    """Start an agent for db_path and wait until it's answering."""
+    from keymaster.cli import key_agent     # pylint: disable=import-outside-toplevel
+    agent = subprocess.Popen([sys.executable, "-m", "keymaster.cli.key_cli", "-d", db_path, "agent"],
+                             env=env, stderr=subprocess.DEVNULL)
+    while key_agent.request(env["KEYMASTER_AGENT_SOCK"], {"cmd": "ping"}) is None:
+        if agent.poll() is not None:
+            raise RuntimeError("keymaster agent exited with status %d" % agent.returncode)
+        time.sleep(0.01)
+    return agent
+
+
+def _over_budget(results, scale):
+    """Names of everything that took longer than its budget (times scale)."""
+    over_budget = [name for name, median_ms in results["commands"].items()
+                   if median_ms > COMMANDS[name][1] * scale]
+    if results["import_ms"] > IMPORT_BUDGET_MS * scale:
+        over_budget.insert(0, "import")
+    return over_budget
+
+
+def parse_args(command_line):
+    """Number of runs, budget scale and output format."""
+    parser = argparse.ArgumentParser(description="Benchmark keymaster startup time")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="runs per command (default 10)")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="multiply all budgets by this (for slow machines)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args(command_line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""Benchmark suite: password calculation, PasswordDB operations at several
+database sizes, and end-to-end keymaster commands.
+
+Each benchmark reports the median time per operation over several runs.
+Results can be written as JSON (--output) and compared with an earlier
+run's JSON (--baseline); anything slower than its baseline by more than
+--tolerance is reported as a regression and the exit status is 1.
+
+Usage: python benchmarks/bench_suite.py [--sizes 10,1000,100000] [--runs N]
+           [--filter REGEX] [--output FILE] [--baseline FILE] [--tolerance F]
+
+For example, save a baseline on master and check a branch against it:
+    python benchmarks/bench_suite.py -o /tmp/base.json
+    python benchmarks/bench_suite.py -b /tmp/base.json
+
+Sizes go up to 1000000 (building that database takes a minute or so).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench_startup import time_command              # pylint: disable=wrong-import-position
+from keymaster.key_password import Password         # pylint: disable=wrong-import-position
+from keymaster.key_password import PasswordDB       # pylint: disable=wrong-import-position
+
+
+DEFAULT_SIZES = [10, 1000, 100000]
+DEFAULT_TOLERANCE = 0.2
+_CLI_DB_SIZE = 1000
+_CLI_COMMANDS = {
+    "help": ["--help"],
+    "hint": ["--no-agent", "-d", "{db}", "hint", "nick5"],
+    "list-one": ["--no-agent", "-d", "{db}", "list", "nick5"],
+    "search": ["--no-agent", "-d", "{db}", "search", "nick5"],
+}
+_OPS_PER_RUN = 20       # lookups and writes are timed this many at a time
+_CALCULATIONS_PER_RUN = 1000
+
+
+def main():
+    """Run the benchmarks, then save and compare the results."""
+    args = parse_args(sys.argv[1:])
+    selected = re.compile(args.filter)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, bench in _benchmarks(tmp_dir, args.sizes, selected):
+            results[name] = _median_us(bench, args.runs)
+            print("%-28s %12.1f us" % (name, results[name]), file=sys.stderr)
+    report = {"meta": _meta(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file)["results"], results, args.tolerance)
+        for name, baseline_us, result_us in regressions:
+            print("REGRESSION: %s %.1f us -> %.1f us (%+.0f%%)"
+                  % (name, baseline_us, result_us, 100 * (result_us / baseline_us - 1)), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE):
+    """(name, baseline us, result us) for each benchmark that's slower than its
+    baseline by more than tolerance (a fraction).  Benchmarks that are only in
+    one of the two are skipped.
+    """
+    return [(name, baseline[name], result_us) for name, result_us in sorted(results.items())
+            if name in baseline and result_us > baseline[name] * (1 + tolerance)]
+
+
+def _median_us(bench, runs):
+    """Median microseconds per operation; bench() does one run and returns (seconds, operations)."""
+    per_op = []
+    for _ in range(runs):
+        seconds, ops = bench()
+        per_op.append(seconds / ops * 1e6)
+    return statistics.median(per_op)
+
+
+def _timed(func, ops=1):
+    """A benchmark that times one call of func, which does ops operations."""
+    def _bench():
+        start_time = time.perf_counter()
+        func()
+        return time.perf_counter() - start_time, ops
+    return _bench
+
+
+def _benchmarks(tmp_dir, sizes, selected):
+    """Yield (name, benchmark) for each selected benchmark, creating the test databases as they're needed."""
+    for base in (32, 64):
+        for special_char in (False, True):
+            pw_obj = Password("nick", "user", "host.com", special_char, base)
+            name = "calculate/base%d%s" % (base, "-special" if special_char else "")
+            if selected.search(name):
+                yield name, _timed(lambda pw_obj=pw_obj: [pw_obj.calculate_password("proto-password")
+                                                          for _ in range(_CALCULATIONS_PER_RUN)],
+                                   _CALCULATIONS_PER_RUN)
+    pw_objs = [Password("nick%d" % i, "user", "host%d.com" % i, i % 2 == 0, 64 if i % 4 == 0 else 32)
+               for i in range(_CALCULATIONS_PER_RUN)]
+    if selected.search("calculate/loop"):
+        yield "calculate/loop", _timed(lambda: [pw_obj.calculate_password("proto-password") for pw_obj in pw_objs],
+                                       _CALCULATIONS_PER_RUN)
+    if selected.search("calculate/batch"):
+        yield "calculate/batch", _timed(lambda: Password.calculate_passwords("proto-password", pw_objs),
+                                        _CALCULATIONS_PER_RUN)
+    for size in sizes:
+        benches = [(name, make_bench) for name, make_bench in _DB_BENCHMARKS if selected.search(name % size)]
+        if benches:
+            db_path = _create_db(tmp_dir, size)
+            pass_db = PasswordDB(db_path, False)
+            for name, make_bench in benches:
+                yield name % size, make_bench(db_path, pass_db, size)
+            pass_db.close_db()
+    benches = [(name, cmd_args) for name, cmd_args in _CLI_COMMANDS.items()
+               if selected.search("cli/%s/%d" % (name, _CLI_DB_SIZE))]
+    if benches:
+        db_path = _create_db(tmp_dir, _CLI_DB_SIZE)
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        for name, cmd_args in benches:
+            yield ("cli/%s/%d" % (name, _CLI_DB_SIZE),
+                   lambda cmd_args=cmd_args: (time_command(cmd_args, db_path, env, 1) / 1000, 1))
+
+
+def _create_db(tmp_dir, size):
+    """Create a test database with size passwords and return its path."""
+    db_path = os.path.join(tmp_dir, "bench%d.db" % size)
+    pass_db = PasswordDB(db_path, create_new_db=True)
+    pass_db.bulk_insert(Password("nick%d" % i, "user%d" % (i % 50), "host%d.com" % (i % 300), hint="hint")
+                        for i in range(size))
+    pass_db.close_db()
+    return db_path
+
+
+def _bench_open(db_path, _, __):
+    """Open and close the database."""
+    return _timed(lambda: PasswordDB(db_path, False).close_db())
+
+
+def _bench_get_data(db_path, _, __):
+    """PasswordDB.get_data (as the CLI and Qt app do at startup)."""
+    def _get_data():
+        pass_db, _ = PasswordDB.get_data(lambda: False, lambda: None, db_path)
+        pass_db.close_db()
+    return _timed(_get_data)
+
+
+def _bench_lookup(_, pass_db, size):
+    """get_password_for_nick, for nicknames spread over the database."""
+    nicks = ["nick%d" % (i * 7919 % size) for i in range(_OPS_PER_RUN)]
+    def _lookup():
+        for nick in nicks:
+            pass_db.get_password_for_nick(nick)
+    return _timed(_lookup, len(nicks))
+
+
+def _bench_snapshot_lookup(db_path, pass_db, size):
+    """get_password_for_nick answered from a snapshot (see key_snapshot); the
+    benchmarks after this one write to the db, which makes the snapshot stale.
+    """
+    pass_db.write_snapshot()
+    return _bench_lookup(db_path, pass_db, size)
+
+
+def _bench_insert(_, pass_db, __):
+    """create_new_password (each one committed); the new passwords are deleted afterwards, untimed."""
+    pw_objs = [Password("new%d" % i, "user", "host") for i in range(_OPS_PER_RUN)]
+    def _bench():
+        start_time = time.perf_counter()
+        for pw_obj in pw_objs:
+            pass_db.create_new_password(pw_obj)
+        seconds = time.perf_counter() - start_time
+        for pw_obj in pw_objs:
+            pass_db.delete_password(pw_obj)
+        return seconds, len(pw_objs)
+    return _bench
+
+
+def _bench_update(_, pass_db, size):
+    """update_old_password (each one committed), changing the hint."""
+    nicks = ["nick%d" % (i * 7919 % size) for i in range(min(_OPS_PER_RUN, size))]
+    hints = iter(range(10 ** 9))
+    def _update():
+        hint = "hint%d" % next(hints)
+        for nick in nicks:
+            pass_db.update_old_password(nick, Password(nick, "user", "host", hint=hint))
+    return _timed(_update, len(nicks))
+
+
+def _bench_delete(_, pass_db, __):
+    """delete_password (each one committed); the passwords are inserted beforehand, untimed."""
+    pw_objs = [Password("new%d" % i, "user", "host") for i in range(_OPS_PER_RUN)]
+    def _bench():
+        pass_db.bulk_insert(pw_objs)
+        start_time = time.perf_counter()
+        for pw_obj in pw_objs:
+            pass_db.delete_password(pw_obj)
+        return time.perf_counter() - start_time, len(pw_objs)
+    return _bench
+
+
+# (name with %d for the db size, function(db_path, open PasswordDB, size) that makes the benchmark)
+_DB_BENCHMARKS = [("db/open/%d", _bench_open),
+                  ("db/get_data/%d", _bench_get_data),
+                  ("db/lookup/%d", _bench_lookup),
+                  ("db/snapshot-lookup/%d", _bench_snapshot_lookup),
+                  ("db/insert/%d", _bench_insert),
+                  ("db/update/%d", _bench_update),
+                  ("db/delete/%d", _bench_delete)]
+
+
+def _meta(args):
+    """What was run, where and when."""
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+            "sizes": args.sizes}
+
+
+def parse_args(command_line):
+    """Sizes, runs, which benchmarks, and where to save and compare results."""
+    parser = argparse.ArgumentParser(description="Benchmark keymaster")
+    parser.add_argument("--sizes", type=lambda sizes: [int(size) for size in sizes.split(",")],
+                        default=DEFAULT_SIZES, help="comma-separated database sizes (default 10,1000,100000)")
+    parser.add_argument("-n", "--runs", type=int, default=9, help="runs per benchmark (default 9)")
+    parser.add_argument("-f", "--filter", default="", help="only run benchmarks whose names match this regex")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file (default: stdout)")
+    parser.add_argument("-b", "--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("-t", "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fraction slower than the baseline that counts as a regression (default 0.2)")
+    return parser.parse_args(command_line)
+
+
+if __name__ == "__main__":
+    main()
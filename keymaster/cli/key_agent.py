@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+
+"""Keep a password database open in a long-running agent and answer
+get, hint and list requests from keymaster over a Unix socket, so that
+each keymaster call skips opening the database and loading passwords.
+
+Example
+----
+$ keymaster agent --cache-timeout 300 &
+$ keymaster get nick        # answered by the agent
+
+Requests: get, hint and list for a nickname, and search (the "nickname" is
+the query).  Listing all the passwords isn't done here: keymaster streams it
+from the database itself rather than have it all sent in one response.
+
+Protocol: one JSON object per line each way.  Requests look like
+{"cmd": "get", "nickname": "nick", "db_path": "...", "proto_pw": "..."}
+and responses like {"ok": true, "result": "..."} or
+{"ok": false, "error": "..."}.  A "get" with no proto_pw (and none cached)
+is answered with {"ok": false, "error": "need_proto_pw"}.  A missing
+db_path means the default database.
+
+Clients (keymaster get/hint/list) import this module on every call, so
+asyncio, xdg and the database code are only imported by the agent itself.
+"""
+
+import json
+import os
+from pathlib import Path
+import socket
+import sys
+import time
+
+from keymaster.key_search import DEFAULT_NUM_MATCHES
+from keymaster.key_search import NicknameIndex
+
+
+AGENT_SOCKET_ENV = "KEYMASTER_AGENT_SOCK"
+
+ERR_NEED_PROTO_PW = "need_proto_pw"
+ERR_NICK_NOT_FOUND = "nick_not_found"
+ERR_WRONG_DB = "wrong_db"
+ERR_BAD_REQUEST = "bad_request"
+
+_MSG_AGENT_RUNNING = "An agent is already listening on {}"
+_MSG_AGENT_LISTENING = "Agent listening on {} for {}"
+
+_CHR_ENCODING = "utf-8"
+_CACHE_EXPIRY_INTERVAL = 1.0
+_REQUEST_TIMEOUT = 10.0     # seconds; long enough for a slow KDF, short enough to fall back from a hung agent
+
+
+class KeyAgent:
+    """Answer requests for one open PasswordDB (and its passwords dictionary,
+    which keeps the Password objects it has loaded).
+
+    If proto_pw_timeout is non-zero, the proto-password from the last "get"
+    is kept for that many seconds so later gets don't need to send it.
+    If derivation_cache_ttl is non-zero, calculated passwords are cached
+    (see key_cache) for that many seconds.
+    """
+    def __init__(self, pass_db, pass_dic, proto_pw_timeout=0, derivation_cache_ttl=0):
+        from keymaster.key_cache import DerivationCache
+        from keymaster.key_password import DEFAULT_DB_PATH
+        self.default_db_path = DEFAULT_DB_PATH
+        self.pass_db = pass_db
+        self.pass_dic = pass_dic
+        self.proto_pw_timeout = proto_pw_timeout
+        self.derivation_cache = DerivationCache(derivation_cache_ttl) if derivation_cache_ttl else None
+        self._data_version, self._seq, self._index = None, None, None
+        self._proto_pw, self._proto_pw_expiry = None, 0.0
+        self._loop, self._stopped = None, None
+
+    async def serve(self, socket_path):
+        """Listen on socket_path (readable by this user only) until stop() is called."""
+        import asyncio
+        import signal
+        import threading
+        socket_path = Path(socket_path)
+        if request(socket_path, {"cmd": "ping"}) is not None:
+            raise RuntimeError(_MSG_AGENT_RUNNING.format(socket_path))
+        socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if socket_path.exists():    # left over from an agent that didn't shut down cleanly
+            socket_path.unlink()
+        self._loop, self._stopped = asyncio.get_running_loop(), asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            self._loop.add_signal_handler(signal.SIGTERM, self._stopped.set)
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle_client, path=str(socket_path))
+        finally:
+            os.umask(old_umask)
+        print(_MSG_AGENT_LISTENING.format(socket_path, self.pass_db.db_name), file=sys.stderr)
+        expire_task = None if self.derivation_cache is None else asyncio.ensure_future(self._expire_cache())
+        try:
+            async with server:
+                await self._stopped.wait()
+        finally:
+            if expire_task is not None:
+                expire_task.cancel()
+                self.derivation_cache.wipe()
+            socket_path.unlink()
+
+    def stop(self):
+        """Stop serving (safe to call from any thread)."""
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _expire_cache(self):
+        """Drop expired entries from the derivation cache every so often."""
+        import asyncio
+        while True:
+            await asyncio.sleep(_CACHE_EXPIRY_INTERVAL)
+            self.derivation_cache.expire()
+
+    async def _handle_client(self, reader, writer):
+        """Answer each request line from one client until it disconnects."""
+        try:
+            line = await reader.readline()
+            while line:
+                writer.write(json.dumps(self.handle_request(line)).encode(_CHR_ENCODING) + b"\n")
+                await writer.drain()
+                line = await reader.readline()
+        finally:
+            writer.close()
+
+    def handle_request(self, line):
+        """Answer a single JSON request."""
+        try:
+            req = json.loads(line)
+            cmd, nickname = req["cmd"], req.get("nickname")
+        except (ValueError, KeyError, TypeError):
+            return _error(ERR_BAD_REQUEST)
+        if cmd == "ping":
+            return _result(str(self.pass_db.db_name))
+        if not _same_path(req.get("db_path") or self.default_db_path, self.pass_db.db_name):
+            return _error(ERR_WRONG_DB)
+        self._check_for_changes()
+        if cmd == "search" and isinstance(nickname, str):
+            matches = self._get_index().search(nickname, req.get("num_matches") or DEFAULT_NUM_MATCHES)
+            return _result([str(self.pass_dic[nick]) for nick in matches])
+        if cmd not in ("get", "hint", "list") or nickname is None:
+            return _error(ERR_BAD_REQUEST)
+        if nickname not in self.pass_dic:
+            return _error(ERR_NICK_NOT_FOUND)
+        pass_obj = self.pass_dic[nickname]
+        if cmd == "hint":
+            return _result(pass_obj.hint)
+        if cmd == "list":
+            return _result(str(pass_obj))
+        proto_pw = self._get_proto_pw(req.get("proto_pw"))
+        if proto_pw is None:
+            return _error(ERR_NEED_PROTO_PW)
+        if self.derivation_cache is not None:
+            return _result(self.derivation_cache.calculate_password(pass_obj, proto_pw))
+        return _result(pass_obj.calculate_password(proto_pw))
+
+    def _check_for_changes(self):
+        """Catch up with changes another process has made to the db: re-apply just
+        the rows changed since we last looked (from the change log, see key_sync)
+        to the search index, and forget their cached Passwords.
+        """
+        data_version = self.pass_db.get_data_version()
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        if self._seq is None:
+            self._seq = self.pass_db.get_sync_state()[1]
+            self.pass_dic.clear()
+            return
+        from keymaster.key_password import Password
+        for seq, nickname, _, _, deleted, fields in self.pass_db.iter_changes(self._seq):
+            self._seq = seq
+            del self.pass_dic[nickname]
+            if self._index is not None:
+                if deleted:
+                    self._index.remove(nickname)
+                else:
+                    self._index.add(Password(*fields))
+
+    def _get_index(self):
+        """Get the search index, building it the first time (after which
+        _check_for_changes keeps it current).
+        """
+        if self._index is None:
+            self._index = NicknameIndex(self.pass_db.iter_password_objects())
+        return self._index
+
+    def _get_proto_pw(self, proto_pw):
+        """Remember proto_pw if we're caching, or return the cached one if it hasn't expired."""
+        now = time.monotonic()
+        if proto_pw is not None:
+            if self.proto_pw_timeout:
+                self._proto_pw, self._proto_pw_expiry = proto_pw, now + self.proto_pw_timeout
+            return proto_pw
+        if now >= self._proto_pw_expiry:
+            self._proto_pw = None
+        return self._proto_pw
+
+
+def _result(result):
+    """Successful response."""
+    return {"ok": True, "result": result}
+
+
+def _error(error):
+    """Error response."""
+    return {"ok": False, "error": error}
+
+
+def _same_path(path1, path2):
+    """Do these name the same database file?"""
+    return os.path.realpath(str(path1)) == os.path.realpath(str(path2))
+
+
+def get_socket_path():
+    """Agent socket path: $KEYMASTER_AGENT_SOCK if set, else
+    $XDG_RUNTIME_DIR/keymaster/agent.sock (or under $XDG_CONFIG_HOME if there's no runtime dir).
+    """
+    if os.environ.get(AGENT_SOCKET_ENV):
+        return Path(os.environ[AGENT_SOCKET_ENV])
+    from xdg import XDG_CONFIG_HOME, XDG_RUNTIME_DIR
+    return Path(XDG_RUNTIME_DIR or XDG_CONFIG_HOME, "keymaster", "agent.sock")
+
+
+def request(socket_path, req, timeout=_REQUEST_TIMEOUT):
+    """Send one request to the agent on socket_path and return its response,
+    or None if there's no agent answering there (none listening, a stale or
+    foreign socket, or an agent that doesn't answer within timeout seconds).
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps(req).encode(_CHR_ENCODING) + b"\n")
+            with sock.makefile("rb") as sock_file:
+                line = sock_file.readline()
+        return json.loads(line) if line else None
+    except (OSError, ValueError):
+        return None
+
+
+def run_agent(socket_path, pass_db, pass_dic, proto_pw_timeout=0, derivation_cache_ttl=0):
+    """Run an agent in the foreground until interrupted."""
+    import asyncio
+    agent = KeyAgent(pass_db, pass_dic, proto_pw_timeout, derivation_cache_ttl)
+    try:
+        asyncio.run(agent.serve(socket_path))
+    except KeyboardInterrupt:
+        pass
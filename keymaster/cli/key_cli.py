@@ -19,17 +19,61 @@ Enter proto-password (won't be displayed): *********
 Again, please (to avoid mistakeS): *********
 Password: password
 
+$ printf 'bank\nfbi\n' | keymaster get --batch --proto-fd 3 3<proto.txt
+<bank password>
+<fbi password>
+
+$ keymaster calibrate scrypt --target-ms 100
+scrypt: --kdf-cost 14 (97.3 ms)
+$ keymaster create bank --kdf scrypt --kdf-cost 14
+
+$ keymaster list --format csv --offset 1 --limit 1
+nickname,username,hostname,special_char,base,iteration,hint,start,finish,kdf,kdf_cost
+fbi,fbi_username,login.fbi.gov,False,32,1,,0,15,sha512,0
+$ keymaster list --user president --no-special
+1: Password(whitehouse, president, whitehouse.gov, 0, 32, 1, , 0, 15, sha512, 0)
+
+$ keymaster snapshot
+Wrote a snapshot of 3 passwords to /home/me/.config/keymaster/.passwords.db.snapshot.
+
+$ keymaster provision fleet.tsv
+Proto-password (won't be displayed): *********
+Again, please (to avoid mistakes): *********
+$ head -1 fleet.tsv
+bank	<password>
+
+If a keymaster agent is running for the same database (see key_agent.py),
+get, hint, list and search are answered by the agent instead.
+
+-d/--db-path can be given more than once to use several databases as one
+(see key_federated.py); "keymaster split N" splits a database into N.
+
+"keymaster sync PEER" exchanges just the changes since the last sync with
+another copy of the database or a shared directory (see key_sync.py).
+
+--stats prints where the time went (see key_metrics.py) when keymaster exits,
+and --profile[=PATH] writes a cProfile of the whole run (see key_profile.py).
+
+Startup time matters here (keymaster is often called from scripts), so
+the database code and other heavy modules are imported only by the
+commands that use them; see benchmarks/bench_startup.py.
+
 """
 
 
 import argparse
+from collections import deque
 from collections import OrderedDict
+import csv
 import getpass
+from itertools import islice
+import json
+import os
 import sys
+import time
 
-from keymaster.key_password import DEFAULT_DB_PATH
-from keymaster.key_password import Password
-from keymaster.key_password import PasswordDB
+from keymaster import key_profile
+from keymaster.cli import key_agent
 
 
 _MSG_NO_PASS_DB = "Password database doesn't already exist."
@@ -38,23 +82,83 @@ _MSG_ERROR_OPENING_DB = "Error opening passwords db. Exiting."
 _MSG_NICK_IN_USE = "Nickname already in use. Please try again."
 _MSG_NICK_NOT_FOUND = "Nickname {} not found."
 _MSG_SELECT_NICK = "Choose identity: "
+_MSG_SEARCH = "Search for: "
+_MSG_SELECT_MATCH = "Choose identity (or just Enter to search again): "
+_MSG_NO_MATCHES = "No matches."
+
+_MAX_LISTED_FOR_SELECTION = 20     # with more passwords than this we search instead of listing them all
 
 _MSG_ENTER_PROTO_PW_1 = "Proto-password (won't be displayed): "
 _MSG_ENTER_PROTO_PW_2 = "Again, please (to avoid mistakes): "
 _MSG_PROTO_PW_MISMATCH = "The two proto-passwords don't match.  Please try again."
+_MSG_PROTO_FD_ERROR = "Can't read the proto-password from file descriptor {}: {}"
+_MSG_BATCH_NO_NICK = "get --batch reads nicknames from stdin; don't give one on the command line."
+_MSG_BATCH_LINE = "line {}: {}"
+
+_MSG_PROVISION_BAD_NUM = "--workers and --chunk-size must be positive."
+_MSG_IMPORTED = "Imported {} passwords in {:.2f}s ({:.0f} rows/s)."
+_MSG_IMPORT_FAILED = "Import failed, nothing was imported: {}"
+
+_PROVISION_CHUNK_SIZE = 1000
+_LIST_CHUNK_SIZE = 1000
+_GET_BATCH_CHUNK_SIZE = 1000
+_IMPORT_FORMATS = ["csv", "jsonl"]
+_INT_FIELDS = ["base", "iteration", "start", "finish", "kdf_cost"]
+_BASES = (32, 64)
+_KDF_OPTS = [(("--kdf",), {"default": None, "help": "key-derivation function (see 'keymaster calibrate')"}),
+             (("--kdf-cost",), {"type": int, "default": None, "help": "cost for the KDF (default: its default)"})]
+
+_MSG_CALIBRATED = "{}: --kdf-cost {} ({:.1f} ms)"
+_MSG_SNAPSHOT_WRITTEN = "Wrote a snapshot of {} passwords to {}."
+_MSG_SPLIT_WRITTEN = "Wrote {}"
+_MSG_SPLIT_NEEDS_NUM = "Usage: keymaster split NUM_SHARDS"
+_MSG_SPLIT_ONE_DB = "Split one database at a time."
+_MSG_AGENT_ONE_DB = "An agent serves a single database."
+_MSG_SYNC_ONE_DB = "Sync one database at a time."
+_MSG_SYNC_NEEDS_PEER = "Usage: keymaster sync [--new-replica-id] DB_FILE_OR_DIR"
+_MSG_SYNCED = "Received {} changes ({} applied) and sent {}."
 
 
 def main():
     """Do it!"""
     args = parse_args(sys.argv[1:])
-    pass_db, passwords_dic = _get_data(args.db_path)
-    if pass_db is None:
-        sys.exit(1)
-    args.func(args.nickname, pass_db, passwords_dic)
-
-
-def _get_data(db_path):
-    """Create communications methods for the back-end get_data and call it."""
+    with key_profile.profiled(args.profile):
+        _run(args)
+
+
+def _run(args):
+    """Run the command (via the agent if we can)."""
+    if args.stats or args.trace:
+        _start_metrics(args.stats, args.trace)
+    elif not args.no_agent and _run_via_agent(args):
+        return
+    if args.no_db:
+        pass_db, passwords_dic = None, None
+    else:
+        pass_db, passwords_dic = _get_data(args.db_path)
+        if pass_db is None:
+            sys.exit(1)
+    options = {opt_name: getattr(args, opt_name) for opt_name in args.opt_names}
+    args.func(args.nickname, pass_db, passwords_dic, **options)
+
+
+def _start_metrics(print_stats, trace_path):
+    """Record metrics (see key_metrics) for this run, and print them to stderr at exit if print_stats."""
+    import atexit
+    from keymaster import key_metrics
+    def _stop_metrics():
+        key_metrics.disable()
+        if print_stats:
+            print(key_metrics.format_summary(key_metrics.snapshot()), file=sys.stderr)
+    key_metrics.enable(trace_path)
+    atexit.register(_stop_metrics)
+
+
+def _get_data(db_paths):
+    """Create communications methods for the back-end get_data and call it
+    (for a FederatedPasswordDB if we're given several databases).
+    """
+    from keymaster.key_password import DEFAULT_DB_PATH, PasswordDB
     def ask_to_create_new():
         """Is it okay to write a new db?"""
         print(_MSG_NO_PASS_DB)
@@ -63,21 +167,62 @@ def _get_data(db_path):
     def error_getting_db():
         """Couldn't get a handle to the database."""
         print(_MSG_ERROR_OPENING_DB, file=sys.stderr)
-    return PasswordDB.get_data(ask_to_create_new, error_getting_db, db_path)
+    if db_paths and len(db_paths) > 1:
+        from keymaster.key_federated import FederatedPasswordDB
+        return FederatedPasswordDB.get_data(ask_to_create_new, error_getting_db, db_paths)
+    return PasswordDB.get_data(ask_to_create_new, error_getting_db, db_paths[0] if db_paths else DEFAULT_DB_PATH)
+
+
+def _run_via_agent(args):
+    """If an agent is running for our db, have it answer get, hint, list and
+    search requests for a given nickname or query.
+    Return False if there's no agent or if it can't answer (or we have several
+    databases), so the caller should do the work itself.  (Listing all the
+    passwords is always done here, where it's streamed from the db.)
+    """
+    cmd = _AGENT_COMMANDS.get(args.func)
+    if cmd is None or args.nickname is None or (args.db_path and len(args.db_path) > 1):
+        return False
+    if cmd in ("get", "list") and any(getattr(args, opt_name) is not None for opt_name in args.opt_names):
+        return False    # the agent only does plain gets and lists
+    socket_path = key_agent.get_socket_path()
+    req = {"cmd": cmd, "nickname": args.nickname, "db_path": args.db_path[0] if args.db_path else None}
+    req.update({opt_name: getattr(args, opt_name) for opt_name in args.opt_names})
+    response = key_agent.request(socket_path, req)
+    if response is not None and response.get("error") == key_agent.ERR_NEED_PROTO_PW:
+        req["proto_pw"] = _read_proto_password()
+        response = key_agent.request(socket_path, req)
+    if response is None or not response["ok"]:
+        return False
+    if cmd == "get":
+        print("Password: " + response["result"])
+    elif cmd == "hint":
+        print("Hint: " + response["result"])
+    elif cmd == "list":
+        print(response["result"])
+    elif not response["result"]:
+        print(_MSG_NO_MATCHES, file=sys.stderr)
+    else:
+        for i, pass_str in enumerate(response["result"]):
+            print(str(i+1) + ": " + pass_str)
+    return True
 
 
-def create_pass(nick, pass_db, pass_dic):
+def create_pass(nick, pass_db, pass_dic, kdf=None, kdf_cost=None):
     """Read in new password info and create and store the new object."""
+    from keymaster.key_kdf import DEFAULT_KDF
+    kdf, kdf_cost = _check_kdf(kdf or DEFAULT_KDF, kdf_cost)
     # get new password object:
-    new_pass = _create_pass_get_new_pass(nick, pass_dic)
+    new_pass = _create_pass_get_new_pass(nick, pass_dic, kdf, kdf_cost)
     # and write it:
     pass_dic[new_pass.nickname] = new_pass
     pass_db.create_new_password(new_pass)
     return new_pass.nickname
 
 
-def _create_pass_get_new_pass(nick, pass_dic):
+def _create_pass_get_new_pass(nick, pass_dic, kdf, kdf_cost):
     """Read in new password info."""
+    from keymaster.key_password import Password
     nick = _create_pass_get_nick(nick, pass_dic)
     # read in data:
     username = input("Username: ")
@@ -89,7 +234,23 @@ def _create_pass_get_new_pass(nick, pass_dic):
     start_char = _read_default_int("Start char index (default: 0): ", 0)
     end_char = _read_default_int("End char index (default: 15): ", 15)
     # create new Password object:
-    return Password(nick, username, hostname, special_char, base, iteration, hint, start_char, end_char)
+    return Password(nick, username, hostname, special_char, base, iteration, hint, start_char, end_char,
+                    kdf, kdf_cost)
+
+
+def _check_kdf(kdf, kdf_cost):
+    """Fill in the default cost for the KDF if need be, and exit with a
+    message if the KDF or cost isn't valid.
+    """
+    from keymaster.key_kdf import DEFAULT_COSTS, check_cost
+    if kdf_cost is None:
+        kdf_cost = DEFAULT_COSTS.get(kdf, 0)
+    try:
+        check_cost(kdf, kdf_cost)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    return kdf, kdf_cost
 
 
 def _create_pass_get_nick(nick, pass_dic):
@@ -121,43 +282,331 @@ def _read_default_int(prompt, default):
     return num
 
 
-def update_pass(nick, pass_db, pass_dic):
-    """Get info for new password, delete the old one, and then create the new one.
-    We create a new one in order to allow changing the nickname (which we use as the key).
+def update_pass(nick, pass_db, pass_dic, kdf=None, kdf_cost=None):
+    """Get info for the new password and update the old one with it
+    (possibly changing the nickname, which we use as the key).
+    The KDF and its cost are kept unless they're given.
     """
     # get and display old password info:
     old_pw = _select_pass(nick, pass_db, pass_dic)
+    if kdf is None or kdf == old_pw.kdf:     # same KDF: keep its cost unless we're given a new one
+        kdf = old_pw.kdf
+        kdf_cost = old_pw.kdf_cost if kdf_cost is None else kdf_cost
+    kdf, kdf_cost = _check_kdf(kdf, kdf_cost)
     print("About to update the following password object:")
     list_pass(old_pw.nickname, pass_db, pass_dic)
     # get new password object:
     print("Please enter new password information:")
-    new_pass = _create_pass_get_new_pass(nick, pass_dic)
-    # and only now delete the old one, and then write the new one:
-    delete_pass(old_pw.nickname, pass_db, pass_dic)
+    new_pass = _create_pass_get_new_pass(nick, pass_dic, kdf, kdf_cost)
+    # and only now update the old one:
+    pass_db.update_old_password(old_pw.nickname, new_pass)
+    del pass_dic[old_pw.nickname]
     pass_dic[new_pass.nickname] = new_pass
-    pass_db.create_new_password(new_pass)
     return new_pass.nickname
 
 
-def get_pass(nick, pass_db, pass_dic):
-    """Get the proto-password for this Password object from the user,
-    and display the calculated password for this proto-password and Password.
+def get_pass(nick, pass_db, pass_dic, batch=None, proto_fd=None):
+    """Get the proto-password for this Password object from the user (or read it
+    from file descriptor proto_fd), and display the calculated password for this
+    proto-password and Password.
+    With --batch, read nicknames from stdin instead, one per line, and write their
+    passwords to stdout in the same order (see _get_batch).
+    """
+    if batch:
+        if nick is not None:
+            print(_MSG_BATCH_NO_NICK, file=sys.stderr)
+            sys.exit(1)
+        _, errors = _get_batch(pass_db, _read_proto_password(proto_fd), sys.stdin, sys.stdout)
+        if errors:
+            sys.exit(1)
+        return
+    pass_obj = _select_pass(nick, pass_db, pass_dic)
+    proto_pw = _read_proto_password(proto_fd)
+    print("Password: " + pass_obj.calculate_password(proto_pw))
+
+
+def _get_batch(pass_db, proto_pw, in_file, out_file):
+    """Write a line to out_file for each nickname line of in_file: its password,
+    or (for a nickname not in the db) an empty line, with the error on stderr.
+    Lines are read, looked up and calculated a chunk at a time, so a chunk's
+    passwords are written once it's all been read (or stdin ends).
+    Returns the numbers of lines read and of errors.
     """
+    from keymaster.key_password import Password
+    count = errors = 0
+    for chunk in _chunked(in_file, _GET_BATCH_CHUNK_SIZE):
+        nicks = [line.rstrip("\r\n") for line in chunk]
+        found = pass_db.find_passwords(set(nicks))
+        pass_objs = [found.get(nick) for nick in nicks]
+        passwords = iter(Password.calculate_passwords(proto_pw, [pass_obj for pass_obj in pass_objs if pass_obj]))
+        lines = []
+        for line_num, (nick, pass_obj) in enumerate(zip(nicks, pass_objs), count + 1):
+            if pass_obj is None:
+                print(_MSG_BATCH_LINE.format(line_num, _MSG_NICK_NOT_FOUND.format(nick)), file=sys.stderr)
+                errors += 1
+                lines.append("\n")
+            else:
+                lines.append(next(passwords) + "\n")
+        count += _write_lines(out_file, lines)
+        out_file.flush()
+    return count, errors
+
+
+def _read_proto_password(proto_fd=None):
+    """Get proto-password from user, re-asking until both entries match
+    (or read it, once, from the first line of file descriptor proto_fd).
+    """
+    if proto_fd is not None:
+        return _read_proto_password_from_fd(proto_fd)
+
     def _get_proto_password():
         """Get proto-password from user."""
         proto_pw1 = getpass.getpass(_MSG_ENTER_PROTO_PW_1)
         proto_pw2 = getpass.getpass(_MSG_ENTER_PROTO_PW_2)
         return proto_pw1 if proto_pw1 == proto_pw2 else None
 
-    pass_obj = _select_pass(nick, pass_db, pass_dic)
-
-    # get a proto-password from the user:
     proto_pw = _get_proto_password()
     while proto_pw is None:
         print(_MSG_PROTO_PW_MISMATCH, file=sys.stderr)
         proto_pw = _get_proto_password()
+    return proto_pw
+
+
+def _read_proto_password_from_fd(proto_fd):
+    """Read the first line of file descriptor proto_fd, for scripts (e.g. --proto-fd 3 3<file).
+    It's read a byte at a time, so nothing after the line is consumed: with
+    --proto-fd 0 the rest of stdin is left for get --batch's nicknames.
+    """
+    line = bytearray()
+    try:
+        byte = os.read(proto_fd, 1)
+        while byte and byte != b"\n":
+            line += byte
+            byte = os.read(proto_fd, 1)
+        proto_pw = line.decode(sys.stdin.encoding or "utf-8").rstrip("\r")
+    except (OSError, UnicodeDecodeError) as err:
+        print(_MSG_PROTO_FD_ERROR.format(proto_fd, err), file=sys.stderr)
+        sys.exit(1)
+    if not proto_pw:
+        print(_MSG_PROTO_FD_ERROR.format(proto_fd, "no proto-password"), file=sys.stderr)
+        sys.exit(1)
+    return proto_pw
+
+
+def provision_pass(out_path, pass_db, _, workers=None, chunk_size=_PROVISION_CHUNK_SIZE):
+    """Calculate every password in the db across a pool of processes and write
+    "nickname<TAB>password" lines to out_path (or stdout if it's None).
+    Chunks are written in nickname order as they finish; at most two chunks
+    per worker are in flight at any time, so memory use doesn't grow with the db.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if (workers is not None and workers < 1) or chunk_size < 1:
+        print(_MSG_PROVISION_BAD_NUM, file=sys.stderr)
+        sys.exit(1)
+    proto_pw = _read_proto_password()
+    workers = workers or os.cpu_count() or 1
+    out_file = sys.stdout if out_path is None else _open_private(out_path)
+    count = 0
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for chunk in _chunked(pass_db.iter_password_objects(chunk_size), chunk_size):
+                pending.append(executor.submit(_provision_chunk, proto_pw, chunk))
+                if len(pending) >= 2 * workers:
+                    count += _write_lines(out_file, pending.popleft().result())
+            while pending:
+                count += _write_lines(out_file, pending.popleft().result())
+    finally:
+        if out_path is not None:
+            out_file.close()
+    return count
+
+
+def _open_private(out_path):
+    """Open out_path for writing, readable and writable by this user only
+    (even if it already exists), since it's going to hold passwords.
+    """
+    out_fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(out_fd, 0o600)
+    return os.fdopen(out_fd, "w")
+
+
+def _provision_chunk(proto_pw, chunk):
+    """Calculate the passwords for one chunk (runs in a worker process)."""
+    from keymaster.key_password import Password
+    passwords = Password.calculate_passwords(proto_pw, chunk)
+    return [pass_obj.nickname + "\t" + password + "\n" for pass_obj, password in zip(chunk, passwords)]
+
+
+def _write_lines(out_file, lines):
+    """Write lines to out_file and return how many we wrote."""
+    out_file.writelines(lines)
+    return len(lines)
+
+
+def import_pass(in_path, pass_db, _, file_format=None):
+    """Import passwords from a CSV file (with a header row naming the Password
+    fields) or a JSON-lines file, or from stdin if in_path is None.
+    The file is read as it's inserted, and it all goes in one transaction:
+    on any error nothing is imported.
+    """
+    import sqlite3
+    if file_format is None:
+        file_format = "jsonl" if in_path is not None and in_path.endswith((".jsonl", ".json")) else "csv"
+    in_file = sys.stdin if in_path is None else open(in_path, newline="")
+    start_time = time.perf_counter()
+    try:
+        count = pass_db.bulk_insert(_read_import_file(in_file, file_format))
+    except (ValueError, csv.Error, sqlite3.Error) as err:
+        print(_MSG_IMPORT_FAILED.format(err), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if in_path is not None:
+            in_file.close()
+    elapsed = time.perf_counter() - start_time
+    print(_MSG_IMPORTED.format(count, elapsed, count / elapsed if elapsed else 0), file=sys.stderr)
+    return count
+
+
+def _read_import_file(in_file, file_format):
+    """Yield a Password for each record in in_file, one line at a time."""
+    if file_format == "csv":
+        records = csv.DictReader(in_file)
+    else:
+        records = (json.loads(line) for line in in_file if line.strip())
+    for record_num, record in enumerate(records, 1):
+        try:
+            yield _password_from_record(record)
+        except (TypeError, ValueError) as err:
+            raise ValueError("record {}: {}".format(record_num, err))
+
+
+def _password_from_record(record):
+    """Create a Password from a dict of field names and (string or JSON) values.
+    Missing or empty fields get the Password defaults.
+    """
+    from keymaster.key_kdf import check_cost
+    from keymaster.key_password import Password
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+    unknown_fields = set(record) - set(Password.FIELDS)
+    if unknown_fields:
+        raise ValueError("unknown fields " + ", ".join(sorted(map(str, unknown_fields))))
+    if not record.get("nickname"):
+        raise ValueError("nickname is required")
+    fields = {field: value for field, value in record.items() if value not in (None, "")}
+    for field in _INT_FIELDS:
+        if field in fields:
+            fields[field] = int(fields[field])
+    if isinstance(fields.get("special_char"), str):
+        fields["special_char"] = fields["special_char"].lower() in ("y", "yes", "true", "1")
+    pw_obj = Password(**fields)
+    if pw_obj.base not in _BASES:
+        raise ValueError("base must be 32 or 64, not {}".format(pw_obj.base))
+    check_cost(pw_obj.kdf, pw_obj.kdf_cost)
+    return pw_obj
+
+
+def calibrate_pass(kdf, _pass_db, _pass_dic, target_ms=100):
+    """Find the cost for a KDF (or for each) that takes about target_ms per password on this machine."""
+    from keymaster import key_kdf
+    for kdf in ([kdf] if kdf else key_kdf.KDF_NAMES):
+        try:
+            cost, measured_ms = key_kdf.calibrate(kdf, target_ms)
+        except ValueError as err:
+            print(err, file=sys.stderr)
+            sys.exit(1)
+        print(_MSG_CALIBRATED.format(kdf, cost, measured_ms))
+
+
+def snapshot_pass(out_path, pass_db, _):
+    """Write a read-only snapshot of the passwords (see key_snapshot), by
+    default next to the db, where lookups use it until the db changes.
+    """
+    from keymaster.key_snapshot import snapshot_path_for
+    try:
+        count = pass_db.write_snapshot(out_path)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    if out_path:
+        snapshot_paths = [out_path]
+    elif hasattr(pass_db, "db_names"):      # a FederatedPasswordDB snapshots each of its dbs
+        snapshot_paths = [snapshot_path_for(db_name) for db_name in pass_db.db_names]
+    else:
+        snapshot_paths = [snapshot_path_for(pass_db.db_name)]
+    print(_MSG_SNAPSHOT_WRITTEN.format(count, ", ".join(snapshot_paths)), file=sys.stderr)
+    return count
+
+
+def split_pass(num_shards, pass_db, _, out_dir=None):
+    """Split the db into num_shards new ones (see key_federated.split_database)
+    that can then be used together with several --db-path options.
+    """
+    from keymaster.key_federated import split_database
+    from keymaster.key_password import PasswordDB
+    if not isinstance(pass_db, PasswordDB):
+        print(_MSG_SPLIT_ONE_DB, file=sys.stderr)
+        sys.exit(1)
+    if num_shards is None or not num_shards.isdigit():
+        print(_MSG_SPLIT_NEEDS_NUM, file=sys.stderr)
+        sys.exit(1)
+    try:
+        paths = split_database(pass_db, int(num_shards), out_dir)
+    except (ValueError, OSError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    for path in paths:
+        print(_MSG_SPLIT_WRITTEN.format(path), file=sys.stderr)
+    return paths
+
+
+def sync_pass(peer, pass_db, _, new_replica_id=False):
+    """Exchange changes with another replica of the db: a database file or a
+    sync directory (see key_sync).  --new-replica-id first gives this db a new
+    replica id (for a db that was copied from another replica's file).
+    """
+    from keymaster import key_sync
+    from keymaster.key_password import PasswordDB
+    if not isinstance(pass_db, PasswordDB):
+        print(_MSG_SYNC_ONE_DB, file=sys.stderr)
+        sys.exit(1)
+    if new_replica_id:
+        pass_db.new_replica_id()
+    if peer is None:
+        if new_replica_id:
+            return None
+        print(_MSG_SYNC_NEEDS_PEER, file=sys.stderr)
+        sys.exit(1)
+    try:
+        received, received_applied, sent, _ = key_sync.sync(pass_db, peer)
+    except (ValueError, OSError) as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    print(_MSG_SYNCED.format(received, received_applied, sent), file=sys.stderr)
+    return received, sent
 
-    print("Password: " + pass_obj.calculate_password(proto_pw))
+
+def agent_pass(socket_path, pass_db, pass_dic, proto_pw_timeout=0, derivation_cache_ttl=0):
+    """Run an agent serving this db in the foreground (see key_agent)."""
+    if not hasattr(pass_db, "db_name"):     # a FederatedPasswordDB
+        print(_MSG_AGENT_ONE_DB, file=sys.stderr)
+        sys.exit(1)
+    socket_path = key_agent.get_socket_path() if socket_path is None else socket_path
+    try:
+        key_agent.run_agent(socket_path, pass_db, pass_dic, proto_pw_timeout, derivation_cache_ttl)
+    except RuntimeError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+
+
+def _chunked(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
 
 
 def hint_pass(nick, pass_db, pass_dic):
@@ -173,16 +622,101 @@ def delete_pass(nick, pass_db, pass_dic):
     del pass_dic[pass_obj.nickname]
 
 
-def list_pass(orig_nick, _, pass_dic):
-    """List Password details either about the given nick (if non-None) or about all nicks."""
+def list_pass(orig_nick, pass_db, pass_dic, limit=None, offset=0, list_format=None, **filters):
+    """List Password details either about the given nick (if non-None) or about all nicks
+    (that match the filters: --host, --user, etc.; see PasswordDB.query).
+    All nicks are streamed from the db in nickname order (skipping offset of them and
+    stopping after limit) and written a chunk of rows at a time, so memory use doesn't
+    grow with the db.  Returns the number of passwords listed.
+    """
+    list_format = list_format or "text"
     if orig_nick is not None:
-        if orig_nick in pass_dic:
-            print(pass_dic[orig_nick])
-        else:
+        if orig_nick not in pass_dic:
             print(_MSG_NICK_NOT_FOUND.format(orig_nick), file=sys.stderr)
+            return 0
+        rows, first_num = [pass_dic[orig_nick].fields()], None
     else:
-        for i, pass_pair in enumerate(sorted(pass_dic.items())):
-            print(str(i+1) + ": " + str(pass_pair[1]))
+        rows = pass_db.iter_password_rows(_LIST_CHUNK_SIZE, limit, offset or 0, **filters)
+        first_num = (offset or 0) + 1
+    try:
+        return _LIST_WRITERS[list_format](sys.stdout, _chunked(rows, _LIST_CHUNK_SIZE), first_num)
+    except BrokenPipeError:     # e.g. piped into head: stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+def _write_text(out_file, chunks, first_num):
+    """Write "N: Password(...)" lines, numbered from first_num (or just the Password if it's None)."""
+    from keymaster.key_password import REPR, Password
+    # REPR with positional fields (much faster than formatting it by name), after the line number {0}:
+    line_format = REPR.format(**{field: "{%d}" % i for i, field in enumerate(Password.FIELDS, 1)}) + "\n"
+    if first_num is not None:
+        line_format = "{0}: " + line_format
+    count = 0
+    for chunk in chunks:
+        start = (first_num or 0) + count
+        count += _write_lines(out_file, [line_format.format(num, *row) for num, row in enumerate(chunk, start)])
+    return count
+
+
+def _write_json(out_file, chunks, _):
+    """Write a JSON array of objects (a chunk of them per line)."""
+    encode = json.JSONEncoder(check_circular=False).encode
+    count = 0
+    out_file.write("[")
+    for chunk in chunks:
+        out_file.write(("\n" if not count else ",\n") + encode([_record(row) for row in chunk])[1:-1])
+        count += len(chunk)
+    out_file.write("\n]\n" if count else "]\n")
+    return count
+
+
+def _write_jsonl(out_file, chunks, _):
+    """Write a JSON object per line (which import reads back)."""
+    encode = json.JSONEncoder(check_circular=False).encode
+    return sum(_write_lines(out_file, [encode(_record(row)) + "\n" for row in chunk]) for chunk in chunks)
+
+
+def _write_csv(out_file, chunks, _):
+    """Write CSV with a header row naming the fields (which import reads back)."""
+    from keymaster.key_password import Password
+    writer = csv.writer(out_file)
+    writer.writerow(Password.FIELDS)
+    count = 0
+    for chunk in chunks:
+        writer.writerows(_record(row).values() for row in chunk)
+        count += len(chunk)
+    return count
+
+
+def _record(row):
+    """A dict of field names and values for a row (with special_char as a bool)."""
+    from keymaster.key_password import Password
+    record = dict(zip(Password.FIELDS, row))
+    record["special_char"] = bool(record["special_char"])
+    return record
+
+
+_LIST_WRITERS = {"text": _write_text, "json": _write_json, "jsonl": _write_jsonl, "csv": _write_csv}
+
+
+def search_pass(query, pass_db, pass_dic, num_matches=None):
+    """List the passwords that best match query (fuzzily, by nickname, username or hostname)."""
+    from keymaster.key_search import DEFAULT_NUM_MATCHES, NicknameIndex
+    if query is None:
+        query = input(_MSG_SEARCH)
+    index = NicknameIndex(pass_db.iter_password_objects())
+    matches = index.search(query, num_matches or DEFAULT_NUM_MATCHES)
+    _print_matches(matches, pass_dic)
+    return matches
+
+
+def _print_matches(matches, pass_dic):
+    """Print numbered details for each matching nickname."""
+    if not matches:
+        print(_MSG_NO_MATCHES, file=sys.stderr)
+    for i, nick in enumerate(matches):
+        print(str(i+1) + ": " + str(pass_dic[nick]))
 
 
 def _select_pass(nick, pass_db, pass_dic):
@@ -194,6 +728,8 @@ def _select_pass(nick, pass_db, pass_dic):
             return pass_dic[nick]
         else:
             print(_MSG_NICK_NOT_FOUND.format(nick), file=sys.stderr)
+    if len(pass_dic) > _MAX_LISTED_FOR_SELECTION:
+        return _search_and_select_pass(pass_db, pass_dic)
     list_pass(None, pass_db, pass_dic)
     pos = None      # Note: pos is 0-based for Python, 1-based for user
     keys = sorted(list(pass_dic.keys()))
@@ -204,26 +740,110 @@ def _select_pass(nick, pass_db, pass_dic):
     return pass_dic[keys[pos-1]]
 
 
-COMMANDS_MAP = [("create", {"func": create_pass, "desc": "create a new password"}),
-                ("update", {"func": update_pass, "desc": "update an existing password"}),
-                ("list", {"func": list_pass, "desc": "list details of an existing password (or all)"}),
+def _search_and_select_pass(pass_db, pass_dic):
+    """Let the user narrow down the passwords with fuzzy searches until they choose one."""
+    from keymaster.key_search import NicknameIndex
+    index = NicknameIndex(pass_db.iter_password_objects())
+    while True:
+        matches = index.search(input(_MSG_SEARCH))
+        _print_matches(matches, pass_dic)
+        pos = _read_default_int(_MSG_SELECT_MATCH, None) if matches else None
+        if pos is not None and pos-1 in range(len(matches)):
+            return pass_dic[matches[pos-1]]
+
+
+COMMANDS_MAP = [("create", {"func": create_pass, "desc": "create a new password", "opts": _KDF_OPTS}),
+                ("update", {"func": update_pass, "desc": "update an existing password", "opts": _KDF_OPTS}),
+                ("list", {"func": list_pass, "desc": "list details of an existing password (or all)",
+                          "opts": [(("-l", "--limit"), {"type": int, "default": None,
+                                                        "help": "list at most this many passwords"}),
+                                   (("-o", "--offset"), {"type": int, "default": None,
+                                                         "help": "skip this many passwords first"}),
+                                   (("-f", "--format"), {"dest": "list_format", "default": None,
+                                                         "choices": ["text", "json", "jsonl", "csv"],
+                                                         "help": "output format (default: text)"}),
+                                   (("--host",), {"default": None, "help": "only passwords for this hostname"}),
+                                   (("--user",), {"default": None, "help": "only passwords for this username"}),
+                                   (("--base",), {"type": int, "default": None, "choices": [32, 64],
+                                                  "help": "only passwords in this base"}),
+                                   (("--special",), {"action": "store_const", "const": True, "default": None,
+                                                     "help": "only passwords with special characters"}),
+                                   (("--no-special",), {"action": "store_const", "const": False, "default": None,
+                                                        "dest": "special",
+                                                        "help": "only passwords without special characters"}),
+                                   (("--iteration-gt",), {"type": int, "default": None, "metavar": "N",
+                                                          "help": "only passwords with an iteration over N"})]}),
                 ("hint", {"func": hint_pass, "desc": "get the hint for an existing password"}),
-                ("get", {"func": get_pass, "desc": "get an existing password"}),
-                ("delete", {"func": delete_pass, "desc": "delete an existing password"})]
+                ("get", {"func": get_pass, "desc": "get an existing password",
+                         "opts": [(("--batch",), {"action": "store_true", "default": None,
+                                                  "help": "read nicknames from stdin, one per line, and write "
+                                                          "their passwords in order (a blank line for errors)"}),
+                                  (("--proto-fd",), {"type": int, "default": None, "metavar": "FD",
+                                                     "help": "read the proto-password from the first line of "
+                                                             "file descriptor FD instead of asking"})]}),
+                ("delete", {"func": delete_pass, "desc": "delete an existing password"}),
+                ("search", {"func": search_pass, "desc": "fuzzy-search nicknames, usernames and hostnames",
+                            "metavar": "query",
+                            "opts": [(("-n", "--num-matches"), {"type": int, "default": None,
+                                                                "help": "how many matches to show"})]}),
+                ("provision", {"func": provision_pass, "desc": "write all passwords to a file (or stdout)",
+                               "metavar": "file",
+                               "opts": [(("-w", "--workers"), {"type": int, "default": None,
+                                                               "help": "number of worker processes"}),
+                                        (("-c", "--chunk-size"), {"type": int, "default": _PROVISION_CHUNK_SIZE,
+                                                                  "help": "passwords per work item"})]}),
+                ("import", {"func": import_pass, "desc": "import passwords from a CSV or JSON-lines file (or stdin)",
+                            "metavar": "file",
+                            "opts": [(("-f", "--format"), {"dest": "file_format", "choices": _IMPORT_FORMATS,
+                                                           "help": "file format (default: from the file name)"})]}),
+                ("snapshot", {"func": snapshot_pass, "desc": "write a snapshot of the db for fast lookups",
+                              "metavar": "file"}),
+                ("split", {"func": split_pass, "desc": "split the db into several (see --db-path)",
+                           "metavar": "num_shards",
+                           "opts": [(("-o", "--out-dir"), {"default": None,
+                                                           "help": "where to write them (default: next to the db)"})]}),
+                ("sync", {"func": sync_pass, "desc": "exchange changes with another copy of the db (or a directory)",
+                          "metavar": "peer",
+                          "opts": [(("--new-replica-id",), {"action": "store_true",
+                                                            "help": "first give this db a new replica id "
+                                                                    "(if it was copied from another's file)"})]}),
+                ("agent", {"func": agent_pass, "desc": "keep the db open and answer get, hint and list requests",
+                           "metavar": "socket",
+                           "opts": [(("-t", "--cache-timeout"), {"dest": "proto_pw_timeout", "type": float,
+                                                                 "default": 0,
+                                                                 "help": "seconds to remember the proto-password "
+                                                                         "(default: don't)"}),
+                                    (("--derivation-cache-ttl",), {"type": float, "default": 0,
+                                                                   "help": "seconds to cache calculated passwords "
+                                                                           "(default: don't)"})]}),
+                ("calibrate", {"func": calibrate_pass, "desc": "pick KDF costs for a target time per password",
+                               "metavar": "kdf", "no_db": True,
+                               "opts": [(("-t", "--target-ms"), {"type": float, "default": 100,
+                                                                 "help": "target milliseconds (default 100)"})]})]
+_AGENT_COMMANDS = {get_pass: "get", hint_pass: "hint", list_pass: "list", search_pass: "search"}
 
 
 def parse_args(command_line):
     """Redirect each subcommand to the appropriate function."""
     parser = argparse.ArgumentParser(description="Manage passwords easily and securely")
-    parser.add_argument("-d", "--db-path", default=DEFAULT_DB_PATH,
-                        help="Alternate passwords-database path")
+    parser.add_argument("-d", "--db-path", action="append", default=None,
+                        help="Alternate passwords-database path (repeat to use several databases as one)")
+    parser.add_argument("--no-agent", action="store_true",
+                        help="Don't use a running keymaster agent")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print timings and counts of database and password operations at exit "
+                             "(implies --no-agent)")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="Append a JSON line per database and password operation to FILE (implies --no-agent)")
+    key_profile.add_profile_arg(parser)
     subparsers = parser.add_subparsers(title="commands", description="valid subcommands", help="additional help")
     for cmd, cmd_data in OrderedDict(COMMANDS_MAP).items():
         subparser = subparsers.add_parser(cmd, description=cmd_data["desc"])
-        subparser.add_argument("nickname", nargs="?", default=None)
-        subparser.set_defaults(func=cmd_data["func"])
-    parsed_args = parser.parse_args(command_line)
-    if list(vars(parsed_args).keys()) == ["db_path"]: # the only argument is the db_path (which we added)
+        subparser.add_argument("nickname", nargs="?", default=None, metavar=cmd_data.get("metavar", "nickname"))
+        opt_names = [subparser.add_argument(*flags, **kwargs).dest for flags, kwargs in cmd_data.get("opts", [])]
+        subparser.set_defaults(func=cmd_data["func"], opt_names=opt_names, no_db=cmd_data.get("no_db", False))
+    parsed_args = parser.parse_args(key_profile.expand_bare_profile_arg(command_line))
+    if "func" not in vars(parsed_args):     # no subcommand, only the global options
         parser.print_help()
         parser.exit()
     return parsed_args
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+"""Tests:
+- Agent requests: get (with and without a cached proto-password or derivation cache), hint, list
+  (but not of all the passwords)
+- Search, and noticing changes made through another connection
+- Keeping the search index current with just the changed rows
+- Bad requests and requests for another (or the default) db
+- A round trip over the socket
+- Falling back when the socket is wedged, stale or not a socket
+"""
+
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import keymaster.key_password as pw
+from keymaster.cli import key_agent
+
+
+NICK, PROTO_PW = "nick", "pass"
+
+
+def _get_agent(proto_pw_timeout=0, derivation_cache_ttl=0):
+    """An agent for an in-memory db with a single password."""
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.create_new_password(pw.Password(NICK, "user", "host", hint="hint"))
+    return key_agent.KeyAgent(pdb, pw.LazyPasswordDict(pdb), proto_pw_timeout, derivation_cache_ttl)
+
+
+def _request(agent, db_path=":memory:", **req):
+    """Encode a request like the client does and pass it to the agent."""
+    return agent.handle_request(json.dumps(dict(req, db_path=db_path)).encode())
+
+
+def test_hint_and_list():
+    """Hint and list for one nickname; listing them all isn't done by the agent."""
+    # given:
+    agent = _get_agent()
+    expected_str = str(agent.pass_dic[NICK])
+    # when/then:
+    assert _request(agent, cmd="hint", nickname=NICK) == {"ok": True, "result": "hint"}
+    assert _request(agent, cmd="list", nickname=NICK) == {"ok": True, "result": expected_str}
+    assert _request(agent, cmd="list") == {"ok": False, "error": key_agent.ERR_BAD_REQUEST}   # streamed by the client
+    assert _request(agent, cmd="hint", nickname="other") == {"ok": False, "error": key_agent.ERR_NICK_NOT_FOUND}
+
+
+def test_get_without_cache():
+    """Without caching, every get needs the proto-password."""
+    # given:
+    agent = _get_agent()
+    expected_pw = agent.pass_dic[NICK].calculate_password(PROTO_PW)
+    # when/then:
+    assert _request(agent, cmd="get", nickname=NICK, proto_pw=PROTO_PW) == {"ok": True, "result": expected_pw}
+    assert _request(agent, cmd="get", nickname=NICK) == {"ok": False, "error": key_agent.ERR_NEED_PROTO_PW}
+
+
+def test_get_with_cache():
+    """With caching, the proto-password is remembered until it expires."""
+    # given:
+    agent = _get_agent(proto_pw_timeout=60)
+    expected_pw = agent.pass_dic[NICK].calculate_password(PROTO_PW)
+    # when:
+    _request(agent, cmd="get", nickname=NICK, proto_pw=PROTO_PW)
+    # then:
+    assert _request(agent, cmd="get", nickname=NICK) == {"ok": True, "result": expected_pw}
+    agent._proto_pw_expiry = time.monotonic()
+    assert _request(agent, cmd="get", nickname=NICK) == {"ok": False, "error": key_agent.ERR_NEED_PROTO_PW}
+
+
+def test_get_with_derivation_cache():
+    """With a derivation cache, gets are answered from it but still need the proto-password."""
+    # given:
+    agent = _get_agent(derivation_cache_ttl=60)
+    expected_pw = agent.pass_dic[NICK].calculate_password(PROTO_PW)
+    # when/then:
+    assert _request(agent, cmd="get", nickname=NICK, proto_pw=PROTO_PW) == {"ok": True, "result": expected_pw}
+    assert _request(agent, cmd="get", nickname=NICK, proto_pw=PROTO_PW) == {"ok": True, "result": expected_pw}
+    assert len(agent.derivation_cache) == 1
+    assert _request(agent, cmd="get", nickname=NICK) == {"ok": False, "error": key_agent.ERR_NEED_PROTO_PW}
+
+
+def test_search_and_changes():
+    """Search, then change the db from another connection and search again."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        db_path = os.path.join(tmp_dir, "test.db")
+        pdb = pw.PasswordDB(db_path, True)
+        pdb.create_new_password(pw.Password(NICK, "user", "host", hint="hint"))
+        agent = key_agent.KeyAgent(pdb, pw.LazyPasswordDict(pdb))
+        assert _request(agent, db_path, cmd="search", nickname="host")["result"] == [str(pdb.find_password(NICK))]
+        assert _request(agent, db_path, cmd="hint", nickname=NICK)["result"] == "hint"
+        # when:
+        other_pdb = pw.PasswordDB(db_path, False)
+        other_pdb.update_old_password(NICK, pw.Password(NICK, "user", "newhost", hint="newhint"))
+        other_pdb.close_db()
+        # then:
+        assert _request(agent, db_path, cmd="hint", nickname=NICK)["result"] == "newhint"
+        assert _request(agent, db_path, cmd="search", nickname="newhost")["result"] == [str(pdb.find_password(NICK))]
+
+
+def test_search_index_kept_current():
+    """The search index is built once and only the changed rows are re-applied to it."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        db_path = os.path.join(tmp_dir, "test.db")
+        pdb = pw.PasswordDB(db_path, True)
+        pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host%d" % i) for i in range(5))
+        agent = key_agent.KeyAgent(pdb, pw.LazyPasswordDict(pdb))
+        assert len(_request(agent, db_path, cmd="search", nickname="host3")["result"]) > 0
+        index = agent._index
+        # when:
+        other_pdb = pw.PasswordDB(db_path, False)
+        other_pdb.create_new_password(pw.Password("bank", "user", "mybank.example"))
+        other_pdb.update_old_password("nick1", pw.Password("renamed", "user", "host1"))
+        other_pdb.delete_password("nick2")
+        other_pdb.close_db()
+        # then:
+        search = _request(agent, db_path, cmd="search", nickname="mybank", num_matches=1)["result"]
+        assert search == [str(pdb.find_password("bank"))]
+        assert agent._index is index
+        assert sorted(index._grams_by_nick) == ["bank", "nick0", "nick3", "nick4", "renamed"]
+        assert _request(agent, db_path, cmd="hint", nickname="nick1")["error"] == key_agent.ERR_NICK_NOT_FOUND
+
+
+def test_bad_requests():
+    """Garbage, unknown commands and the wrong db are all refused."""
+    # given:
+    agent = _get_agent()
+    # when/then:
+    assert agent.handle_request(b"not json")["error"] == key_agent.ERR_BAD_REQUEST
+    assert _request(agent, cmd="delete", nickname=NICK)["error"] == key_agent.ERR_BAD_REQUEST
+    assert _request(agent, cmd="hint", nickname=NICK, db_path="/other.db")["error"] == key_agent.ERR_WRONG_DB
+    assert _request(agent, cmd="hint", nickname=NICK, db_path=None)["error"] == key_agent.ERR_WRONG_DB
+
+
+def test_socket_round_trip():
+    """Run an agent in a thread and talk to it over its socket."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given an agent, created in its own thread since that's where it uses the db:
+        socket_path = os.path.join(tmp_dir, "agent.sock")
+        agents = []
+        def run_agent():
+            agents.append(_get_agent())
+            asyncio.run(agents[0].serve(socket_path))
+        thread = threading.Thread(target=run_agent)
+        thread.start()
+        while key_agent.request(socket_path, {"cmd": "ping"}) is None:
+            time.sleep(0.01)
+        # when:
+        response = key_agent.request(socket_path, {"cmd": "hint", "nickname": NICK, "db_path": ":memory:"})
+        agents[0].stop()
+        thread.join()
+        # then:
+        assert response == {"ok": True, "result": "hint"}
+        assert not os.path.exists(socket_path)
+        assert key_agent.request(socket_path, {"cmd": "ping"}) is None
+
+
+def test_request_without_a_working_agent():
+    """A socket nobody answers on, a stale one and a non-socket all mean "no agent"."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given a listening socket that never answers:
+        socket_path = os.path.join(tmp_dir, "wedged.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as wedged:
+            wedged.bind(socket_path)
+            wedged.listen(1)
+            # when/then:
+            start = time.monotonic()
+            assert key_agent.request(socket_path, {"cmd": "ping"}, timeout=0.2) is None
+            assert time.monotonic() - start < 5
+        # and given a socket left behind with nothing listening, and a plain file:
+        not_a_socket = os.path.join(tmp_dir, "file")
+        with open(not_a_socket, "w") as out_file:
+            out_file.write("not a socket")
+        # when/then:
+        assert key_agent.request(socket_path, {"cmd": "ping"}) is None
+        assert key_agent.request(not_a_socket, {"cmd": "ping"}) is None
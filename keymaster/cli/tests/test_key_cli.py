@@ -7,7 +7,12 @@
 """
 
 from io import StringIO
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 from nose.tools import raises
 
 import keymaster.key_password as pw
@@ -45,6 +50,17 @@ def test_nonempty_commands():
         assert args.func == func_desc["func"]
 
 
+def test_lazy_imports():
+    """Importing the CLI (all that --help needs) doesn't import the heavy modules."""
+    # given:
+    heavy_modules = ["asyncio", "concurrent.futures", "hashlib", "keymaster.key_password", "sqlite3", "xdg"]
+    check = "import sys, keymaster.cli.key_cli; print(' '.join(m for m in sys.argv[1:] if m in sys.modules))"
+    # when:
+    output = subprocess.check_output([sys.executable, "-c", check] + heavy_modules, universal_newlines=True)
+    # then:
+    assert output.strip() == ""
+
+
 @raises(SystemExit)     # then
 def test_call_with_bad_command():
     """Non-existent subcommand ("other") should raise an error."""
@@ -141,8 +157,387 @@ def test_update():
     assert pdb.get_list_of_nicks() == [new_nick]
 
 
+def test_create_and_update_with_kdf():
+    """Create with a KDF; update keeps it unless a new one is given."""
+    # given:
+    pdic, pdb = {}, pw.PasswordDB(":memory:", True)
+    save_stdin, sys.stdin = sys.stdin, StringIO(TEST_CREATE_INPUT + TEST2_CREATE_INPUT + TEST_CREATE_INPUT)
+    # when/then:
+    cli.create_pass(None, pdb, pdic, kdf="pbkdf2-sha512", kdf_cost=5000)
+    assert (pdb.get_password_for_nick("nick").kdf, pdb.get_password_for_nick("nick").kdf_cost) == \
+        ("pbkdf2-sha512", 5000)
+    cli.update_pass("nick", pdb, pdic)
+    assert (pdb.get_password_for_nick("nick2").kdf, pdb.get_password_for_nick("nick2").kdf_cost) == \
+        ("pbkdf2-sha512", 5000)
+    cli.update_pass("nick2", pdb, pdic, kdf="scrypt")
+    sys.stdin = save_stdin
+    assert (pdb.get_password_for_nick("nick").kdf, pdb.get_password_for_nick("nick").kdf_cost) == ("scrypt", 14)
+
+
+@raises(SystemExit)     # then
+def test_create_with_bad_kdf():
+    """An unknown KDF is an error."""
+    save_stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        # given/when:
+        cli.create_pass("nick", pw.PasswordDB(":memory:", True), {}, kdf="md5")
+    finally:
+        sys.stderr = save_stderr
+
+
+def test_calibrate():
+    """Calibrate doesn't need a db, and prints a cost for each KDF (or the one given)."""
+    # given:
+    args = cli.parse_args(["calibrate", "scrypt", "-t", "1"])
+    assert args.no_db and not cli.parse_args(["list"]).no_db
+    # when:
+    save_stdout, sys.stdout = sys.stdout, StringIO()
+    cli.calibrate_pass(args.nickname, None, None, args.target_ms)
+    output, sys.stdout = sys.stdout.getvalue(), save_stdout
+    # then:
+    assert output.startswith("scrypt: --kdf-cost ")
+
+
+def test_search():
+    """Create two, then search."""
+    # First create:
+    pdic, pdb = _create_dummy(TEST_CREATE_INPUT)
+    save_stdin, sys.stdin = sys.stdin, StringIO(TEST2_CREATE_INPUT)
+    cli.create_pass(None, pdb, pdic)
+    sys.stdin = save_stdin
+    # when:
+    save_stdout, sys.stdout = sys.stdout, StringIO()
+    matches = cli.search_pass("host2", pdb, pdic)
+    output, sys.stdout = sys.stdout.getvalue(), save_stdout
+    # then:
+    assert matches[0] == "nick2"
+    assert output.splitlines()[0] == "1: " + str(pdic["nick2"])
+
+
+def test_select_by_search():
+    """With many passwords, choosing one means searching first."""
+    # given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%02d" % i, "user", "host%02d" % i) for i in range(30))
+    pdic = pw.LazyPasswordDict(pdb)
+    # Search once with no good match, then for host17 and take the first match:
+    save_stdin, sys.stdin = sys.stdin, StringIO("zzzz\nhost17\n1\n")
+    save_stdout, sys.stdout = sys.stdout, StringIO()
+    save_stderr, sys.stderr = sys.stderr, sys.stdout
+    # when:
+    pass_obj = cli._select_pass(None, pdb, pdic)
+    sys.stdin, sys.stdout, sys.stderr = save_stdin, save_stdout, save_stderr
+    # then:
+    assert pass_obj.nickname == "nick17"
+
+
+def test_provision():
+    """Create two, then provision them to a file."""
+    # First create:
+    pdic, pdb = _create_dummy(TEST_CREATE_INPUT)
+    save_stdin, sys.stdin = sys.stdin, StringIO(TEST2_CREATE_INPUT)
+    cli.create_pass(None, pdb, pdic)
+    sys.stdin = save_stdin
+    # given:
+    proto_pw = "pass"
+    expected = ["%s\t%s" % (nick, pdic[nick].calculate_password(proto_pw)) for nick in ["nick", "nick2"]]
+    save_read_proto, cli._read_proto_password = cli._read_proto_password, lambda: proto_pw
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, "out.tsv")
+        # when:
+        count = cli.provision_pass(out_path, pdb, pdic, workers=2, chunk_size=1)
+        with open(out_path) as out_file:
+            output = out_file.read()
+        mode = os.stat(out_path).st_mode & 0o777
+    cli._read_proto_password = save_read_proto
+    # then:
+    assert count == 2
+    assert output.splitlines() == expected
+    assert mode == 0o600
+
+
+def test_provision_bad_numbers():
+    """Zero or negative --workers or --chunk-size is an error, not an empty file."""
+    pdb = pw.PasswordDB(":memory:", True)
+    save_stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        for options in ({"chunk_size": 0}, {"chunk_size": -1}, {"workers": 0}, {"workers": -2}):
+            try:
+                cli.provision_pass(None, pdb, {}, **options)
+                assert False, "provisioned with " + str(options)
+            except SystemExit as err:
+                assert err.code == 1
+    finally:
+        sys.stderr = save_stderr
+
+
+def _import_file(contents, file_name, pdb):
+    """Write contents to a temporary file and import it."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_path = os.path.join(tmp_dir, file_name)
+        with open(in_path, "w") as in_file:
+            in_file.write(contents)
+        save_stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            return cli.import_pass(in_path, pdb, {})
+        finally:
+            sys.stderr = save_stderr
+
+
+def test_import():
+    """Import a CSV file and a JSON-lines file."""
+    # given:
+    pdb = pw.PasswordDB(":memory:", True)
+    csv_input = "nickname,username,hostname,special_char,base\nnick,user,host,y,64\nnick2,user2,host2,,\n"
+    jsonl_input = '{"nickname": "nick3", "iteration": 2}\n\n{"nickname": "nick4", "hint": "hint4", "kdf": "scrypt"}\n'
+    # when:
+    csv_count = _import_file(csv_input, "in.csv", pdb)
+    jsonl_count = _import_file(jsonl_input, "in.jsonl", pdb)
+    # then:
+    assert (csv_count, jsonl_count) == (2, 2)
+    assert pdb.get_list_of_nicks() == ["nick", "nick2", "nick3", "nick4"]
+    assert pdb.get_password_for_nick("nick") == pw.Password("nick", "user", "host", True, 64)
+    assert pdb.get_password_for_nick("nick2") == pw.Password("nick2", "user2", "host2")
+    assert pdb.get_password_for_nick("nick3").iteration == 2
+    assert pdb.get_password_for_nick("nick4").hint == "hint4"
+    assert (pdb.get_password_for_nick("nick4").kdf, pdb.get_password_for_nick("nick4").kdf_cost) == ("scrypt", 14)
+
+
+def _list(pdb, nick=None, **opts):
+    """Run list_pass and return what it printed."""
+    save_stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        cli.list_pass(nick, pdb, pw.LazyPasswordDict(pdb), **opts)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = save_stdout
+
+
+def test_list():
+    """List pages of the db in each format; json, jsonl and csv can be imported again."""
+    # given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%02d" % i, "user", "host", i % 2 == 0) for i in range(25))
+    expected = [pdb.get_password_for_nick("nick%02d" % i) for i in range(10, 15)]
+    # when/then:
+    text = _list(pdb, limit=5, offset=10)
+    assert text.splitlines() == ["%d: %r" % (i + 11, pw_obj) for i, pw_obj in enumerate(expected)]
+    assert len(_list(pdb).splitlines()) == 25
+    assert _list(pdb, "nick03") == repr(pdb.get_password_for_nick("nick03")) + "\n"
+    assert [pw.Password(**record) for record in json.loads(_list(pdb, limit=5, offset=10, list_format="json"))] \
+        == expected
+    assert json.loads(_list(pdb, offset=30, list_format="json")) == []
+    for list_format, file_name in (("jsonl", "in.jsonl"), ("csv", "in.csv")):
+        listed = _list(pdb, limit=5, offset=10, list_format=list_format)
+        new_pdb = pw.PasswordDB(":memory:", True)
+        _import_file(listed, file_name, new_pdb)
+        assert list(new_pdb.iter_password_objects()) == expected
+
+
+def test_list_with_filters():
+    """Only the passwords that match all the filters are listed."""
+    # given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%02d" % i, "user%d" % (i % 2), "host%d" % (i % 3), i % 4 == 0, 32, 1 + i % 5)
+                    for i in range(30))
+    args = cli.parse_args(["list", "--user", "user0", "--no-special", "--iteration-gt", "2", "--format", "jsonl"])
+    # when:
+    listed = _list(pdb, **{opt_name: getattr(args, opt_name) for opt_name in args.opt_names})
+    # then:
+    expected = [pw_obj for pw_obj in pdb.iter_password_objects()
+                if pw_obj.username == "user0" and not pw_obj.special_char and pw_obj.iteration > 2]
+    assert expected and [pw.Password(**json.loads(line)) for line in listed.splitlines()] == expected
+    assert cli.parse_args(["list", "--special"]).special and not cli._run_via_agent(args)
+
+
+def test_list_skips_agent():
+    """The agent only answers plain lists of one password; whole-table lists are streamed locally."""
+    assert not cli._run_via_agent(cli.parse_args(["list"]))
+    assert not cli._run_via_agent(cli.parse_args(["list", "--format", "csv"]))
+    assert not cli._run_via_agent(cli.parse_args(["list", "--limit", "3"]))
+
+
+def test_snapshot():
+    """Write a snapshot next to the db, then look a password up in it."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        pdb = pw.PasswordDB(os.path.join(tmp_dir, "passwords.db"), True)
+        pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(5))
+        # when:
+        save_stderr, sys.stderr = sys.stderr, StringIO()
+        count = cli.snapshot_pass(None, pdb, None)
+        sys.stderr = save_stderr
+        # then:
+        assert count == 5
+        assert os.path.exists(os.path.join(tmp_dir, "passwords.db.snapshot"))
+        assert pw.LazyPasswordDict(pdb)["nick3"] == pw.Password("nick3", "user", "host")
+        pdb.close_db()
+
+
+def test_sync():
+    """Sync a db with a copy of itself, which first needs a new replica id."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        pdb = pw.PasswordDB(os.path.join(tmp_dir, "passwords.db"), True)
+        pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(5))
+        pdb.close_db()
+        shutil.copy(os.path.join(tmp_dir, "passwords.db"), os.path.join(tmp_dir, "copy.db"))
+        pdb = pw.PasswordDB(os.path.join(tmp_dir, "passwords.db"), False)
+        copy_db = pw.PasswordDB(os.path.join(tmp_dir, "copy.db"), False)
+        copy_db.create_new_password(pw.Password("new"))
+        save_stderr, sys.stderr = sys.stderr, StringIO()
+        # when:
+        try:
+            cli.sync_pass(copy_db.db_name, pdb, None)
+            assert False, "synced with a copy"
+        except SystemExit:
+            pass
+        counts = cli.sync_pass(copy_db.db_name, pdb, None, new_replica_id=True)
+        sys.stderr = save_stderr
+        # then:
+        assert counts == (6, 0)     # the copy now has the old replica id, so all its rows come over
+        assert pdb.find_password("new") is not None
+        copy_db.close_db()
+        pdb.close_db()
+
+
+def test_several_dbs_and_split():
+    """Split a db, then use the shards together."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        pdb = pw.PasswordDB(os.path.join(tmp_dir, "passwords.db"), True)
+        pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(20))
+        save_stderr, sys.stderr = sys.stderr, StringIO()
+        paths = cli.split_pass("3", pdb, None)
+        sys.stderr = save_stderr
+        # when:
+        args = cli.parse_args(["-d", paths[0], "-d", paths[1], "--db-path", paths[2], "list"])
+        fed_db, pdic = cli._get_data(args.db_path)
+        # then:
+        assert args.db_path == paths
+        assert not cli._run_via_agent(args)
+        assert sorted(pdic) == sorted("nick%d" % i for i in range(20))
+        assert pdic["nick7"] == pdb.find_password("nick7")
+        fed_db.close_db()
+        pdb.close_db()
+
+
+def test_split_several_dbs():
+    """split refuses several --db-path options, rather than crashing."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        db_paths = [os.path.join(tmp_dir, name) for name in ("a.db", "b.db")]
+        for db_path in db_paths:
+            pw.PasswordDB(db_path, True).close_db()
+        # when:
+        command = [sys.executable, "-m", "keymaster.cli.key_cli", "--no-agent",
+                   "-d", db_paths[0], "-d", db_paths[1], "split", "2"]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        # then:
+        assert result.returncode == 1
+        assert result.stderr == cli._MSG_SPLIT_ONE_DB + "\n"
+        assert sorted(os.listdir(tmp_dir)) == ["a.db", "b.db"]
+
+
+@raises(SystemExit)     # then
+def test_import_with_error():
+    """A bad record anywhere means nothing is imported."""
+    # given:
+    pdb = pw.PasswordDB(":memory:", True)
+    jsonl_input = '{"nickname": "nick"}\n{"nickname": "nick2", "base": "abcd"}\n'
+    # when:
+    try:
+        _import_file(jsonl_input, "in.jsonl", pdb)
+    finally:
+        assert pdb.get_list_of_nicks() == []
+
+
+def test_import_bad_records():
+    """Records that aren't objects, and bases other than 32 and 64, fail the import."""
+    for file_name, contents in (("in.jsonl", '{"nickname": "nick"}\n["nick2"]\n'),
+                                ("in.jsonl", '{"nickname": "nick"}\n"nick2"\n'),
+                                ("in.jsonl", '{"nickname": "nick", "base": 16}\n'),
+                                ("in.csv", "nickname,base\nnick,32\nnick2,65\n")):
+        # given:
+        pdb = pw.PasswordDB(":memory:", True)
+        # when:
+        try:
+            _import_file(contents, file_name, pdb)
+            assert False, "imported " + contents
+        except SystemExit:
+            pass
+        # then:
+        assert pdb.get_list_of_nicks() == []
+    try:
+        list(cli._read_import_file(StringIO('["nick"]\n'), "jsonl"))
+        assert False, "read a record that isn't an object"
+    except ValueError as err:
+        assert str(err) == "record 1: not a JSON object"
+
+
 def test_get():
     """Can't test get because of how getpass handles I/O.
     Do it manually.
     """
     assert True
+
+
+def test_get_batch():
+    """Get passwords for nicknames read from a file, with an error for an unknown one."""
+    # given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host%d" % i) for i in range(3))
+    pdb.create_new_password(pw.Password("slow", kdf="scrypt", kdf_cost=10))
+    in_file, out_file = StringIO("nick2\nnope\nslow\nnick0\n"), StringIO()
+    # when:
+    save_stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        counts = cli._get_batch(pdb, "proto", in_file, out_file)
+        errors = sys.stderr.getvalue()
+    finally:
+        sys.stderr = save_stderr
+    # then:
+    expected = [pdb.find_password(nick).calculate_password("proto") for nick in ("nick2", "slow", "nick0")]
+    assert counts == (4, 1)
+    assert out_file.getvalue().split("\n") == [expected[0], "", expected[1], expected[2], ""]
+    assert errors == "line 2: Nickname nope not found.\n"
+
+
+def test_get_batch_command():
+    """Run get --batch with the proto-password on another file descriptor."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        pdb = pw.PasswordDB(os.path.join(tmp_dir, "passwords.db"), True)
+        pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host%d" % i) for i in range(1000))
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b"proto\nnot read\n")
+        os.close(write_fd)
+        nicks = ["nick%d" % (i * 7 % 1000) for i in range(2500)]
+        # when:
+        command = [sys.executable, "-m", "keymaster.cli.key_cli", "--no-agent", "-d", pdb.db_name,
+                   "get", "--batch", "--proto-fd", str(read_fd)]
+        output = subprocess.run(command, input="\n".join(nicks) + "\n", stdout=subprocess.PIPE, check=True,
+                                universal_newlines=True, pass_fds=(read_fd,)).stdout
+        os.close(read_fd)
+        # then:
+        assert output.splitlines() == [pdb.find_password(nick).calculate_password("proto") for nick in nicks]
+        pdb.close_db()
+
+
+def test_get_batch_proto_on_stdin():
+    """Run get --batch with the proto-password on the first line of stdin, before the nicknames."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # given:
+        pdb = pw.PasswordDB(os.path.join(tmp_dir, "passwords.db"), True)
+        pdb.bulk_insert(pw.Password(nick, "user", "host") for nick in ("a", "b", "c"))
+        # when:
+        command = [sys.executable, "-m", "keymaster.cli.key_cli", "--no-agent", "-d", pdb.db_name,
+                   "get", "--batch", "--proto-fd", "0"]
+        result = subprocess.run(command, input="proto\na\nzz\nb\n", stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        # then:
+        expected = [pdb.find_password(nick).calculate_password("proto") for nick in ("a", "b")]
+        assert result.returncode == 1
+        assert result.stdout.split("\n") == [expected[0], "", expected[1], ""]
+        assert "zz" in result.stderr
+        pdb.close_db()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Asyncio front end for PasswordDB.
+
+AsyncPasswordDB runs each PasswordDB call on its own thread pool (with one
+pooled connection per thread), so awaiting a lookup or a commit doesn't block
+the event loop, and concurrent lookups run in parallel.
+
+Example
+----
+pass_db = await AsyncPasswordDB.open(db_path)
+pw_obj = await pass_db.find_password("nick")
+async for pw_obj in pass_db.iter_password_objects():
+    ...
+await pass_db.close_db()
+
+Cancellation: a cancelled call that hasn't started yet never runs.  One that
+is already running on a worker thread can't be interrupted, so it finishes
+(a write is committed or rolled back as a whole, as usual) and its result is
+dropped.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from keymaster.key_password import DEFAULT_DB_PATH
+from keymaster.key_password import PasswordDB
+
+
+DEFAULT_NUM_WORKERS = 4
+
+
+class AsyncPasswordDB:
+    """Awaitable versions of the PasswordDB methods, for a pooled PasswordDB
+    (see open and get_data, which create one).
+    """
+    def __init__(self, pass_db, num_workers=DEFAULT_NUM_WORKERS):
+        self.pass_db = pass_db
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="keymaster-db")
+
+    @classmethod
+    async def open(cls, db_name, create_new_db=False, num_workers=DEFAULT_NUM_WORKERS):
+        """Open (or create) a database, with a connection pool of num_workers connections."""
+        async_db = cls(None, num_workers)
+        async_db.pass_db = await async_db._run(PasswordDB, db_name, create_new_db, pool_size=num_workers)
+        return async_db
+
+    @classmethod
+    async def get_data(cls, ask_to_create_new_func, error_getting_db_func, db_name=DEFAULT_DB_PATH,
+                       num_workers=DEFAULT_NUM_WORKERS):
+        """Like PasswordDB.get_data (the callbacks are run on a worker thread).
+        Reading the passwords dictionary queries the database directly, so in
+        async code prefer find_password, which doesn't block the event loop.
+        """
+        async_db = cls(None, num_workers)
+        pass_db, pass_dic = await async_db._run(PasswordDB.get_data, ask_to_create_new_func, error_getting_db_func,
+                                                db_name, pool_size=num_workers)
+        if pass_db is None:
+            async_db._executor.shutdown(wait=False)
+            return None, None
+        async_db.pass_db = pass_db
+        return async_db, pass_dic
+
+    def __repr__(self):
+        return "AsyncPasswordDB(%r)" % self.pass_db
+
+    async def _run(self, func, *args, **kwargs):
+        """Run func on our thread pool and wait for it."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def get_list_of_nicks(self):
+        """Get list of all nicknames in password database."""
+        return await self._run(self.pass_db.get_list_of_nicks)
+
+    async def get_nicks_page(self, after=None, limit=1000, containing=None):
+        """Get up to limit nicknames, in order, starting after the given nickname
+        (only those containing containing, if it isn't None).
+        """
+        return await self._run(self.pass_db.get_nicks_page, after, limit, containing)
+
+    async def get_password_for_nick(self, nickname):
+        """Get password for a particular nick (raises IndexError if there isn't one)."""
+        return await self._run(self.pass_db.get_password_for_nick, nickname)
+
+    async def find_password(self, nickname):
+        """Get the Password for a particular nick, or None if there isn't one."""
+        return await self._run(self.pass_db.find_password, nickname)
+
+    async def count_passwords(self):
+        """Get the number of passwords in the password database."""
+        return await self._run(self.pass_db.count_passwords)
+
+    async def get_all_password_objects(self):
+        """Get all passwords in password database."""
+        return await self._run(self.pass_db.get_all_password_objects)
+
+    async def iter_password_objects(self, batch_size=1000):
+        """Yield all passwords in nickname order, fetching batch_size rows at a time.
+        Each batch is a separate query, so no connection is held between batches.
+        """
+        batch = await self._run(self.pass_db.get_passwords_page, None, batch_size)
+        while batch:
+            for pw_obj in batch:
+                yield pw_obj
+            if len(batch) < batch_size:
+                return
+            batch = await self._run(self.pass_db.get_passwords_page, batch[-1].nickname, batch_size)
+
+    async def create_new_password(self, pw_obj):
+        """Create a new password in the password database."""
+        await self._run(self.pass_db.create_new_password, pw_obj)
+
+    async def bulk_insert(self, pw_objs, chunk_size=1000):
+        """Insert many passwords in a single transaction; see PasswordDB.bulk_insert."""
+        return await self._run(self.pass_db.bulk_insert, pw_objs, chunk_size)
+
+    async def update_old_password(self, orig_nick, pw_obj):
+        """Update an existing password in place; returns False if there's no password orig_nick."""
+        return await self._run(self.pass_db.update_old_password, orig_nick, pw_obj)
+
+    async def delete_password(self, nickname_or_pw_obj):
+        """Delete an existing password from the password database."""
+        await self._run(self.pass_db.delete_password, nickname_or_pw_obj)
+
+    async def close_db(self):
+        """Drop any calls that haven't started, wait for running ones, and close the database."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._executor.shutdown)
+        self.pass_db.close_db()
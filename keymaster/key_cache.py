@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""Cache of calculated passwords, for long-running processes (the Qt app
+and the agent) that calculate the same passwords again and again.
+
+Entries are keyed on the Password's fields and an HMAC of the proto-password
+under a random key that lives only in this process, so the cache never holds
+a proto-password.  Calculated passwords are kept in bytearrays, which wipe()
+overwrites with zeros; it's called at exit, and by the Qt app when its
+window is closed.  (Python can't promise to leave no
+copies of a string behind, but this leaves none of ours.)
+"""
+
+import atexit
+from collections import OrderedDict
+import hashlib
+import hmac
+import os
+import threading
+import time
+import weakref
+
+
+DEFAULT_MAX_ENTRIES = 256
+_CHR_ENCODING = "utf-8"
+_KEY_SIZE = 32
+
+_live_caches = weakref.WeakSet()    # wiped at exit (without keeping them alive until then)
+
+
+class DerivationCache:
+    """LRU cache of calculated passwords, each kept for at most ttl seconds."""
+    def __init__(self, ttl, max_entries=DEFAULT_MAX_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()   # key -> (expiry time, password bytearray), least recently used first
+        self._hmac_key = os.urandom(_KEY_SIZE)
+        self._lock = threading.Lock()
+        _live_caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def calculate_password(self, pw_obj, user_proto_pw):
+        """pw_obj.calculate_password(user_proto_pw), from the cache if we can."""
+        key = (pw_obj.fields(),
+               hmac.new(self._hmac_key, user_proto_pw.encode(_CHR_ENCODING), hashlib.sha256).digest())
+        now = self._clock()
+        with self._lock:
+            self._drop_expired(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[1].decode(_CHR_ENCODING)
+        password = pw_obj.calculate_password(user_proto_pw)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (now + self.ttl, bytearray(password.encode(_CHR_ENCODING)))
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+        return password
+
+    def expire(self):
+        """Wipe and drop the entries whose time is up (lookups do this too, but
+        call it every so often so that entries don't outlive their time while
+        nobody's looking things up).
+        """
+        with self._lock:
+            self._drop_expired(self._clock())
+
+    def wipe(self):
+        """Wipe and drop all entries, and change the HMAC key."""
+        with self._lock:
+            while self._entries:
+                self._drop(next(iter(self._entries)))
+            self._hmac_key = os.urandom(_KEY_SIZE)
+
+    def _drop_expired(self, now):
+        """Wipe and drop the entries whose time is up (call with the lock held)."""
+        for key in [key for key, (expiry, _) in self._entries.items() if expiry <= now]:
+            self._drop(key)
+
+    def _drop(self, key):
+        """Zero an entry's password and drop it (call with the lock held)."""
+        _, password = self._entries.pop(key)
+        password[:] = bytes(len(password))
+
+
+@atexit.register
+def _wipe_live_caches():
+    """Wipe every cache that's still around at exit."""
+    for cache in list(_live_caches):
+        cache.wipe()
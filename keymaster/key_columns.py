@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""Column-oriented, read-only copy of a password database, for databases
+too big to hold as one Python object per password.
+
+The numeric fields are kept in typed arrays.  Nicknames are kept in a list,
+and the other string fields as indexes into a pool of distinct strings:
+usernames, hostnames, hints and KDF names repeat a lot.  Password objects are only
+made when asked for, and filters compare whole columns at C speed.
+
+Example
+----
+columns = PasswordColumns.from_db(pass_db)
+rows = columns.find_rows(hostname="mail.example.com", base=64)
+nicks = [columns.nickname(row) for row in rows]
+"""
+
+from array import array
+from bisect import bisect_left
+from itertools import compress
+from itertools import repeat
+import operator
+
+from keymaster.key_password import FrozenPassword
+
+
+_LOAD_BATCH_SIZE = 10000
+
+
+class _StringPool:
+    """Each distinct string once, numbered in the order they were added."""
+    def __init__(self):
+        self._strings = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __getitem__(self, string_id):
+        return self._strings[string_id]
+
+    def add(self, string):
+        """Get the number of a string, adding it if it's new."""
+        string_id = self._ids.get(string)
+        if string_id is None:
+            string_id = self._ids[string] = len(self._strings)
+            self._strings.append(string)
+        return string_id
+
+    def find(self, string):
+        """Get the number of a string, or None if it isn't in the pool."""
+        return self._ids.get(string)
+
+
+class PasswordColumns:
+    """All the passwords in a PasswordDB, in nickname order, one column per field.
+    Rows are numbered from 0; columns[row] is a FrozenPassword for that row.
+    """
+    def __init__(self):
+        self._pool = _StringPool()
+        self._nicknames = []
+        self._usernames = array("I")
+        self._hostnames = array("I")
+        self._hints = array("I")
+        self._special_chars = array("b")
+        self._bases = array("b")
+        self._iterations = array("q")
+        self._starts = array("i")
+        self._finishes = array("i")
+        self._kdfs = array("I")
+        self._kdf_costs = array("q")
+
+    @classmethod
+    def from_db(cls, pass_db, batch_size=_LOAD_BATCH_SIZE):
+        """Load all of pass_db's passwords."""
+        columns = cls()
+        columns.extend(pass_db.iter_password_rows(batch_size))
+        return columns
+
+    def extend(self, rows):
+        """Append rows (tuples of the values of Password.FIELDS), which must
+        come after the rows we have in nickname order.
+        """
+        add_string = self._pool.add
+        for nickname, username, hostname, special_char, base, iteration, hint, start, finish, kdf, kdf_cost in rows:
+            self._nicknames.append(nickname)
+            self._usernames.append(add_string(username))
+            self._hostnames.append(add_string(hostname))
+            self._special_chars.append(special_char)
+            self._bases.append(base)
+            self._iterations.append(iteration)
+            self._hints.append(add_string(hint))
+            self._starts.append(start)
+            self._finishes.append(finish)
+            self._kdfs.append(add_string(kdf))
+            self._kdf_costs.append(kdf_cost)
+
+    def __len__(self):
+        return len(self._nicknames)
+
+    def __getitem__(self, row):
+        pool = self._pool
+        return FrozenPassword(self._nicknames[row], pool[self._usernames[row]], pool[self._hostnames[row]],
+                              self._special_chars[row], self._bases[row], self._iterations[row],
+                              pool[self._hints[row]], self._starts[row], self._finishes[row],
+                              pool[self._kdfs[row]], self._kdf_costs[row])
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def nickname(self, row):
+        """The nickname in a row (without making a Password)."""
+        return self._nicknames[row]
+
+    def find_row(self, nickname):
+        """The row for a nickname, or None if there isn't one."""
+        row = bisect_left(self._nicknames, nickname)
+        if row < len(self._nicknames) and self._nicknames[row] == nickname:
+            return row
+        return None
+
+    def get(self, nickname):
+        """The Password for a nickname, or None if there isn't one."""
+        row = self.find_row(nickname)
+        return None if row is None else self[row]
+
+    def find_rows(self, hostname=None, iteration=None, base=None):
+        """The rows, in order, that match all of the given fields."""
+        masks = []
+        if hostname is not None:
+            host_id = self._pool.find(hostname)
+            if host_id is None:
+                return []
+            masks.append(map(operator.eq, self._hostnames, repeat(host_id)))
+        if iteration is not None:
+            masks.append(map(operator.eq, self._iterations, repeat(iteration)))
+        if base is not None:
+            masks.append(map(operator.eq, self._bases, repeat(base)))
+        if not masks:
+            return list(range(len(self)))
+        mask = masks[0] if len(masks) == 1 else map(all, zip(*masks))
+        return list(compress(range(len(self)), mask))
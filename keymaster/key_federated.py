@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""Several password databases (shards) used as one, e.g. one per team.
+
+FederatedPasswordDB has the PasswordDB methods that the CLI, the Qt app and
+LazyPasswordDict use:
+
+- The shards are opened, and queried when a call needs all of them, in
+  parallel on a thread pool.  Each shard is a pooled PasswordDB (see its
+  pool_size), so any thread can use it; like any pooled PasswordDB this puts
+  the files in WAL mode.
+- A nickname routes by its namespace: "ops/db-admin" goes to the shard whose
+  file is called ops (ops.db, say) if there is one.  Other nicknames are
+  spread over all the shards by a hash of the nickname (see shard_index),
+  which is also how split_database divides a database; so open the shards of
+  a split database in order (as their names sort).
+- Lookups try the shard a nickname routes to, then all the others at once.
+  Listings are merged in nickname order.  A nickname should only be in one
+  shard, but if it's in several the copy in the shard it routes to wins.
+- New passwords go to the shard their nickname routes to; updates and deletes
+  go to the shard that has the password (an update that renames it moves it
+  if the new nickname routes elsewhere).  Each shard commits on its own, so a
+  bulk_insert or a move that fails part way can leave some shards changed.
+
+Example
+----
+fed_db = FederatedPasswordDB(["ops.db", "dev.db"], create_new_db=False)
+fed_db.find_password("ops/db-admin")    # looks in ops.db first
+paths = split_database(PasswordDB("big.db", False), 4)     # big-0-of-4.db ... big-3-of-4.db
+"""
+
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import heapq
+from itertools import groupby
+from itertools import islice
+import os
+from pathlib import Path
+import zlib
+
+from keymaster import key_metrics
+from keymaster.key_password import BasePassword
+from keymaster.key_password import LazyPasswordDict
+from keymaster.key_password import PasswordDB
+from keymaster.key_snapshot import snapshot_path_for
+
+
+NAMESPACE_SEP = "/"
+DEFAULT_POOL_SIZE = 4       # connections per shard
+_MAX_WORKERS = 32
+_SPLIT_CHUNK_SIZE = 10000
+_CHR_ENCODING = "utf-8"
+
+
+def shard_index(nickname, num_shards):
+    """Which of num_shards shards a nickname goes to if it has no namespace."""
+    return zlib.crc32(nickname.encode(_CHR_ENCODING)) % num_shards
+
+
+def namespace_for(db_name):
+    """A shard's namespace: its file name without the extension."""
+    return Path(str(db_name)).stem
+
+
+class FederatedPasswordDB:
+    """PasswordDB's methods over several databases (see the module docstring).
+    create_new_db is either a bool for all of them or a list with one per database.
+    """
+    @key_metrics.instrumented
+    def __init__(self, db_names, create_new_db, pool_size=DEFAULT_POOL_SIZE, num_workers=None):
+        self.db_names = [str(db_name) for db_name in db_names]
+        if not self.db_names:
+            raise ValueError("no databases to open")
+        if isinstance(create_new_db, bool):
+            create_new_db = [create_new_db] * len(self.db_names)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers or min(_MAX_WORKERS, len(self.db_names)),
+                                            thread_name_prefix="keymaster-shard")
+        futures = [self._executor.submit(PasswordDB, db_name, create, pool_size=pool_size)
+                   for db_name, create in zip(self.db_names, create_new_db)]
+        try:
+            self.shards = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                if not future.cancel() and future.exception() is None:
+                    future.result().close_db()
+            self._executor.shutdown()
+            raise
+        self._namespaces = {}
+        for pos, db_name in enumerate(self.db_names):
+            self._namespaces.setdefault(namespace_for(db_name), pos)
+
+    @staticmethod
+    @key_metrics.instrumented
+    def get_data(ask_to_create_new_func, _error_getting_db_func, db_names, pool_size=DEFAULT_POOL_SIZE):
+        """Like PasswordDB.get_data, asking once whether to create the databases that don't exist.
+        (Errors opening a database are raised, so the error callback isn't called.)
+        """
+        missing = [not os.path.exists(db_name) for db_name in db_names]
+        if any(missing):
+            if not ask_to_create_new_func():
+                return None, None
+            for db_name in (db_name for db_name, is_missing in zip(db_names, missing) if is_missing):
+                root = os.path.dirname(db_name)
+                if root and not os.path.exists(root):
+                    os.makedirs(root)
+        fed_db = FederatedPasswordDB(db_names, missing, pool_size)
+        return fed_db, LazyPasswordDict(fed_db)
+
+    def __repr__(self):
+        return "FederatedPasswordDB(%r)" % self.db_names
+
+    def _route(self, nickname):
+        """The position of the shard that a nickname goes to."""
+        namespace, sep, _ = nickname.partition(NAMESPACE_SEP)
+        if sep and namespace in self._namespaces:
+            return self._namespaces[namespace]
+        return shard_index(nickname, len(self.shards))
+
+    def _map(self, func, items):
+        """[func(item) for item in items], run in parallel."""
+        return list(self._executor.map(func, items))
+
+    def _find(self, nickname):
+        """Get (shard, Password) for a nickname, or (None, None) if no shard has it."""
+        routed = self.shards[self._route(nickname)]
+        pw_obj = routed.find_password(nickname)
+        if pw_obj is not None:
+            return routed, pw_obj
+        others = [shard for shard in self.shards if shard is not routed]
+        for shard, pw_obj in zip(others, self._map(lambda shard: shard.find_password(nickname), others)):
+            if pw_obj is not None:
+                return shard, pw_obj
+        return None, None
+
+    def _merged(self, get_page, nickname_of, after=None, page_size=1000):
+        """Yield the items from all the shards in nickname order, one per nickname.
+        get_page(shard, after, limit) gets a page of a shard's items; each
+        shard's next page is fetched (in parallel) while we go through this one.
+        Pages still being fetched when we're closed are cancelled or waited for,
+        so the shards can be closed as soon as we are.
+        """
+        pending = set()
+
+        def _fetch(pos, after):
+            future = self._executor.submit(get_page, self.shards[pos], after, page_size)
+            pending.add(future)
+            return future
+
+        def _paged(pos, future):
+            while future is not None:
+                page = future.result()
+                pending.discard(future)
+                future = _fetch(pos, nickname_of(page[-1])) if len(page) == page_size else None
+                for item in page:
+                    yield nickname_of(item), pos, item
+        try:
+            first_pages = [_fetch(pos, after) for pos in range(len(self.shards))]
+            merged = heapq.merge(*(_paged(pos, future) for pos, future in enumerate(first_pages)))
+            for nickname, group in groupby(merged, key=lambda entry: entry[0]):
+                entries = list(group)
+                if len(entries) > 1:    # in several shards: take the one it routes to
+                    routed = self._route(nickname)
+                    entries = [entry for entry in entries if entry[1] == routed] or entries
+                yield entries[0][2]
+        finally:
+            # Only wait for the fetches that are already running: a cancelled
+            # future (including one cancelled by close_db) never completes.
+            futures.wait([future for future in pending if not future.cancel()])
+
+    @key_metrics.instrumented
+    def get_list_of_nicks(self):
+        """Get list of all nicknames in all the databases."""
+        return list(self.iter_nicks())
+
+    @key_metrics.instrumented
+    def get_nicks_page(self, after=None, limit=1000, containing=None):
+        """Get up to limit nicknames, in order, starting after the given nickname
+        (only those containing containing, if it isn't None).
+        """
+        def get_page(shard, after, page_size):
+            return shard.get_nicks_page(after, page_size, containing)
+        with closing(self._merged(get_page, str, after, limit)) as nicks:
+            return list(islice(nicks, limit))
+
+    @key_metrics.instrumented
+    def get_passwords_page(self, after=None, limit=1000):
+        """Like get_nicks_page, but get the Passwords."""
+        with closing(self._merged(PasswordDB.get_passwords_page, _nickname_of, after, limit)) as pw_objs:
+            return list(islice(pw_objs, limit))
+
+    @key_metrics.instrumented
+    def get_password_for_nick(self, nickname):
+        """Get password for a particular nick (IndexError if there isn't one)."""
+        pw_obj = self.find_password(nickname)
+        if pw_obj is None:
+            raise IndexError(nickname)
+        return pw_obj
+
+    @key_metrics.instrumented
+    def find_password(self, nickname):
+        """Get the Password for a particular nick, or None if there isn't one."""
+        return self._find(nickname)[1]
+
+    @key_metrics.instrumented
+    def find_passwords(self, nicknames):
+        """Like find_password for many nicknames: get a dict of those in any database
+        and their Passwords.  Every database is asked for all of them (in parallel),
+        and as in find_password the database a nickname routes to wins.
+        """
+        nicknames = list(nicknames)
+        found = list(self._map(lambda shard: shard.find_passwords(nicknames), self.shards))
+        result = {}
+        for nickname in nicknames:
+            routed = found[self._route(nickname)]
+            pw_obj = routed.get(nickname) or next((other[nickname] for other in found if nickname in other), None)
+            if pw_obj is not None:
+                result[nickname] = pw_obj
+        return result
+
+    @key_metrics.instrumented
+    def count_passwords(self):
+        """Get the number of passwords in all the databases."""
+        return sum(self._map(PasswordDB.count_passwords, self.shards))
+
+    @key_metrics.instrumented
+    def iter_nicks(self, batch_size=1000):
+        """Yield all nicknames in order, fetching batch_size at a time from each database."""
+        yield from self._merged(PasswordDB.get_nicks_page, str, page_size=batch_size)
+
+    @key_metrics.instrumented
+    def get_all_password_objects(self):
+        """Get all passwords in all the databases."""
+        return {pw_obj.nickname: pw_obj for pw_obj in self.iter_password_objects()}
+
+    @key_metrics.instrumented
+    def iter_password_objects(self, batch_size=1000):
+        """Yield all passwords in nickname order, fetching batch_size at a time from each database."""
+        yield from self._merged(PasswordDB.get_passwords_page, _nickname_of, page_size=batch_size)
+
+    @key_metrics.instrumented
+    def iter_password_rows(self, batch_size=1000, limit=None, offset=0, **filters):
+        """Like iter_password_objects, but yield tuples of the values of Password.FIELDS
+        (as for PasswordDB.iter_password_rows).
+        """
+        for pw_obj in self.query(batch_size, limit, offset, **filters):
+            yield pw_obj.fields()
+
+    @key_metrics.instrumented
+    def query(self, batch_size=1000, limit=None, offset=0, **filters):
+        """Yield the passwords that match the filters (see PasswordDB.query) in nickname
+        order; each database runs the query, a page at a time.
+        """
+        def get_page(shard, after, page_size):
+            return shard.get_passwords_page(after, page_size, **filters)
+        with closing(self._merged(get_page, _nickname_of, page_size=batch_size)) as pw_objs:
+            yield from islice(pw_objs, offset, None if limit is None else offset + limit)
+
+    @key_metrics.instrumented
+    def create_new_password(self, pw_obj):
+        """Create a new password in the database its nickname routes to."""
+        self.shards[self._route(pw_obj.nickname)].create_new_password(pw_obj)
+
+    @key_metrics.instrumented
+    def bulk_insert(self, pw_objs, chunk_size=1000):
+        """Insert many passwords, each in the database it routes to, in one
+        transaction per database (run in parallel).  All of pw_objs is read
+        before anything is inserted.  Returns the number of passwords inserted.
+        """
+        batches = [[] for _ in self.shards]
+        for pw_obj in pw_objs:
+            batches[self._route(pw_obj.nickname)].append(pw_obj)
+        return sum(self._map(lambda pos: self.shards[pos].bulk_insert(batches[pos], chunk_size),
+                             range(len(self.shards))))
+
+    @key_metrics.instrumented
+    def update_old_password(self, orig_nick, pw_obj):
+        """Update an existing password, moving it if it's renamed to a nickname
+        that routes to another database.  Returns False if there's no password orig_nick.
+        """
+        old_shard, _ = self._find(orig_nick)
+        if old_shard is None:
+            return False
+        new_shard = old_shard if pw_obj.nickname == orig_nick else self.shards[self._route(pw_obj.nickname)]
+        if new_shard is old_shard:
+            return old_shard.update_old_password(orig_nick, pw_obj)
+        new_shard.create_new_password(pw_obj)
+        old_shard.delete_password(orig_nick)
+        return True
+
+    @key_metrics.instrumented
+    def delete_password(self, nickname_or_pw_obj):
+        """Delete an existing password from the database that has it."""
+        if isinstance(nickname_or_pw_obj, BasePassword):
+            nickname = nickname_or_pw_obj.nickname
+        else:
+            nickname = nickname_or_pw_obj
+        shard, _ = self._find(nickname)
+        if shard is not None:
+            shard.delete_password(nickname)
+
+    @key_metrics.instrumented
+    def write_snapshot(self, path=None):
+        """Write a snapshot (see key_snapshot) next to each database.  Returns the number of passwords."""
+        if path is not None:
+            raise ValueError("each database gets its own snapshot: " + ", ".join(map(snapshot_path_for,
+                                                                                         self.db_names)))
+        return sum(self._map(PasswordDB.write_snapshot, self.shards))
+
+    @key_metrics.instrumented
+    def close_db(self):
+        """Close all the databases (after any work still queued for them is cancelled or done)."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for shard in self.shards:
+            shard.close_db()
+
+
+def _nickname_of(pw_obj):
+    """A Password's nickname."""
+    return pw_obj.nickname
+
+
+def split_database(pass_db, num_shards, out_dir=None, chunk_size=_SPLIT_CHUNK_SIZE):
+    """Copy a PasswordDB's passwords into num_shards new databases (by
+    shard_index, so a FederatedPasswordDB over them routes each nickname to
+    the one it's in) and return their paths, in order.  The shards are named
+    after the database (big.db: big-0-of-4.db, ...) and go next to it or in
+    out_dir.  The database itself isn't changed.
+    """
+    if num_shards < 1:
+        raise ValueError("the number of shards must be at least 1")
+    db_path = Path(str(pass_db.db_name))
+    out_dir = db_path.parent if out_dir is None else Path(out_dir)
+    width = len(str(num_shards - 1))
+    paths = [str(out_dir / ("%s-%0*d-of-%d%s" % (db_path.stem, width, pos, num_shards, db_path.suffix)))
+             for pos in range(num_shards)]
+    for path in paths:
+        if os.path.exists(path):
+            raise FileExistsError("%s already exists" % path)
+    shards = []
+    try:
+        shards = [PasswordDB(path, create_new_db=True) for path in paths]
+        batches = [[] for _ in paths]
+        for pw_obj in pass_db.iter_password_objects(chunk_size):
+            pos = shard_index(pw_obj.nickname, num_shards)
+            batches[pos].append(pw_obj)
+            if len(batches[pos]) >= chunk_size:
+                shards[pos].bulk_insert(batches[pos], chunk_size)
+                batches[pos] = []
+        for shard, batch in zip(shards, batches):
+            shard.bulk_insert(batch, chunk_size)
+    except BaseException:
+        for shard in shards:
+            shard.close_db()
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    for shard in shards:
+        shard.close_db()
+    return paths
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""Key-derivation functions for calculating passwords.
+
+Each Password names its KDF and a cost.  "sha512" (the original calculation,
+a single round, which ignores the cost) is the default, so existing passwords
+don't change.  The slower ones make guessing proto-passwords more expensive:
+
+- "pbkdf2-sha512": PBKDF2-HMAC-SHA512; the cost is the number of iterations.
+- "scrypt": scrypt with r=8 and p=1; the cost is log2(N).
+
+The salt is the Password's "username@hostname<iteration>", which is what
+sha512 has always appended to the proto-password, so each entry gets its own
+salt and the same inputs always give the same password.
+
+A name fixes everything about a KDF except its cost: changing anything else
+(the hash, r, p, the salt) would change existing passwords, so it needs a
+new name.  That makes the names the KDF versions.
+"""
+
+import hashlib
+import time
+
+
+DEFAULT_KDF = "sha512"
+DEFAULT_COSTS = {"sha512": 0, "pbkdf2-sha512": 210000, "scrypt": 14}
+KDF_NAMES = tuple(DEFAULT_COSTS)
+DEFAULT_TARGET_MS = 100
+
+_SCRYPT_R, _SCRYPT_P = 8, 1
+_DIGEST_SIZE = 64       # same as sha512's, so the encoded passwords are the same length
+_MIN_COSTS = {"sha512": 0, "pbkdf2-sha512": 1000, "scrypt": 10}
+_MAX_SCRYPT_COST = 19  # hashlib.scrypt's maxmem must be below 2**31, and cost 20 needs 2 GiB
+
+
+def derive(kdf, cost, proto_pw, salt):
+    """Derive the 64-byte digest that a password is calculated from."""
+    if kdf == "sha512":
+        return hashlib.sha512(proto_pw + salt).digest()
+    if kdf == "pbkdf2-sha512":
+        return hashlib.pbkdf2_hmac("sha512", proto_pw, salt, cost, _DIGEST_SIZE)
+    if kdf == "scrypt":
+        return hashlib.scrypt(proto_pw, salt=salt, n=1 << cost, r=_SCRYPT_R, p=_SCRYPT_P,
+                              maxmem=_scrypt_maxmem(cost), dklen=_DIGEST_SIZE)
+    raise ValueError("unknown KDF: %s" % kdf)
+
+
+def _scrypt_maxmem(cost):
+    """Memory limit to give hashlib.scrypt for this cost: twice what it needs, plus a little."""
+    return 2 * 128 * _SCRYPT_R * (1 << cost) + (1 << 20)
+
+
+def check_cost(kdf, cost):
+    """Raise ValueError if kdf isn't a KDF we know or cost is out of range for it."""
+    if kdf not in KDF_NAMES:
+        raise ValueError("unknown KDF: %s (use one of %s)" % (kdf, ", ".join(KDF_NAMES)))
+    if kdf != "sha512" and cost < _MIN_COSTS[kdf]:
+        raise ValueError("%s cost must be at least %d" % (kdf, _MIN_COSTS[kdf]))
+    if kdf == "scrypt" and cost > _MAX_SCRYPT_COST:
+        raise ValueError("scrypt cost must be at most %d" % _MAX_SCRYPT_COST)
+
+
+def time_derivation(kdf, cost):
+    """Seconds that one derivation takes on this machine."""
+    start_time = time.perf_counter()
+    derive(kdf, cost, b"calibration proto-password", b"user@host1")
+    return time.perf_counter() - start_time
+
+
+def calibrate(kdf, target_ms=DEFAULT_TARGET_MS):
+    """Pick the cost that makes one derivation take about target_ms on this
+    machine.  Returns (cost, measured ms at that cost).
+    """
+    check_cost(kdf, _MIN_COSTS.get(kdf, 0))
+    if kdf == "sha512":
+        return 0, time_derivation(kdf, 0) * 1000
+    if kdf == "pbkdf2-sha512":
+        # time is linear in the number of iterations, so estimate from a short
+        # run and then correct the estimate with a run at the estimated cost:
+        cost = _MIN_COSTS[kdf] * 10
+        for _ in range(2):
+            seconds = min(time_derivation(kdf, cost) for _ in range(3))
+            cost = max(_MIN_COSTS[kdf], int(cost * target_ms / 1000 / seconds))
+        return cost, time_derivation(kdf, cost) * 1000
+    # scrypt doubles in time with each step, so take the step closest to the target:
+    cost, seconds = _MIN_COSTS[kdf], time_derivation(kdf, _MIN_COSTS[kdf])
+    while cost < _MAX_SCRYPT_COST and seconds * 1000 < target_ms:
+        next_seconds = time_derivation(kdf, cost + 1)
+        if next_seconds * 1000 - target_ms > target_ms - seconds * 1000:
+            break
+        cost, seconds = cost + 1, next_seconds
+    return cost, seconds * 1000
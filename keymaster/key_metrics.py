@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""Counters, timings and trace spans for PasswordDB and password calculation.
+
+Everything is off until enable() is called, and while it's off an
+instrumented function costs one extra call and one flag check.
+
+Example
+----
+key_metrics.enable(trace_path="trace.jsonl")    # or just enable()
+...
+print(key_metrics.format_summary(key_metrics.snapshot()))
+
+Each instrumented call (see @instrumented) is a span: it's timed, its time
+is added to the timing with the same name (e.g. "PasswordDB.find_password"),
+and if there's a trace file it's written there as one JSON object per line:
+{"name": ..., "start": <epoch seconds>, "duration_ms": ..., "thread": ...,
+"parent": <name of the enclosing span or null>}.  Generators' spans are
+detached (see span), so they're never parents.
+Counters count things that aren't calls, such as SQL statements.
+"""
+
+import functools
+import inspect
+import json
+import random
+import threading
+import time
+
+
+_MAX_SAMPLES = 10000    # per timing, for percentiles; beyond this we keep a random sample
+
+
+class _State:
+    """Everything we've recorded, plus whether we're recording at all."""
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()  # .stack: this thread's open (non-detached) spans
+        self.counters = {}
+        self.timings = {}               # name -> [count, total ms, min ms, max ms, samples]
+        self.trace_file = None
+
+
+_STATE = _State()
+
+
+def enable(trace_path=None):
+    """Start recording (and writing spans to trace_path, if given)."""
+    with _STATE.lock:
+        if trace_path is not None and _STATE.trace_file is None:
+            _STATE.trace_file = open(trace_path, "a")
+        _STATE.enabled = True
+
+
+def disable():
+    """Stop recording and close the trace file (what's been recorded is kept until reset)."""
+    with _STATE.lock:
+        _STATE.enabled = False
+        if _STATE.trace_file is not None:
+            _STATE.trace_file.close()
+            _STATE.trace_file = None
+
+
+def is_enabled():
+    """Are we recording?"""
+    return _STATE.enabled
+
+
+def reset():
+    """Forget everything recorded so far."""
+    with _STATE.lock:
+        _STATE.counters, _STATE.timings = {}, {}
+
+
+def count(name, num=1):
+    """Add num to a counter."""
+    if _STATE.enabled:
+        with _STATE.lock:
+            _STATE.counters[name] = _STATE.counters.get(name, 0) + num
+
+
+def observe(name, duration_ms):
+    """Add a duration to a timing."""
+    if not _STATE.enabled:
+        return
+    with _STATE.lock:
+        timing = _STATE.timings.get(name)
+        if timing is None:
+            timing = _STATE.timings[name] = [0, 0.0, duration_ms, duration_ms, []]
+        timing[0] += 1
+        timing[1] += duration_ms
+        timing[2] = min(timing[2], duration_ms)
+        timing[3] = max(timing[3], duration_ms)
+        samples = timing[4]
+        if len(samples) < _MAX_SAMPLES:
+            samples.append(duration_ms)
+        else:   # reservoir sampling
+            pos = random.randrange(timing[0])
+            if pos < _MAX_SAMPLES:
+                samples[pos] = duration_ms
+
+
+class span:     # pylint: disable=invalid-name
+    """Context manager that times a block as a span called name (if we're recording).
+    Its parent is the innermost span open in this thread when it starts.  A
+    detached span isn't anyone's parent: it's for spans that can be suspended,
+    like a generator's, which would otherwise become the parent of whatever
+    happens to run while they're suspended.
+    """
+    def __init__(self, name, detached=False):
+        self.name = name
+        self.detached = detached
+        self._start, self._stack, self._parent, self._thread = None, None, None, None
+
+    def __enter__(self):
+        if _STATE.enabled:
+            stack = getattr(_STATE.local, "stack", None)
+            if stack is None:
+                stack = _STATE.local.stack = []
+            self._parent = stack[-1].name if stack else None
+            self._thread = threading.current_thread().name
+            if not self.detached:
+                stack.append(self)
+                self._stack = stack
+            self._start = (time.time(), time.perf_counter())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._start is None:
+            return
+        duration_ms = (time.perf_counter() - self._start[1]) * 1000
+        if self._stack is not None:     # take ourselves off the stack we went on, wherever we are in it
+            for pos in range(len(self._stack) - 1, -1, -1):
+                if self._stack[pos] is self:
+                    del self._stack[pos]
+                    break
+        observe(self.name, duration_ms)
+        if _STATE.trace_file is not None:
+            line = json.dumps({"name": self.name, "start": self._start[0], "duration_ms": duration_ms,
+                               "thread": self._thread, "parent": self._parent})
+            with _STATE.lock:
+                if _STATE.trace_file is not None:
+                    _STATE.trace_file.write(line + "\n")
+
+
+def instrumented(func):
+    """Decorator: make each call of func a span named after it (e.g. "PasswordDB.find_password").
+    For generator functions the span covers the whole iteration, and is detached.
+    """
+    name = func.__qualname__
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def _iter_wrapper(*args, **kwargs):
+            if not _STATE.enabled:
+                return (yield from func(*args, **kwargs))
+            with span(name, detached=True):
+                return (yield from func(*args, **kwargs))
+        return _iter_wrapper
+    @functools.wraps(func)
+    def _wrapper(*args, **kwargs):
+        if not _STATE.enabled:
+            return func(*args, **kwargs)
+        with span(name):
+            return func(*args, **kwargs)
+    return _wrapper
+
+
+def snapshot():
+    """Everything recorded so far: {"counters": {name: count}, "timings": {name: {"count": ...,
+    "total_ms": ..., "mean_ms": ..., "min_ms": ..., "p50_ms": ..., "p95_ms": ..., "max_ms": ...}}}.
+    """
+    with _STATE.lock:
+        timings = {}
+        for name, (num, total_ms, min_ms, max_ms, samples) in _STATE.timings.items():
+            samples = sorted(samples)
+            timings[name] = {"count": num, "total_ms": total_ms, "mean_ms": total_ms / num,
+                             "min_ms": min_ms, "p50_ms": samples[len(samples) // 2],
+                             "p95_ms": samples[min(len(samples) - 1, len(samples) * 95 // 100)], "max_ms": max_ms}
+        return {"counters": dict(_STATE.counters), "timings": timings}
+
+
+def format_summary(stats):
+    """A snapshot as a table, slowest timings (by total) first."""
+    lines = ["%-36s %8s %10s %9s %9s %9s" % ("timing", "calls", "total ms", "mean ms", "p95 ms", "max ms")]
+    for name, timing in sorted(stats["timings"].items(), key=lambda item: -item[1]["total_ms"]):
+        lines.append("%-36s %8d %10.2f %9.3f %9.3f %9.3f" % (name, timing["count"], timing["total_ms"],
+                                                             timing["mean_ms"], timing["p95_ms"], timing["max_ms"]))
+    for name, num in sorted(stats["counters"].items()):
+        lines.append("%-36s %8d" % (name, num))
+    return "\n".join(lines)
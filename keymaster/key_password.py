@@ -4,16 +4,32 @@
 """
 
 import base64
+from collections.abc import ItemsView
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from hashlib import sha512
+from itertools import islice
 import os
 from pathlib import Path
+import queue
 import sqlite3
+import sys
+import threading
 from xdg import XDG_CONFIG_HOME
 
+from keymaster import key_kdf
+from keymaster import key_metrics
+from keymaster import key_snapshot
+
 
 DEFAULT_DB_PATH = Path(XDG_CONFIG_HOME, "keymaster", ".passwords.db")
 
-_DROP_PASSWORDS_TABLE_SCHEMA = """drop table if exists passwords;"""
+_DROP_PASSWORDS_TABLE_SCHEMA = """
+drop table if exists passwords;
+drop table if exists sync_state;
+drop table if exists row_versions;
+drop table if exists sync_peers;
+"""
 _CREATE_PASSWORDS_TABLE_SCHEMA = """
 create table passwords
 (
@@ -29,65 +45,337 @@ create table passwords
 );
 """
 
-_SQL_INS_PASS = "insert into passwords values(?,?,?,?,?,?,?,?,?);"
+# Schema migrations: _MIGRATIONS[i] takes the passwords table from version i
+# (as recorded in "pragma user_version") to version i+1.  New databases are
+# created at version 0 and migrated like any other.
+_MIGRATIONS = [
+    # 1: nickname becomes the (unique) key; index hostname and username.  Older
+    #    databases could have duplicate nicknames: the newest row keeps the
+    #    nickname and the others are renamed "nick (2)", "nick (3)", ..., newest
+    #    first, so that no stored password is lost.  (If a new name is taken
+    #    too, the migration fails and the database is left as it was.)
+    """
+    alter table passwords rename to passwords_v0;
+    create table passwords
+    (
+        nickname text primary key,
+        username text,
+        hostname text,
+        special_char boolean,
+        base integer,
+        iteration integer,
+        hint text,
+        start integer,
+        finish integer
+    );
+    insert into passwords
+        select case copy when 1 then nickname else nickname || ' (' || copy || ')' end,
+               username, hostname, special_char, base, iteration, hint, start, finish
+        from (select *, row_number() over (partition by nickname order by rowid desc) as copy
+              from passwords_v0);
+    drop table passwords_v0;
+    create index passwords_hostname on passwords(hostname);
+    create index passwords_username on passwords(username);
+    """,
+    # 2: per-password key-derivation function and cost (see key_kdf); existing
+    #    passwords keep the original sha512 calculation.
+    """
+    alter table passwords add column kdf text not null default 'sha512';
+    alter table passwords add column kdf_cost integer not null default 0;
+    """,
+    # 3: change log for syncing replicas (see key_sync).  Triggers stamp every
+    #    change with a Lamport clock, this replica's id and a local sequence
+    #    number; deletes (and the old nickname of a rename) leave tombstones.
+    #    Existing passwords, and each bulk insert, are stamped as one change.
+    """
+    create table sync_state
+    (
+        id integer primary key check (id = 0),
+        replica_id text not null,
+        clock integer not null,         -- Lamport clock
+        seq integer not null,           -- number of the last change recorded here
+        stamps_paused integer not null  -- 1 while we stamp changes ourselves (bulk inserts, syncs)
+    );
+    insert into sync_state values (0, lower(hex(randomblob(16))), 1, 1, 0);
+    create table row_versions
+    (
+        nickname text primary key,
+        version integer not null,       -- clock of the last change
+        origin text not null,           -- replica that made it
+        seq integer not null,           -- when it was recorded here
+        deleted integer not null        -- 1 for a tombstone
+    );
+    create index row_versions_seq on row_versions(seq);
+    insert into row_versions select nickname, 1, (select replica_id from sync_state), 1, 0 from passwords;
+    create table sync_peers
+    (
+        peer text primary key,          -- a replica id, or a file in a sync directory
+        received integer not null,      -- how far we've applied their changes (their seq, or a file offset)
+        sent integer not null           -- how far we've written ours to a sync directory (our seq)
+    );
+    create trigger passwords_inserted after insert on passwords
+    when (select stamps_paused from sync_state) = 0
+    begin
+        update sync_state set clock = clock + 1, seq = seq + 1;
+        insert or replace into row_versions select new.nickname, clock, replica_id, seq, 0 from sync_state;
+    end;
+    create trigger passwords_updated after update on passwords
+    when (select stamps_paused from sync_state) = 0
+    begin
+        update sync_state set clock = clock + 1, seq = seq + 1;
+        insert or replace into row_versions select old.nickname, clock, replica_id, seq, 1 from sync_state
+            where old.nickname != new.nickname;
+        insert or replace into row_versions select new.nickname, clock, replica_id, seq, 0 from sync_state;
+    end;
+    create trigger passwords_deleted after delete on passwords
+    when (select stamps_paused from sync_state) = 0
+    begin
+        update sync_state set clock = clock + 1, seq = seq + 1;
+        insert or replace into row_versions select old.nickname, clock, replica_id, seq, 1 from sync_state;
+    end;
+    """,
+    # 4: indexes for the query filters (see PasswordDB.query).  The hostname and
+    #    username ones end with nickname, so their matches come out in order
+    #    without a sort.  base and special_char have too few values to be worth one.
+    """
+    drop index passwords_hostname;
+    drop index passwords_username;
+    create index passwords_hostname on passwords(hostname, nickname);
+    create index passwords_username on passwords(username, nickname);
+    create index passwords_iteration on passwords(iteration);
+    """,
+]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+_SQL_GET_DATA_VERSION = "pragma data_version;"
+_SQL_SET_WAL_MODE = "pragma journal_mode = wal;"
+_SQL_GET_SCHEMA_VERSION = "pragma user_version;"
+_SQL_SET_SCHEMA_VERSION = "pragma user_version = {};"
+_SQL_INS_PASS = "insert into passwords values(?,?,?,?,?,?,?,?,?,?,?);"
 _SQL_GET_NICK = "select nickname from passwords;"
+_SQL_GET_NICK_ORDERED = "select nickname from passwords order by nickname;"
+_SQL_GET_NICK_PAGE = "select nickname from passwords order by nickname limit ?;"
+_SQL_GET_NICK_PAGE_AFTER = "select nickname from passwords where nickname > ? order by nickname limit ?;"
+# Case-insensitive (for ASCII) substring match; the caller lower-cases the text:
+_SQL_GET_NICK_PAGE_CONTAINING = """select nickname from passwords
+    where instr(lower(nickname), ?) > 0 and nickname > ? order by nickname limit ?;"""
+_SQL_COUNT_PASS = "select count(*) from passwords;"
 _SQL_GET_PASS_BY_NICK = "select * from passwords where nickname = ?;"
+_SQL_GET_PASS_BY_NICKS = "select * from passwords where nickname in ({});"
 _SQL_GET_PASS = "select * from passwords;"
+_SQL_GET_PASS_ORDERED = "select * from passwords order by nickname;"
+_SQL_GET_PASS_PAGE = "select * from passwords order by nickname limit ?;"
+_SQL_GET_PASS_PAGE_AFTER = "select * from passwords where nickname > ? order by nickname limit ?;"
+_SQL_QUERY_PASS = "select * from passwords{} order by {} limit ? offset ?;"     # see _compile_filters
+_SQL_UPD_PASS = """update passwords set nickname = ?, username = ?, hostname = ?, special_char = ?, base = ?,
+                   iteration = ?, hint = ?, start = ?, finish = ?, kdf = ?, kdf_cost = ? where nickname = ?;"""
 _SQL_DEL_PASS = "delete from passwords where nickname = ?;"
+_SQL_UPSERT_PASS = "insert or replace into passwords values(?,?,?,?,?,?,?,?,?,?,?);"
+_SQL_GET_SYNC_STATE = "select replica_id, seq from sync_state;"
+_SQL_NEW_REPLICA_ID = "update sync_state set replica_id = lower(hex(randomblob(16)));"
+_SQL_PAUSE_STAMPS = "update sync_state set stamps_paused = ?;"
+_SQL_UPDATE_CLOCK = "update sync_state set clock = max(clock, ?);"
+_SQL_GET_CHANGES = """select v.seq, v.nickname, v.version, v.origin, v.deleted, p.*
+    from row_versions v left join passwords p on p.nickname = v.nickname where v.seq > ? order by v.seq;"""
+_SQL_GET_ROW_VERSION = "select version, origin from row_versions where nickname = ?;"
+_SQL_NEXT_SEQ = "update sync_state set seq = seq + 1;"
+_SQL_NEXT_CHANGE = "update sync_state set clock = clock + 1, seq = seq + 1;"
+_SQL_GET_MAX_ROWID = "select coalesce(max(rowid), 0) from passwords;"
+_SQL_STAMP_NEW_ROWS = """insert or replace into row_versions
+    select nickname, clock, replica_id, seq, 0 from passwords, sync_state where passwords.rowid > ?;"""
+_SQL_SET_ROW_VERSION = "insert or replace into row_versions select ?, ?, ?, seq, ? from sync_state;"
+_SQL_GET_SYNC_POSITION = "select received, sent from sync_peers where peer = ?;"
+_SQL_SET_RECEIVED = """insert into sync_peers values(?, ?, 0)
+    on conflict(peer) do update set received = excluded.received;"""
+_SQL_SET_SENT = """insert into sync_peers values(?, 0, ?)
+    on conflict(peer) do update set sent = excluded.sent;"""
+
+# The filters for PasswordDB.query: name -> (condition, conversion of the value).
+# Migration 4 indexes the columns they're useful on.
+_QUERY_FILTERS = {
+    "host": ("hostname = ?", str),
+    "user": ("username = ?", str),
+    "base": ("base = ?", int),
+    "special": ("special_char = ?", bool),
+    "iteration_gt": ("iteration > ?", int),
+}
+# Without range statistics SQLite would rather scan the table in nickname order
+# than use an index for these and sort, even when (as usual) they match a few rows;
+# ordering by +nickname (which can't use the nickname index) lets it use theirs.
+_RANGE_FILTERS = {"iteration_gt"}
+
+_BUSY_TIMEOUT = 5.0     # seconds to wait for another connection's lock before giving up
 
 _DB_DOES_NOT_EXIST = "DB file {} does not exist but you asked me not to create it"
 
 _CHR_ENCODING = "utf-8"
+_ENCODERS = {32: base64.b32encode, 64: base64.b64encode}
+_DIGEST_SIZE = 64       # of sha512, and of every KDF (see key_kdf)
 
 # public for tests
-REPR = "Password({nickname}, {username}, {hostname}, {special_char}, {base}, {iteration}, {hint}, {start}, {finish})"
+REPR = ("Password({nickname}, {username}, {hostname}, {special_char}, {base}, {iteration}, {hint}, {start}, {finish}, "
+        "{kdf}, {kdf_cost})")
+
+
+def _b32_window(start, finish):
+    """Characters start to finish of a base 32 encoded digest come from whole
+    5-byte groups of it (8 characters each).  Returns (first byte, end byte,
+    first character, end character): those groups, and where the characters
+    are in their encoding.  None if the characters aren't all in whole groups
+    (e.g. they reach the padded end), so the whole digest has to be encoded.
+    """
+    end = finish + 1
+    if not 0 <= start < end <= _DIGEST_SIZE // 5 * 8:
+        return None
+    first_group, end_group = start // 8, (end + 7) // 8
+    return first_group * 5, end_group * 5, start - first_group * 8, end - first_group * 8
 
 
-class Password:
-    """Keep all info about a single password together."""
+class BasePassword:
+    """What Password and FrozenPassword have in common: the fields, equality
+    (a Password and a FrozenPassword with the same fields are equal) and the
+    password calculation.
+    """
+    __slots__ = ()
     translator = str.maketrans("acers", "@(*^$")
+    FIELDS = ("nickname", "username", "hostname", "special_char", "base", "iteration", "hint", "start", "finish",
+              "kdf", "kdf_cost")
 
-    def __init__(self, nickname="", username="", hostname="", special_char=False,
-                 base=32, iteration=1, hint="", start=0, finish=15):
-        self.nickname = str(nickname)
-        self.username = str(username)
-        self.hostname = str(hostname)
-        self.special_char = special_char
-        self.base = base
-        self.iteration = iteration
-        self.hint = str(hint)
-        self.start = start
-        self.finish = finish
+    def fields(self):
+        """The field values, in FIELDS order."""
+        return (self.nickname, self.username, self.hostname, self.special_char, self.base,
+                self.iteration, self.hint, self.start, self.finish, self.kdf, self.kdf_cost)
 
     def __eq__(self, other):
-        if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+        if isinstance(other, BasePassword):
+            return self.fields() == other.fields()
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __repr__(self):
-        return REPR.format(**self.__dict__)
+        return REPR.format(**dict(zip(self.FIELDS, self.fields())))
 
+    @key_metrics.instrumented
     def calculate_password(self, user_proto_pw):
         """Do the actual password calculation."""
-        # add username @ hostname iteration, and then hash:
-        proto_pw = user_proto_pw + self.username + '@' + self.hostname + str(self.iteration)
-        if self.base == 32:
-            encode_fn = base64.b32encode
-        if self.base == 64:
-            encode_fn = base64.b64encode
-        password_str = encode_fn(sha512(str(proto_pw).encode(_CHR_ENCODING)).digest())
-        password_str = password_str[self.start:self.finish+1].lower()
+        # hash (or otherwise derive from) the proto-password with username @ hostname iteration:
+        return self._finish_password(key_kdf.derive(self.kdf, self.kdf_cost, str(user_proto_pw).encode(_CHR_ENCODING),
+                                                    self._salt()))
+
+    @staticmethod
+    @key_metrics.instrumented
+    def calculate_passwords(user_proto_pw, pw_objs):
+        """Calculate the passwords for many Password objects and one proto-password;
+        this returns the same list as calling calculate_password on each, faster.
+        The proto-password is encoded (and for the sha512 KDF, hashed) once, and
+        the hash state copied for each Password.  For base 32, only the part of
+        the digest that the password's characters come from is encoded (see
+        _b32_window, worked out once per start and finish in the batch).
+        """
+        proto_pw = str(user_proto_pw).encode(_CHR_ENCODING)
+        proto_hash = sha512(proto_pw)
+        windows = {}
+        passwords = []
+        for pw_obj in pw_objs:
+            if pw_obj.kdf == key_kdf.DEFAULT_KDF:
+                pw_hash = proto_hash.copy()
+                pw_hash.update(pw_obj._salt())
+                digest = pw_hash.digest()
+            else:
+                digest = key_kdf.derive(pw_obj.kdf, pw_obj.kdf_cost, proto_pw, pw_obj._salt())
+            window = None
+            if pw_obj.base == 32:
+                window_key = (pw_obj.start, pw_obj.finish)
+                if window_key not in windows:
+                    windows[window_key] = _b32_window(pw_obj.start, pw_obj.finish)
+                window = windows[window_key]
+            if window is None:
+                passwords.append(pw_obj._finish_password(digest))
+            else:
+                first_byte, end_byte, first_char, end_char = window
+                encoded = base64.b32encode(digest[first_byte:end_byte])[first_char:end_char]
+                passwords.append(pw_obj._finish_encoded(encoded))
+        return passwords
+
+    def _salt(self):
+        """What's appended to the proto-password (or used as the salt)."""
+        return (self.username + '@' + self.hostname + str(self.iteration)).encode(_CHR_ENCODING)
+
+    def _finish_password(self, digest):
+        """Turn a hash digest into the final password string."""
+        return self._finish_encoded(_ENCODERS[self.base](digest)[self.start:self.finish+1])
+
+    def _finish_encoded(self, encoded):
+        """Turn the characters (start to finish) of the encoded digest into the final password string."""
+        password_str = encoded.lower()
         password_str = password_str.decode(_CHR_ENCODING)
         # change a few letters:
         password_str = password_str.replace('b', 'B', 1).replace('d', 'D', 1).replace('z', 'Z', 1)
         if self.special_char:
-            password_str = password_str.translate(Password.translator)
+            password_str = password_str.translate(BasePassword.translator)
         return password_str
 
 
+class Password(BasePassword):
+    """Keep all info about a single password together.
+    A kdf_cost of None means the default cost for the KDF."""
+    def __init__(self, nickname="", username="", hostname="", special_char=False,
+                 base=32, iteration=1, hint="", start=0, finish=15, kdf=key_kdf.DEFAULT_KDF, kdf_cost=None):
+        self.nickname = str(nickname)
+        self.username = str(username)
+        self.hostname = str(hostname)
+        self.special_char = special_char
+        self.base = base
+        self.iteration = iteration
+        self.hint = str(hint)
+        self.start = start
+        self.finish = finish
+        self.kdf = str(kdf)
+        self.kdf_cost = key_kdf.DEFAULT_COSTS.get(self.kdf, 0) if kdf_cost is None else kdf_cost
+
+    __hash__ = None     # mutable
+
+
+class FrozenPassword(BasePassword):
+    """Immutable, hashable Password for holding lots of passwords in memory.
+    It has no per-instance __dict__, and it shares one copy of each distinct
+    username, hostname and hint (which repeat a lot) instead of keeping a copy
+    per password.  Its hash is its nickname's, which str computes only once.
+    Compares equal to a Password with the same fields.
+    """
+    __slots__ = BasePassword.FIELDS
+
+    def __init__(self, nickname="", username="", hostname="", special_char=False,
+                 base=32, iteration=1, hint="", start=0, finish=15, kdf=key_kdf.DEFAULT_KDF, kdf_cost=None):
+        kdf = sys.intern(str(kdf))
+        kdf_cost = key_kdf.DEFAULT_COSTS.get(kdf, 0) if kdf_cost is None else kdf_cost
+        values = (str(nickname), sys.intern(str(username)), sys.intern(str(hostname)), special_char,
+                  base, iteration, sys.intern(str(hint)), start, finish, kdf, kdf_cost)
+        for field, value in zip(self.FIELDS, values):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenPassword is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("FrozenPassword is immutable")
+
+    def __hash__(self):
+        return hash(self.nickname)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, BasePassword) and self.nickname != other.nickname:
+            return False
+        return BasePassword.__eq__(self, other)
+
+    def __reduce__(self):
+        return (FrozenPassword, self.fields())
+
+
 class PasswordDB:
     """Encapsulate all our CRUD operations."""
 
@@ -98,87 +386,605 @@ class PasswordDB:
     #     only be catastrophic and would be meaningless to users.
     # Note: if the file exists but doesn't contain the required
     #     database we get an error.
-    def __init__(self, db_name, create_new_db):
+    @key_metrics.instrumented
+    def __init__(self, db_name, create_new_db, pool_size=None, timeout=_BUSY_TIMEOUT):
         self.db_name = db_name
-        self.conn = sqlite3.connect(str(self.db_name))  # note: this creates the file if it doesn't exist
+        self._pool = None
+        if pool_size is None:
+            # note: this creates the file if it doesn't exist
+            self.conn = _trace_statements(sqlite3.connect(str(self.db_name), timeout=timeout))
+        else:
+            self._pool = _ConnectionPool(db_name, pool_size, timeout)
+            self.conn = self._pool.connect()    # keeps an in-memory db alive while the pool's connections come and go
         self.cur = self.conn.cursor()
         if create_new_db:
-            self.cur.execute(_DROP_PASSWORDS_TABLE_SCHEMA)
+            self.cur.executescript(_DROP_PASSWORDS_TABLE_SCHEMA)
             self.cur.execute(_CREATE_PASSWORDS_TABLE_SCHEMA)
+            self.cur.execute(_SQL_SET_SCHEMA_VERSION.format(0))
             self.conn.commit()
+        self._migrate()
+        self._snapshot = self._open_snapshot()
 
     @staticmethod
-    def get_data(ask_to_create_new_func, error_getting_db_func, db_name=DEFAULT_DB_PATH):
-        """Open the database and get passwords dictionary."""
+    @key_metrics.instrumented
+    def get_data(ask_to_create_new_func, error_getting_db_func, db_name=DEFAULT_DB_PATH, pool_size=None):
+        """Open the database and get a (lazily-loaded) passwords dictionary."""
         # Try to open the database:
         root = os.path.dirname(db_name)
         if os.path.exists(db_name):
-            pass_db = PasswordDB(db_name, create_new_db=False)
+            pass_db = PasswordDB(db_name, create_new_db=False, pool_size=pool_size)
         else:
             create_new_db = ask_to_create_new_func()
             if create_new_db:
                 if not os.path.exists(root):
                     os.makedirs(root)
-                pass_db = PasswordDB(db_name, create_new_db=True)
+                pass_db = PasswordDB(db_name, create_new_db=True, pool_size=pool_size)
             else:
                 return None, None
         if pass_db is None:
             error_getting_db_func()
             return None, None
-        passwords_dic = pass_db.get_all_password_objects()
-        return pass_db, passwords_dic
+        return pass_db, LazyPasswordDict(pass_db)
 
     def __repr__(self):
         return 'PasswordDB("%s")' % self.db_name
 
+    @contextmanager
+    def _cursor(self, new_cursor=False):
+        """Get a cursor: our one shared cursor (or a new one on our connection),
+        or in pooled mode a new cursor on this thread's connection from the pool.
+        """
+        if self._pool is None:
+            yield self.conn.cursor() if new_cursor else self.cur
+        else:
+            with self._pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    yield cur
+                finally:
+                    cur.close()     # an unfinished statement would keep its read transaction open
+
+    @key_metrics.instrumented
+    def get_schema_version(self):
+        """Get the schema version recorded in the database."""
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_SCHEMA_VERSION)
+            return cur.fetchone()[0]
+
+    @key_metrics.instrumented
+    def get_data_version(self):
+        """Get a number that changes whenever another connection commits changes to the database.
+        (In pooled mode each connection has its own numbering, so this isn't useful there.)
+        """
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_DATA_VERSION)
+            return cur.fetchone()[0]
+
+    def _migrate(self):
+        """Bring an older database up to SCHEMA_VERSION, one migration (and transaction) at a time.
+        (This uses our own connection, so that pooled connections never see the old schema.)
+        """
+        self.cur.execute(_SQL_GET_SCHEMA_VERSION)
+        for version in range(self.cur.fetchone()[0], SCHEMA_VERSION):
+            try:
+                self.cur.executescript("begin;" + _MIGRATIONS[version]
+                                       + _SQL_SET_SCHEMA_VERSION.format(version + 1) + "commit;")
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+    @key_metrics.instrumented
     def get_list_of_nicks(self):
         """Get list of all nicknames in password database."""
-        self.cur.execute(_SQL_GET_NICK)
-        return sorted([pw[0] for pw in self.cur.fetchall()])
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_NICK)
+            return sorted([pw[0] for pw in cur.fetchall()])
+
+    @key_metrics.instrumented
+    def get_nicks_page(self, after=None, limit=1000, containing=None):
+        """Get up to limit nicknames, in order, starting after the given nickname
+        (or from the beginning if after is None).  If containing isn't None, get
+        only the nicknames that contain it (ignoring the case of ASCII letters).
+        """
+        with self._cursor() as cur:
+            if containing is not None:
+                cur.execute(_SQL_GET_NICK_PAGE_CONTAINING, (containing.lower(), after or "", limit))
+            elif after is None:
+                cur.execute(_SQL_GET_NICK_PAGE, (limit,))
+            else:
+                cur.execute(_SQL_GET_NICK_PAGE_AFTER, (after, limit))
+            return [row[0] for row in cur.fetchall()]
+
+    @key_metrics.instrumented
+    def get_passwords_page(self, after=None, limit=1000, **filters):
+        """Like get_nicks_page, but get the Passwords (those that match the filters, as for query)."""
+        with self._cursor() as cur:
+            if filters:
+                where, order_by, params = _compile_filters(filters, after)
+                cur.execute(_SQL_QUERY_PASS.format(where, order_by), params + [limit, 0])
+            elif after is None:
+                cur.execute(_SQL_GET_PASS_PAGE, (limit,))
+            else:
+                cur.execute(_SQL_GET_PASS_PAGE_AFTER, (after, limit))
+            return [FrozenPassword(*row) for row in cur.fetchall()]
+
+    def _open_snapshot(self):
+        """Map the snapshot next to our database (see key_snapshot), if there is one."""
+        snapshot_path = key_snapshot.snapshot_path_for(self.db_name)
+        if str(self.db_name) == ":memory:" or not os.path.exists(snapshot_path):
+            return None
+        try:
+            return key_snapshot.Snapshot(snapshot_path)
+        except (OSError, ValueError):
+            return None
+
+    def _fresh_snapshot(self):
+        """Get our snapshot if it's up to date with the database, else None.
+        (We only look for a snapshot when we open the database, but pick up
+        new ones written over it after that.)
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        if not snapshot.is_fresh(self.db_name):
+            if not snapshot.is_replaced():
+                key_metrics.count("snapshot.stale")
+                return None
+            # other threads may still be reading the old one, so leave unmapping it to the gc:
+            snapshot = self._snapshot = self._open_snapshot()
+            if snapshot is None or not snapshot.is_fresh(self.db_name):
+                key_metrics.count("snapshot.stale")
+                return None
+        key_metrics.count("snapshot.hits")
+        return snapshot
+
+    @key_metrics.instrumented
+    def write_snapshot(self, path=None):
+        """Write a snapshot of the passwords (see key_snapshot) to path, by
+        default next to the database, where we'll use it for lookups for as
+        long as the database doesn't change.  Returns the number of passwords.
+        """
+        if str(self.db_name) == ":memory:":
+            raise ValueError("can't snapshot an in-memory database")
+        default_path = key_snapshot.snapshot_path_for(self.db_name)
+        state = key_snapshot.db_state(self.db_name)    # before reading, so changes while we read make it stale
+        count = key_snapshot.write_snapshot(self.iter_password_rows(), path or default_path, state)
+        if path is None or os.path.abspath(path) == os.path.abspath(default_path):
+            self._snapshot = self._open_snapshot()
+        return count
 
+    @key_metrics.instrumented
     def get_password_for_nick(self, nickname):
         """Get password for a particular nick."""
-        self.cur.execute(_SQL_GET_PASS_BY_NICK, (nickname,))    # nickname could be untrusted user input
-        return Password(*(self.cur.fetchall()[0]))
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            fields = snapshot.find(nickname)
+            if fields is None:
+                raise IndexError(nickname)
+            return Password(*fields)
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_PASS_BY_NICK, (nickname,))     # nickname could be untrusted user input
+            return Password(*(cur.fetchall()[0]))
+
+    @key_metrics.instrumented
+    def find_password(self, nickname):
+        """Get the Password for a particular nick, or None if there isn't one."""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            fields = snapshot.find(nickname)
+            return None if fields is None else Password(*fields)
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_PASS_BY_NICK, (nickname,))     # nickname could be untrusted user input
+            row = cur.fetchone()
+        return None if row is None else Password(*row)
+
+    @key_metrics.instrumented
+    def find_passwords(self, nicknames, chunk_size=500):
+        """Like find_password for many nicknames: get a dict of those in the db and
+        their Passwords, looking up chunk_size of them per query.
+        """
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            found = ((nickname, snapshot.find(nickname)) for nickname in nicknames)
+            return {nickname: Password(*fields) for nickname, fields in found if fields is not None}
+        found, nicknames = {}, iter(nicknames)
+        with self._cursor() as cur:
+            chunk = list(islice(nicknames, chunk_size))
+            while chunk:
+                cur.execute(_SQL_GET_PASS_BY_NICKS.format(",".join("?" * len(chunk))), chunk)
+                found.update((row[0], Password(*row)) for row in cur.fetchall())
+                chunk = list(islice(nicknames, chunk_size))
+        return found
+
+    @key_metrics.instrumented
+    def count_passwords(self):
+        """Get the number of passwords in the password database."""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return len(snapshot)
+        with self._cursor() as cur:
+            cur.execute(_SQL_COUNT_PASS)
+            return cur.fetchone()[0]
 
+    @key_metrics.instrumented
+    def iter_nicks(self, batch_size=1000):
+        """Yield all nicknames in order, fetching batch_size rows at a time."""
+        for row in self._iter_rows(_SQL_GET_NICK_ORDERED, batch_size):
+            yield row[0]
+
+    @key_metrics.instrumented
     def get_all_password_objects(self):
         """Get all passwords in password database."""
-        self.cur.execute(_SQL_GET_PASS)
-        return {row[0]: Password(*row) for row in self.cur.fetchall()}
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_PASS)
+            return {row[0]: FrozenPassword(*row) for row in cur.fetchall()}
+
+    @key_metrics.instrumented
+    def iter_password_objects(self, batch_size=1000):
+        """Yield all passwords in nickname order, fetching batch_size rows at a time."""
+        for row in self._iter_rows(_SQL_GET_PASS_ORDERED, batch_size):
+            yield FrozenPassword(*row)
+
+    @key_metrics.instrumented
+    def iter_password_rows(self, batch_size=1000, limit=None, offset=0, **filters):
+        """Like iter_password_objects, but yield the raw rows (tuples of the
+        values of Password.FIELDS) without making a Password for each.
+        Skip the first offset rows, and stop after limit rows if it isn't None;
+        filters are as for query.
+        """
+        if limit is None and not offset and not filters:
+            yield from self._iter_rows(_SQL_GET_PASS_ORDERED, batch_size)
+        else:
+            where, order_by, params = _compile_filters(filters)
+            params += [-1 if limit is None else limit, offset]
+            yield from self._iter_rows(_SQL_QUERY_PASS.format(where, order_by), batch_size, params)
 
+    @key_metrics.instrumented
+    def query(self, batch_size=1000, limit=None, offset=0, **filters):
+        """Yield the passwords that match all the filters (in nickname order, as for
+        iter_password_rows), which are run as a single SQL query:
+        host, user, base: hostname, username, base is this
+        special: special_char is this (True or False)
+        iteration_gt: iteration is more than this
+        Filters that are None are ignored; unknown filters raise TypeError.
+        """
+        for row in self.iter_password_rows(batch_size, limit, offset, **filters):
+            yield FrozenPassword(*row)
+
+    def _iter_rows(self, sql, batch_size, params=()):
+        """Yield the rows of a query, fetching batch_size rows at a time."""
+        with self._cursor(new_cursor=True) as cur:  # own cursor so other calls can run while we're iterating
+            cur.execute(sql, params)
+            rows = cur.fetchmany(batch_size)
+            while rows:
+                yield from rows
+                rows = cur.fetchmany(batch_size)
+
+    @key_metrics.instrumented
     def create_new_password(self, pw_obj):
         """Create a new password in the password database."""
-        self._run_create(pw_obj)
-        self.conn.commit()
+        with self._cursor() as cur:
+            self._run_create(cur, pw_obj)
+            _commit(cur.connection)
 
-    def _run_create(self, pw_obj):
+    @staticmethod
+    def _run_create(cur, pw_obj):
         """Run the create command against the database."""
-        self.cur.execute(_SQL_INS_PASS,                         # Fields could be untrusted user input
-                         (pw_obj.nickname, pw_obj.username, pw_obj.hostname,
-                          pw_obj.special_char, pw_obj.base, pw_obj.iteration,
-                          pw_obj.hint, pw_obj.start, pw_obj.finish))
+        cur.execute(_SQL_INS_PASS, _password_row(pw_obj))   # Fields could be untrusted user input
+
+    @key_metrics.instrumented
+    def bulk_insert(self, pw_objs, chunk_size=1000):
+        """Insert many passwords (any iterable, read chunk_size at a time) in a
+        single transaction, which is one change for syncing (see key_sync).
+        If anything fails, including reading pw_objs, then nothing is
+        inserted.  Returns the number of passwords inserted.
+        """
+        rows = (_password_row(pw_obj) for pw_obj in pw_objs)
+        count = 0
+        with self._cursor() as cur:
+            try:
+                cur.execute(_SQL_PAUSE_STAMPS, (1,))     # stamping the rows one by one triples the time
+                cur.execute(_SQL_GET_MAX_ROWID)
+                max_rowid = cur.fetchone()[0]            # new rows get higher rowids
+                chunk = list(islice(rows, chunk_size))
+                while chunk:
+                    cur.executemany(_SQL_INS_PASS, chunk)
+                    count += len(chunk)
+                    chunk = list(islice(rows, chunk_size))
+                cur.execute(_SQL_NEXT_CHANGE)
+                cur.execute(_SQL_STAMP_NEW_ROWS, (max_rowid,))
+                cur.execute(_SQL_PAUSE_STAMPS, (0,))
+            except BaseException:
+                cur.connection.rollback()
+                raise
+            _commit(cur.connection)
+        return count
 
+    @key_metrics.instrumented
     def update_old_password(self, orig_nick, pw_obj):
-        """Update an existing password in the password database."""
-        # We delete and then create (instead of updating) in case nickname itself changes.
-        self._run_delete(orig_nick)
-        self._run_create(pw_obj)
-        self.conn.commit()
+        """Update an existing password (possibly changing its nickname) in place,
+        in a single statement.  Returns False if there's no password orig_nick.
+        """
+        with self._cursor() as cur:
+            try:
+                cur.execute(_SQL_UPD_PASS, _password_row(pw_obj) + (orig_nick,))
+            except sqlite3.Error:
+                cur.connection.rollback()
+                raise
+            _commit(cur.connection)
+            return cur.rowcount == 1
 
+    @key_metrics.instrumented
     def delete_password(self, nickname_or_pw_obj):
         """Delete an existing password from the password database."""
-        if isinstance(nickname_or_pw_obj, Password):
+        if isinstance(nickname_or_pw_obj, BasePassword):
             nickname = nickname_or_pw_obj.nickname
         else:
             nickname = nickname_or_pw_obj
-        self._run_delete(nickname)
-        self.conn.commit()
+        with self._cursor() as cur:
+            self._run_delete(cur, nickname)
+            _commit(cur.connection)
 
-    def _run_delete(self, nickname):
+    @staticmethod
+    def _run_delete(cur, nickname):
         """Delete a password by nickname."""
-        self.cur.execute(_SQL_DEL_PASS, (nickname,))            # nickname could be untrusted user input
+        cur.execute(_SQL_DEL_PASS, (nickname,))                 # nickname could be untrusted user input
+
+    @key_metrics.instrumented
+    def get_sync_state(self):
+        """Get (this replica's id, the number of the last change recorded here); see key_sync."""
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_SYNC_STATE)
+            return cur.fetchone()
+
+    @key_metrics.instrumented
+    def new_replica_id(self):
+        """Give this database a new replica id (e.g. because it's a copy of another replica's file)."""
+        with self._cursor() as cur:
+            cur.execute(_SQL_NEW_REPLICA_ID)
+            _commit(cur.connection)
 
+    @key_metrics.instrumented
+    def iter_changes(self, after_seq=0, exclude_origins=(), batch_size=1000):
+        """Yield the changes recorded here after after_seq, in order, as
+        (seq, nickname, version, origin, deleted, fields), where fields are the
+        values of Password.FIELDS (None for a deletion).  Changes made by the
+        replicas in exclude_origins are skipped.
+        """
+        for row in self._iter_rows(_SQL_GET_CHANGES, batch_size, (after_seq,)):
+            if row[3] not in exclude_origins:
+                yield row[:5] + (None if row[4] else row[5:],)
+
+    @key_metrics.instrumented
+    def apply_changes(self, changes, peer, received):
+        """Apply another replica's changes (as from iter_changes), each one only
+        if it's newer than what we have: the higher version wins, and for equal
+        versions the higher replica id, so every replica ends up with the same
+        passwords.  Records that we've received peer's changes up to received,
+        all in one transaction.  Returns the number of changes applied.
+        """
+        applied, max_version = 0, 0
+        with self._cursor() as cur:
+            try:
+                cur.execute(_SQL_PAUSE_STAMPS, (1,))
+                for _, nickname, version, origin, deleted, fields in changes:
+                    max_version = max(max_version, version)
+                    cur.execute(_SQL_GET_ROW_VERSION, (nickname,))
+                    local = cur.fetchone()
+                    if local is not None and (version, origin) <= tuple(local):
+                        continue
+                    if deleted:
+                        self._run_delete(cur, nickname)
+                    else:
+                        cur.execute(_SQL_UPSERT_PASS, tuple(fields))
+                    cur.execute(_SQL_NEXT_SEQ)
+                    cur.execute(_SQL_SET_ROW_VERSION, (nickname, version, origin, int(deleted)))
+                    applied += 1
+                cur.execute(_SQL_UPDATE_CLOCK, (max_version,))
+                cur.execute(_SQL_PAUSE_STAMPS, (0,))
+                cur.execute(_SQL_SET_RECEIVED, (peer, received))
+            except BaseException:
+                cur.connection.rollback()
+                raise
+            _commit(cur.connection)
+        return applied
+
+    @key_metrics.instrumented
+    def get_sync_position(self, peer):
+        """Get (received, sent) for a peer: see apply_changes and set_sent_position."""
+        with self._cursor() as cur:
+            cur.execute(_SQL_GET_SYNC_POSITION, (peer,))
+            return cur.fetchone() or (0, 0)
+
+    @key_metrics.instrumented
+    def set_sent_position(self, peer, sent):
+        """Record that we've sent peer our changes up to sent."""
+        with self._cursor() as cur:
+            cur.execute(_SQL_SET_SENT, (peer, sent))
+            _commit(cur.connection)
+
+    @key_metrics.instrumented
     def close_db(self):
-        """Close database connection."""
+        """Close database connection (and in pooled mode the pool's connections,
+        those in use as soon as they're returned).
+        """
         self.conn.commit()
-        self.conn.close()
+        if self._pool is None:
+            self.conn.close()
+        else:
+            self._pool.close()     # self.conn is one of its connections
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+
+class _ConnectionPool:
+    """A bounded pool of connections to one database, for using a PasswordDB from
+    many threads.  Each thread checks out its own connection (and gets the same
+    one back if it asks again before returning it, e.g. while iterating over rows);
+    once pool_size connections are checked out, other threads wait for one (for
+    up to timeout seconds, then get sqlite3.OperationalError).
+    File databases are switched to WAL mode so that reads don't wait for writes.
+    Closing the pool closes the connections not in use; those still checked out are
+    closed as they're returned.
+    """
+    def __init__(self, db_name, pool_size, timeout):
+        self.timeout = timeout
+        if str(db_name) == ":memory:":     # give all our connections the same in-memory db
+            self._uri = "file:/keymaster-%d?vfs=memdb" % id(self)
+        else:
+            self._uri = Path(os.path.abspath(str(db_name))).as_uri()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+        self._checked_out = set()
+        self._closed = False
+
+    def connect(self, checked_out=False):
+        """Open a new connection to the database."""
+        conn = _trace_statements(sqlite3.connect(self._uri, timeout=self.timeout, uri=True, check_same_thread=False))
+        if "vfs=memdb" not in self._uri:
+            conn.execute(_SQL_SET_WAL_MODE)
+        with self._lock:
+            self._all.append(conn)
+            if checked_out:
+                self._checked_out.add(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out this thread's connection, waiting for a free one if need be."""
+        held = getattr(self._local, "held", None)
+        if held is None or held[0] is None:
+            if not self._slots.acquire(timeout=self.timeout):   # e.g. abandoned row iterators are holding them all
+                raise sqlite3.OperationalError("No free connection in the pool after %g seconds." % self.timeout)
+            with self._lock:
+                closed = self._closed
+                conn = None if closed or self._idle.empty() else self._idle.get_nowait()
+                if conn is not None:
+                    self._checked_out.add(conn)
+            if closed:
+                self._slots.release()
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+            if conn is None:
+                conn = self.connect(checked_out=True)
+            held = self._local.held = [conn, 0]
+        held[1] += 1
+        try:
+            yield held[0]
+        finally:
+            held[1] -= 1
+            if held[1] == 0:
+                conn, held[0] = held[0], None
+                with self._lock:
+                    self._checked_out.discard(conn)
+                    if self._closed:
+                        conn.close()
+                        self._all.remove(conn)
+                    else:
+                        self._idle.put(conn)
+                self._slots.release()
+
+    def close(self):
+        """Close the connections that aren't checked out, and have the rest closed when
+        they're returned (closing a connection while another thread is using it can crash SQLite).
+        """
+        with self._lock:
+            self._closed = True
+            for conn in [conn for conn in self._all if conn not in self._checked_out]:
+                conn.close()
+                self._all.remove(conn)
+            self._idle = queue.LifoQueue()
+
+
+def _commit(conn):
+    """Commit, timing it (if we're recording metrics)."""
+    with key_metrics.span("sqlite.commit"):
+        conn.commit()
+
+
+def _trace_statements(conn):
+    """If we're recording metrics, count the SQL statements run on conn."""
+    if key_metrics.is_enabled():
+        conn.set_trace_callback(_count_statement)
+    return conn
+
+
+def _count_statement(_):
+    """Trace callback: count a SQL statement."""
+    key_metrics.count("sqlite.statements")
+
+
+def _password_row(pw_obj):
+    """Get the column values to store for a Password object."""
+    return pw_obj.fields()
+
+
+def _compile_filters(filters, after=None):
+    """Turn query filters (and the nickname to start after, if any) into a where
+    clause (or ""), what to order by and the clause's parameters.
+    """
+    unknown = set(filters) - set(_QUERY_FILTERS)
+    if unknown:
+        raise TypeError("unknown filters: " + ", ".join(sorted(unknown)))
+    conditions, params = ([], []) if after is None else (["nickname > ?"], [after])
+    for name, value in sorted(filters.items()):
+        if value is not None:
+            condition, convert = _QUERY_FILTERS[name]
+            conditions.append(condition)
+            params.append(convert(value))
+    order_by = "+nickname" if any(filters.get(name) is not None for name in _RANGE_FILTERS) else "nickname"
+    return (" where " + " and ".join(conditions) if conditions else ""), order_by, params
+
+
+class LazyPasswordDict(MutableMapping):
+    """Dict-like view of a PasswordDB (nickname -> Password) that runs a query
+    for each lookup instead of loading the whole table, caching rows as they're
+    touched.  Iteration is in nickname order.
+
+    The database is the source of truth: callers still write through the
+    PasswordDB, and setting or deleting an item here only keeps the cache in
+    step with those writes.
+    """
+    def __init__(self, pass_db):
+        self.pass_db = pass_db
+        self._cache = {}
+
+    def __getitem__(self, nickname):
+        if nickname not in self._cache:
+            pw_obj = self.pass_db.find_password(nickname)
+            if pw_obj is None:
+                raise KeyError(nickname)
+            self._cache[nickname] = pw_obj
+        return self._cache[nickname]
+
+    def __setitem__(self, nickname, pw_obj):
+        self._cache[nickname] = pw_obj
+
+    def __delitem__(self, nickname):
+        self._cache.pop(nickname, None)
+
+    def clear(self):
+        """Forget all cached rows (e.g. because another process has changed the database)."""
+        self._cache.clear()
+
+    def __iter__(self):
+        return self.pass_db.iter_nicks()
+
+    def __len__(self):
+        return self.pass_db.count_passwords()
+
+    def items(self):
+        return _LazyPasswordItems(self)
+
+    def __repr__(self):
+        return 'LazyPasswordDict(%r)' % self.pass_db
+
+
+class _LazyPasswordItems(ItemsView):
+    """Items of a LazyPasswordDict, streamed from the database in one query."""
+    def __iter__(self):
+        for pw_obj in self._mapping.pass_db.iter_password_objects():
+            yield pw_obj.nickname, pw_obj
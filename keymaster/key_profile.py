@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""Profile a run of keymaster (--profile[=PATH] in the CLI and the Qt app).
+
+The profile is a cProfile/pstats file, so it can be read with
+    python -m pstats keymaster.prof
+or loaded into snakeviz and similar tools.  Both front ends import their
+heavy modules (the database code, sqlite3, hashlib, Qt's forms) only when
+they're needed, so the time spent importing them shows up in the profile
+under <frozen importlib._bootstrap> along with everything else.
+"""
+
+from contextlib import contextmanager
+import sys
+
+
+DEFAULT_PROFILE_PATH = "keymaster.prof"
+PROFILE_OPT = "--profile"
+
+_MSG_PROFILE_WRITTEN = "Profile written to {0} (see: python -m pstats {0})"
+
+
+def add_profile_arg(parser):
+    """Add --profile[=PATH] to an argparse parser.  A bare --profile has to be
+    turned into --profile=DEFAULT_PROFILE_PATH before parsing (see
+    expand_bare_profile_arg) so that it doesn't take the next argument as its path.
+    """
+    parser.add_argument(PROFILE_OPT, metavar="PATH", default=None,
+                        help="Profile this run and write the profile to PATH "
+                             "(use --profile=PATH; a bare --profile writes {})".format(DEFAULT_PROFILE_PATH))
+
+
+def expand_bare_profile_arg(command_line):
+    """Turn a bare --profile into --profile=DEFAULT_PROFILE_PATH."""
+    return [PROFILE_OPT + "=" + DEFAULT_PROFILE_PATH if arg == PROFILE_OPT else arg for arg in command_line]
+
+
+@contextmanager
+def profiled(path):
+    """Profile the block (if path isn't None) and write the profile to path,
+    even if the block raises (or calls sys.exit).
+    """
+    if path is None:
+        yield
+        return
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        print(_MSG_PROFILE_WRITTEN.format(path), file=sys.stderr)
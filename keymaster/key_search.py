@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""Fuzzy search over password nicknames, usernames and hostnames.
+"""
+
+from collections import Counter
+from collections import defaultdict
+import heapq
+
+
+DEFAULT_NUM_MATCHES = 10
+_COMMON_GRAM_FRACTION = 0.1
+
+
+def _trigrams(text):
+    """Lower-cased trigrams of text, padded so that even 1- and 2-character
+    strings (and the starts and ends of words) have trigrams.
+    """
+    padded = "  " + text.lower() + " "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class NicknameIndex:
+    """Trigram index over Password nicknames, usernames and hostnames.
+    Build it once (from any iterable of Passwords) and keep it current with
+    add and remove as entries are created, updated and deleted.
+    """
+    def __init__(self, pw_objs=()):
+        self._nicks_by_gram = defaultdict(set)
+        self._grams_by_nick = {}
+        for pw_obj in pw_objs:
+            self.add(pw_obj)
+
+    def __len__(self):
+        return len(self._grams_by_nick)
+
+    def add(self, pw_obj):
+        """Index a Password (replacing any earlier entry with the same nickname)."""
+        self.remove(pw_obj.nickname)
+        grams = frozenset(_trigrams(pw_obj.nickname) | _trigrams(pw_obj.username) | _trigrams(pw_obj.hostname))
+        self._grams_by_nick[pw_obj.nickname] = grams
+        for gram in grams:
+            self._nicks_by_gram[gram].add(pw_obj.nickname)
+
+    def remove(self, nickname):
+        """Drop a nickname from the index (if it's there)."""
+        for gram in self._grams_by_nick.pop(nickname, ()):
+            nicks = self._nicks_by_gram[gram]
+            nicks.discard(nickname)
+            if not nicks:
+                del self._nicks_by_gram[gram]
+
+    def search(self, query, num_matches=DEFAULT_NUM_MATCHES):
+        """Return up to num_matches nicknames, best first.
+        Entries are ranked by how many of the query's trigrams they contain, then
+        by whether the query appears in the nickname itself, then by nickname length.
+        An empty query returns the first nicknames alphabetically.
+        """
+        query = query.strip()
+        if not query:
+            return heapq.nsmallest(num_matches, self._grams_by_nick)
+        postings = [self._nicks_by_gram[gram] for gram in _trigrams(query) if gram in self._nicks_by_gram]
+        # Trigrams that lots of entries share (".com", say) tell us little and
+        # are slow to count, so we skip them if the query has rarer ones:
+        rare_postings = [nicks for nicks in postings if len(nicks) <= len(self) * _COMMON_GRAM_FRACTION]
+        scores = Counter()
+        for nicks in rare_postings or postings:
+            scores.update(nicks)
+        query = query.lower()
+        return heapq.nsmallest(num_matches, scores,
+                               key=lambda nick: (-scores[nick], query not in nick.lower(), len(nick), nick))
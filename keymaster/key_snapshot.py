@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""Read-only snapshot of a password database in a compact binary file that
+readers mmap and binary-search, so lookups don't touch SQLite and the pages
+are shared between processes.  Written by "keymaster snapshot"; PasswordDB
+uses a snapshot next to its database (see snapshot_path_for) for as long as
+the database hasn't changed since the snapshot was written.
+
+Layout (all little-endian):
+    header     magic, format version, record count, the database's state
+               when the snapshot was written (see db_state), section offsets
+    prefixes   the first 8 bytes of each nickname (zero-padded) as a 64-bit
+               big-endian number, so a lookup can bisect them in C and only
+               compare whole nicknames that share a prefix
+    nicknames  count + 1 offsets, then the UTF-8 nicknames, sorted, end to
+               end: nickname i runs from offset i to offset i + 1
+    records    the other fields, one fixed-size record per password, in
+               nickname order
+    strings    the other strings (UTF-8), each distinct one once; records
+               refer to them by (offset, length)
+
+Whether the database has changed is judged from its file's mtime, size and
+the change counter SQLite keeps in its header, plus (in WAL mode) the mtime
+and size of its -wal file.  ("pragma data_version" can't be used: it's only
+meaningful within one connection.)
+"""
+
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
+import mmap
+import os
+import struct
+import sys
+
+
+SNAPSHOT_SUFFIX = ".snapshot"
+
+_MAGIC = b"KMSNAP\r\n"
+_FORMAT_VERSION = 1
+# magic, version, count, db state, offsets of the prefixes, nickname offsets, records and strings:
+_HEADER = struct.Struct("<8sII5q4Q")
+# username, hostname, hint and kdf as (offset, length), then
+# special_char, base, iteration, start, finish, kdf_cost:
+_RECORD = struct.Struct("<8IBBxxqiiq")
+_PREFIX_SIZE = 8
+_PREFIX_TYPE = "Q"
+_OFFSETS_TYPE = "I"
+_CHR_ENCODING = "utf-8"
+# from the SQLite file header: the file format write version (2 for WAL mode), then 5 bytes
+# later the change counter (which isn't updated in WAL mode):
+_SQLITE_HEADER = struct.Struct(">B5xI")
+_SQLITE_HEADER_OFFSET = 18
+_WAL_VERSION = 2
+_MISSING_FILE_STATE = (-1, -1)
+
+
+def snapshot_path_for(db_path):
+    """Where the snapshot for a database goes by default."""
+    return str(db_path) + SNAPSHOT_SUFFIX
+
+
+def db_state(db_path):
+    """(db mtime ns, db size, db change counter, -wal mtime ns, -wal size), with -1s for
+    a missing file (and for the -wal file if the database isn't in WAL mode).
+    """
+    db_file = _DbFile(db_path)
+    try:
+        return db_file.state()
+    finally:
+        db_file.close()
+
+
+class _DbFile:
+    """A database file whose state (see db_state) we check often, so we keep it open."""
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self._wal_path = self.db_path + "-wal"
+        self._fd, self._ino = None, None
+
+    def state(self):
+        """See db_state."""
+        try:
+            stat = os.stat(self.db_path)
+        except FileNotFoundError:
+            return _MISSING_FILE_STATE + (-1,) + self._wal_state()
+        if stat.st_ino != self._ino:    # first time, or the file's been replaced
+            self.close()
+            self._fd, self._ino = os.open(self.db_path, os.O_RDONLY), stat.st_ino
+        header = os.pread(self._fd, _SQLITE_HEADER.size, _SQLITE_HEADER_OFFSET)
+        if len(header) < _SQLITE_HEADER.size:     # empty, or not a database
+            return (stat.st_mtime_ns, stat.st_size, -1) + self._wal_state()
+        write_version, change_counter = _SQLITE_HEADER.unpack(header)
+        wal_state = self._wal_state() if write_version == _WAL_VERSION else _MISSING_FILE_STATE
+        return (stat.st_mtime_ns, stat.st_size, change_counter) + wal_state
+
+    def _wal_state(self):
+        """The -wal file's part of the state."""
+        try:
+            stat = os.stat(self._wal_path)
+        except FileNotFoundError:
+            return _MISSING_FILE_STATE
+        return stat.st_mtime_ns, stat.st_size
+
+    def close(self):
+        """Close the file (state() reopens it)."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd, self._ino = None, None
+
+
+def write_snapshot(rows, path, state):
+    """Write rows (tuples of the values of Password.FIELDS) to a snapshot at
+    path, recording state (see db_state: take it before reading the rows, so
+    that a change made while we're reading makes the snapshot stale).  The
+    file is replaced atomically, so readers of an older snapshot are
+    unaffected.  Returns the number of passwords written.
+    """
+    strings, string_offsets = bytearray(), {}
+    def _add_string(string):
+        encoded = string.encode(_CHR_ENCODING)
+        offset = string_offsets.get(encoded)
+        if offset is None:
+            offset = string_offsets[encoded] = len(strings)
+            strings.extend(encoded)
+        return offset, len(encoded)
+    records = []
+    for nickname, username, hostname, special_char, base, iteration, hint, start, finish, kdf, kdf_cost in rows:
+        records.append((nickname.encode(_CHR_ENCODING),
+                        _RECORD.pack(*_add_string(username), *_add_string(hostname), *_add_string(hint),
+                                     *_add_string(kdf), int(special_char), base, iteration, start, finish, kdf_cost)))
+    records.sort(key=lambda record: record[0])
+    prefixes, nicknames, nick_offsets = array(_PREFIX_TYPE), bytearray(), array(_OFFSETS_TYPE, [0])
+    for nickname, _ in records:
+        prefixes.append(_prefix(nickname))
+        nicknames.extend(nickname)
+        nick_offsets.append(len(nicknames))
+    if sys.byteorder != "little":
+        prefixes.byteswap()
+        nick_offsets.byteswap()
+    nick_section = nick_offsets.tobytes() + bytes(nicknames)
+    nick_section += bytes(-len(nick_section) % 8)        # keep the records aligned
+    offsets_offset = _HEADER.size + len(prefixes) * prefixes.itemsize
+    records_offset = offsets_offset + len(nick_section)
+    strings_offset = records_offset + _RECORD.size * len(records)
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "wb") as out_file:
+        out_file.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(records), *state,
+                                    _HEADER.size, offsets_offset, records_offset, strings_offset))
+        out_file.write(prefixes.tobytes())
+        out_file.write(nick_section)
+        out_file.writelines(record for _, record in records)
+        out_file.write(strings)
+    os.replace(tmp_path, str(path))
+    return len(records)
+
+
+class Snapshot:
+    """A snapshot file, mapped read-only."""
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, "rb") as snapshot_file:
+            self._file_id = _file_id(os.fstat(snapshot_file.fileno()))
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size or self._map[:len(_MAGIC)] != _MAGIC:
+            self._map.close()
+            raise ValueError("not a keymaster snapshot: " + self.path)
+        _, version, self._count, *state, prefixes_offset, offsets_offset, self._records_offset, \
+            self._strings_offset = _HEADER.unpack_from(self._map)
+        if version != _FORMAT_VERSION:
+            self._map.close()
+            raise ValueError("unsupported snapshot version %d: %s" % (version, self.path))
+        self.db_state = tuple(state)
+        self._db_file = None
+        self._nicknames_offset = offsets_offset + (self._count + 1) * array(_OFFSETS_TYPE).itemsize
+        self._prefixes = _array_view(self._map, prefixes_offset, offsets_offset, _PREFIX_TYPE)
+        self._nick_offsets = _array_view(self._map, offsets_offset, self._nicknames_offset, _OFFSETS_TYPE)
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        """Unmap the file."""
+        for view in (self._prefixes, self._nick_offsets):
+            if isinstance(view, memoryview):
+                view.release()
+        if self._db_file is not None:
+            self._db_file.close()
+        self._map.close()
+
+    def is_fresh(self, db_path):
+        """Has the database not changed since this snapshot was written?"""
+        if self._db_file is None or self._db_file.db_path != str(db_path):
+            self._db_file = _DbFile(db_path)
+        return self._db_file.state() == self.db_state
+
+    def is_replaced(self):
+        """Has a new snapshot been written over this one?"""
+        try:
+            return _file_id(os.stat(self.path)) != self._file_id
+        except FileNotFoundError:
+            return True
+
+    def find(self, nickname):
+        """The field values (in Password.FIELDS order) for a nickname, or None."""
+        key = nickname.encode(_CHR_ENCODING)
+        the_map, offsets, base = self._map, self._nick_offsets, self._nicknames_offset
+        prefix = _prefix(key)
+        low = bisect_left(self._prefixes, prefix)
+        high = bisect_right(self._prefixes, prefix, low)
+        while low < high:       # nicknames with the same prefix
+            mid = (low + high) // 2
+            if the_map[base + offsets[mid]:base + offsets[mid + 1]] < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == self._count or the_map[base + offsets[low]:base + offsets[low + 1]] != key:
+            return None
+        return self._fields(low, nickname)
+
+    def iter_rows(self):
+        """Yield all the rows in nickname order."""
+        base = self._nicknames_offset
+        for pos in range(self._count):
+            nickname = self._map[base + self._nick_offsets[pos]:base + self._nick_offsets[pos + 1]]
+            yield self._fields(pos, nickname.decode(_CHR_ENCODING))
+
+    def _fields(self, pos, nickname):
+        """Record pos's field values, in Password.FIELDS order."""
+        the_map, strings = self._map, self._strings_offset
+        (username, username_len, hostname, hostname_len, hint, hint_len, kdf, kdf_len,
+         special_char, base, iteration, start, finish, kdf_cost) = \
+            _RECORD.unpack_from(the_map, self._records_offset + pos * _RECORD.size)
+        username, hostname, hint, kdf = (strings + username, strings + hostname, strings + hint, strings + kdf)
+        return (nickname, the_map[username:username + username_len].decode(_CHR_ENCODING),
+                the_map[hostname:hostname + hostname_len].decode(_CHR_ENCODING), special_char, base, iteration,
+                the_map[hint:hint + hint_len].decode(_CHR_ENCODING), start, finish,
+                the_map[kdf:kdf + kdf_len].decode(_CHR_ENCODING), kdf_cost)
+
+
+def _prefix(nickname):
+    """A number that orders nicknames (UTF-8) the same way as their first 8 bytes do."""
+    return int.from_bytes(nickname[:_PREFIX_SIZE].ljust(_PREFIX_SIZE, b"\0"), "big")
+
+
+def _array_view(the_map, start, end, typecode):
+    """The numbers in the_map[start:end] as a read-only sequence (without copying if we can)."""
+    view = memoryview(the_map)[start:end]
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    numbers = array(typecode)
+    numbers.frombytes(view)
+    numbers.byteswap()
+    view.release()
+    return numbers
+
+
+def _file_id(stat):
+    """What identifies a particular version of a file."""
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""Incremental sync between replicas of a password database.
+
+Every change to the passwords table is stamped (by triggers; see migration 3
+in key_password) with a version from a Lamport clock, the id of the replica
+that made it and a local sequence number, and deletes leave tombstones.  A
+sync sends only the changes the other side hasn't had yet: those with
+sequence numbers after the last one it received from us.
+
+Conflicts are resolved the same way everywhere: a change replaces what a
+replica has only if its (version, replica id) is higher (see
+PasswordDB.apply_changes), so once replicas have exchanged their changes
+they have the same passwords whatever order they synced in.
+
+A peer is either another database file or a sync directory standing in for
+a server: each replica appends its changes to <replica id>.changes (JSON
+lines) there and reads the others' files from where it left off.
+
+A database file copied from another replica has the same replica id, which
+sync refuses; give the copy a new one first (PasswordDB.new_replica_id or
+"keymaster sync --new-replica-id").
+"""
+
+import json
+import os
+
+from keymaster.key_password import PasswordDB
+
+
+CHANGES_SUFFIX = ".changes"
+
+_MSG_SAME_REPLICA = ("{} and {} have the same replica id (is one a copy of the other?); "
+                     "give one of them a new one with --new-replica-id")
+
+
+def sync(pass_db, peer_path):
+    """Sync with a database file or a sync directory.  Returns (changes received,
+    received changes applied, changes sent, sent changes applied or None for a directory).
+    """
+    if os.path.isdir(peer_path):
+        return sync_with_dir(pass_db, peer_path)
+    if not os.path.exists(peer_path):
+        raise FileNotFoundError("no such database or directory: %s" % peer_path)
+    peer_db = PasswordDB(peer_path, create_new_db=False)
+    try:
+        return sync_with_db(pass_db, peer_db)
+    finally:
+        peer_db.close_db()
+
+
+def sync_with_db(pass_db, peer_db):
+    """Exchange changes with another replica's database (see sync)."""
+    replica_id = pass_db.get_sync_state()[0]
+    peer_id, peer_seq = peer_db.get_sync_state()   # before reading, so changes made meanwhile are sent again
+    if replica_id == peer_id:
+        raise ValueError(_MSG_SAME_REPLICA.format(pass_db.db_name, peer_db.db_name))
+    received = _Counted(peer_db.iter_changes(pass_db.get_sync_position(peer_id)[0], exclude_origins={replica_id}))
+    received_applied = pass_db.apply_changes(received, peer_id, peer_seq)
+    seq = pass_db.get_sync_state()[1]
+    sent = _Counted(pass_db.iter_changes(peer_db.get_sync_position(replica_id)[0], exclude_origins={peer_id}))
+    sent_applied = peer_db.apply_changes(sent, replica_id, seq)
+    return received.count, received_applied, sent.count, sent_applied
+
+
+def sync_with_dir(pass_db, dir_path):
+    """Exchange changes through a sync directory (see sync)."""
+    replica_id, seq = pass_db.get_sync_state()
+    own_path = os.path.realpath(os.path.join(dir_path, replica_id + CHANGES_SUFFIX))
+    other_paths = sorted(os.path.realpath(os.path.join(dir_path, name)) for name in os.listdir(dir_path)
+                         if name.endswith(CHANGES_SUFFIX) and name != replica_id + CHANGES_SUFFIX)
+    # Send ours, except those that replicas with their own files here have sent (or will send):
+    others = {os.path.basename(path)[:-len(CHANGES_SUFFIX)] for path in other_paths}
+    sent = 0
+    with open(own_path, "a") as out_file:
+        for change in pass_db.iter_changes(pass_db.get_sync_position(own_path)[1], exclude_origins=others):
+            out_file.write(json.dumps(change) + "\n")
+            sent += 1
+    pass_db.set_sent_position(own_path, seq)
+    # Then receive theirs:
+    received = received_applied = 0
+    for path in other_paths:
+        offset = pass_db.get_sync_position(path)[0]
+        with open(path, "rb") as in_file:
+            in_file.seek(offset)
+            data = in_file.read()
+        data = data[:data.rfind(b"\n") + 1]     # a line still being written is read next time
+        changes = [json.loads(line) for line in data.splitlines()]
+        received += len(changes)
+        received_applied += pass_db.apply_changes(changes, path, offset + len(data))
+    return received, received_applied, sent, None
+
+
+class _Counted:
+    """Iterate over an iterable, counting the items."""
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.count += 1
+            yield item
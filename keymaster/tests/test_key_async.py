@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Concurrent lookups and writes through AsyncPasswordDB
+- Async iteration in batches
+- Cancelling calls
+- get_data
+"""
+
+import asyncio
+import os
+import tempfile
+
+import nose
+from keymaster.key_async import AsyncPasswordDB
+from keymaster.key_password import Password
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _open_db(num_passwords=50):
+    """An in-memory AsyncPasswordDB with a few passwords."""
+    pass_db = await AsyncPasswordDB.open(":memory:", create_new_db=True)
+    await pass_db.bulk_insert(Password("nick%03d" % i, "user", "host") for i in range(num_passwords))
+    return pass_db
+
+
+def test_concurrent_crud():
+    async def _test():
+        # Given:
+        pass_db = await _open_db()
+        # When we look up lots of passwords at once:
+        pw_objs = await asyncio.gather(*(pass_db.find_password("nick%03d" % (i % 60)) for i in range(1000)))
+        # Then we get them all (and None for the ones that don't exist):
+        assert [pw_obj.nickname for pw_obj in pw_objs[:50]] == ["nick%03d" % i for i in range(50)]
+        assert pw_objs[50:60] == [None] * 10
+        # And when we create, update and delete:
+        await asyncio.gather(*(pass_db.create_new_password(Password("new%d" % i, "u", "h")) for i in range(20)))
+        assert await pass_db.update_old_password("new0", Password("renamed", "u", "h"))
+        assert not await pass_db.update_old_password("no-such-nick", Password("other", "u", "h"))
+        await pass_db.delete_password("new1")
+        # Then:
+        assert await pass_db.count_passwords() == 50 + 20 - 1
+        assert (await pass_db.get_password_for_nick("renamed")).hostname == "h"
+        assert "new1" not in await pass_db.get_list_of_nicks()
+        await pass_db.close_db()
+    _run(_test())
+
+
+def test_async_iteration():
+    async def _test():
+        # Given:
+        pass_db = await _open_db()
+        # When/then: iterating in batches (including a partial last batch) gets everything in order:
+        for batch_size in (7, 10, 50, 1000):
+            nicks = [pw_obj.nickname async for pw_obj in pass_db.iter_password_objects(batch_size)]
+            assert nicks == ["nick%03d" % i for i in range(50)]
+        await pass_db.close_db()
+    _run(_test())
+
+
+def test_cancellation():
+    async def _test():
+        # Given:
+        pass_db = await _open_db()
+        # When we cancel a lot of lookups (most of which won't have started):
+        tasks = [asyncio.ensure_future(pass_db.find_password("nick001")) for _ in range(200)]
+        await asyncio.sleep(0)
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Then they're cancelled:
+        assert any(isinstance(result, asyncio.CancelledError) for result in results)
+        # And the database still works:
+        assert (await pass_db.find_password("nick001")).nickname == "nick001"
+        await pass_db.close_db()
+    _run(_test())
+
+
+def test_get_data():
+    async def _test():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "sub", "async.db")
+            # Given no database, when we decline to create one, then:
+            assert await AsyncPasswordDB.get_data(lambda: False, lambda: None, db_path) == (None, None)
+            # When we create one:
+            pass_db, pass_dic = await AsyncPasswordDB.get_data(lambda: True, lambda: None, db_path)
+            await pass_db.create_new_password(Password("nick", "user", "host"))
+            # Then:
+            assert await pass_db.get_list_of_nicks() == ["nick"]
+            assert pass_dic["nick"].username == "user"
+            await pass_db.close_db()
+    _run(_test())
+
+
+if __name__ == '__main__':
+    nose.main()
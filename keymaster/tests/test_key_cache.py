@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Cache hits and misses, by Password fields and proto-password
+- TTL expiry and LRU eviction
+- Wiping, and wiping at exit without keeping caches alive
+"""
+
+import gc
+import weakref
+
+import nose
+from keymaster import key_cache
+from keymaster.key_cache import DerivationCache
+from keymaster.key_password import FrozenPassword
+from keymaster.key_password import Password
+
+
+class _Clock:
+    """A clock for tests: set now to move time."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class _CountingPassword(Password):
+    """A Password that counts its calculations."""
+    calculations = 0
+
+    def calculate_password(self, user_proto_pw):
+        _CountingPassword.calculations += 1
+        return super().calculate_password(user_proto_pw)
+
+
+def _get_cache(max_entries=3):
+    clock = _Clock()
+    return clock, DerivationCache(ttl=10, max_entries=max_entries, clock=clock)
+
+
+def test_hits_and_misses():
+    # Given:
+    _, cache = _get_cache()
+    pw_obj = _CountingPassword("nick", "user", "host")
+    _CountingPassword.calculations = 0
+    # When we calculate the same password twice, then it's only calculated once:
+    assert cache.calculate_password(pw_obj, "proto") == pw_obj.calculate_password("proto")
+    assert cache.calculate_password(pw_obj, "proto") == pw_obj.calculate_password("proto")
+    assert _CountingPassword.calculations == 3
+    # But a different proto-password or any different field is a miss:
+    assert cache.calculate_password(pw_obj, "other") == pw_obj.calculate_password("other")
+    changed = _CountingPassword("nick", "user", "host", iteration=2)
+    assert cache.calculate_password(changed, "proto") == changed.calculate_password("proto")
+    assert _CountingPassword.calculations == 7
+    # And the cache doesn't hold the proto-password:
+    assert all(b"proto" not in bytes(key[1]) for key in cache._entries)
+
+
+def test_expiry_and_eviction():
+    # Given:
+    clock, cache = _get_cache()
+    pw_objs = [FrozenPassword("nick%d" % i, "user", "host") for i in range(4)]
+    for pw_obj in pw_objs[:3]:
+        cache.calculate_password(pw_obj, "proto")
+    # When we use the first one again and add a fourth:
+    cache.calculate_password(pw_objs[0], "proto")
+    cache.calculate_password(pw_objs[3], "proto")
+    # Then the least recently used one is evicted:
+    assert len(cache) == 3
+    assert [key[0][0] for key in cache._entries] == ["nick2", "nick0", "nick3"]
+    # And when their time is up, they're all dropped:
+    clock.now = 10
+    cache.expire()
+    assert len(cache) == 0
+
+
+def test_wipe():
+    # Given:
+    _, cache = _get_cache()
+    cache.calculate_password(FrozenPassword("nick", "user", "host"), "proto")
+    entries = [password for _, password in cache._entries.values()]
+    # When:
+    cache.wipe()
+    # Then the passwords were zeroed and dropped:
+    assert len(cache) == 0
+    assert entries[0] == bytearray(len(entries[0])) and len(entries[0]) > 0
+
+
+def test_wipe_at_exit():
+    # Given a cache that's still in use and one that's been dropped:
+    _, cache = _get_cache()
+    cache.calculate_password(FrozenPassword("nick", "user", "host"), "proto")
+    dropped = weakref.ref(_get_cache()[1])
+    gc.collect()
+    # When the exit hook runs:
+    key_cache._wipe_live_caches()
+    # Then the live cache was wiped, and the dropped one wasn't kept alive for it:
+    assert len(cache) == 0
+    assert dropped() is None
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Loading PasswordColumns from a PasswordDB
+- Lookups by row and nickname
+- Filtering by hostname, iteration and base
+"""
+
+import nose
+from keymaster.key_columns import PasswordColumns
+from keymaster.key_password import Password
+from keymaster.key_password import PasswordDB
+
+
+def _get_columns():
+    """Columns loaded (in small batches) from a db with a few passwords."""
+    pass_db = PasswordDB(":memory:", True)
+    pass_db.bulk_insert(Password("nick%d" % i, "user%d" % (i % 2), "host%d" % (i % 3), i % 2 == 0,
+                                 (32, 64)[i % 2], 1 + i % 4, "hint", 0, 15) for i in range(10))
+    return pass_db, PasswordColumns.from_db(pass_db, batch_size=3)
+
+
+def test_load_and_lookup():
+    # Given:
+    pass_db, columns = _get_columns()
+    # Then the columns hold the same passwords, in order:
+    assert len(columns) == 10
+    assert list(columns) == list(pass_db.iter_password_objects())
+    assert columns[1] == pass_db.get_password_for_nick("nick1")
+    assert columns.nickname(2) == "nick2"
+    # And can be searched by nickname:
+    assert columns.find_row("nick2") == 2
+    assert columns.get("nick9") == pass_db.get_password_for_nick("nick9")
+    assert columns.find_row("nick") is None
+    assert columns.get("zzz") is None
+
+
+def test_find_rows():
+    # Given:
+    _, columns = _get_columns()
+    # When/then:
+    assert columns.find_rows() == list(range(10))
+    assert columns.find_rows(hostname="host1") == [1, 4, 7]
+    assert columns.find_rows(hostname="nowhere") == []
+    assert columns.find_rows(base=64) == [1, 3, 5, 7, 9]
+    assert columns.find_rows(iteration=2) == [1, 5, 9]
+    assert columns.find_rows(hostname="host1", base=64) == [1, 7]
+    assert columns.find_rows(hostname="host1", base=64, iteration=4) == [7]
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Routing by namespace and by hash
+- Lookups and merged listings across shards
+- Writes, including renames that move a password between shards
+- Closing while pages are still being fetched
+- Splitting a database and opening the shards together
+- get_data
+"""
+
+import os
+import tempfile
+import threading
+
+import nose
+from nose.tools import raises
+from keymaster import key_federated
+from keymaster.key_federated import FederatedPasswordDB
+from keymaster.key_password import LazyPasswordDict
+from keymaster.key_password import Password
+from keymaster.key_password import PasswordDB
+
+
+def _open(tmp_dir, names=("ops", "dev", "web")):
+    """A FederatedPasswordDB over new databases in tmp_dir."""
+    return FederatedPasswordDB([os.path.join(tmp_dir, name + ".db") for name in names], True)
+
+
+def _count_in(fed_db, pos):
+    return fed_db.shards[pos].count_passwords()
+
+
+def test_routing_and_lookups():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        fed_db = _open(tmp_dir)
+        # When:
+        fed_db.create_new_password(Password("ops/db", "root", "db.ops"))
+        fed_db.create_new_password(Password("web/cdn", "admin", "cdn.web"))
+        fed_db.bulk_insert(Password("nick%02d" % i, "user", "host") for i in range(30))
+        # Then namespaced nicknames go to their shard and the rest are spread by hash:
+        assert fed_db.shards[0].find_password("ops/db") is not None
+        assert fed_db.shards[2].find_password("web/cdn") is not None
+        for i in range(30):
+            nick = "nick%02d" % i
+            assert fed_db.shards[key_federated.shard_index(nick, 3)].find_password(nick) is not None
+        assert all(_count_in(fed_db, pos) > 1 for pos in range(3))
+        # And lookups and listings see all of them:
+        assert fed_db.count_passwords() == 32
+        assert fed_db.find_password("ops/db").hostname == "db.ops"
+        assert fed_db.get_password_for_nick("nick17") == Password("nick17", "user", "host")
+        assert fed_db.find_password("nope") is None
+        assert fed_db.find_passwords(["nick03", "ops/db", "nope"]) == {
+            "nick03": fed_db.find_password("nick03"), "ops/db": fed_db.find_password("ops/db")}
+        expected = sorted(["ops/db", "web/cdn"] + ["nick%02d" % i for i in range(30)])
+        assert fed_db.get_list_of_nicks() == expected
+        assert list(fed_db.iter_nicks(batch_size=4)) == expected
+        assert [pw_obj.nickname for pw_obj in fed_db.iter_password_objects(batch_size=3)] == expected
+        assert fed_db.get_nicks_page(limit=5) == expected[:5]
+        assert fed_db.get_nicks_page(after=expected[5], limit=5) == expected[6:11]
+        assert fed_db.get_nicks_page(after="nick05", limit=3, containing="K1") == ["nick10", "nick11", "nick12"]
+        assert [pw_obj.nickname for pw_obj in fed_db.get_passwords_page("nick28", 10)] == expected[29:]
+        fed_db.close_db()
+
+
+def test_updates_and_deletes():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        fed_db = _open(tmp_dir)
+        fed_db.create_new_password(Password("ops/db", "root", "db.ops"))
+        # When we update in place, then rename into another namespace:
+        assert fed_db.update_old_password("ops/db", Password("ops/db", "admin", "db.ops"))
+        assert fed_db.find_password("ops/db").username == "admin"
+        assert fed_db.update_old_password("ops/db", Password("dev/db", "admin", "db.dev"))
+        # Then the password has moved:
+        assert fed_db.find_password("ops/db") is None
+        assert fed_db.shards[1].find_password("dev/db").hostname == "db.dev"
+        assert (_count_in(fed_db, 0), _count_in(fed_db, 1)) == (0, 1)
+        assert not fed_db.update_old_password("nope", Password("nope"))
+        # And deletes find it wherever it is:
+        fed_db.delete_password("dev/db")
+        assert fed_db.count_passwords() == 0
+        fed_db.close_db()
+
+
+def test_duplicate_nicknames():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given the same nickname in two shards:
+        fed_db = _open(tmp_dir)
+        fed_db.shards[0].create_new_password(Password("dev/x", "wrong"))
+        fed_db.shards[1].create_new_password(Password("dev/x", "right"))
+        # Then the one in the shard it routes to wins:
+        assert fed_db.find_password("dev/x").username == "right"
+        assert [pw_obj.username for pw_obj in fed_db.iter_password_objects()] == ["right"]
+        assert fed_db.find_passwords(["dev/x", "nope"]) == {"dev/x": Password("dev/x", "right")}
+        fed_db.close_db()
+
+
+def test_close_after_partial_reads():
+    def _read_and_close(tmp_dir, names):
+        for _ in range(10):
+            # Given shards whose next pages are fetched ahead:
+            fed_db = _open(tmp_dir, names)
+            fed_db.bulk_insert(Password("nick%03d" % i, "user", "host") for i in range(300))
+            # When we read part of a listing and close straight away:
+            assert len(fed_db.get_nicks_page(limit=2)) == 2
+            assert len(fed_db.get_passwords_page("nick100", 3)) == 3
+            assert len(list(fed_db.query(batch_size=2, limit=5))) == 5
+            nicks = fed_db.iter_nicks(batch_size=2)
+            next(nicks)
+            pw_objs = fed_db.query(batch_size=2)
+            next(pw_objs)
+            fed_db.close_db()
+            # Then nothing is left fetching from the closed databases (which would crash),
+            # and the listings can still be closed afterwards:
+            nicks.close()
+            del pw_objs
+            for name in names:
+                os.remove(os.path.join(tmp_dir, name + ".db"))
+        done.set()
+
+    done = threading.Event()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        thread = threading.Thread(target=_read_and_close, args=(tmp_dir, ["db%d" % i for i in range(6)]),
+                                  daemon=True)
+        thread.start()
+        thread.join(30)
+        assert done.is_set(), "closing a partly read listing hung or failed"
+
+
+def test_split():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        pass_db = PasswordDB(os.path.join(tmp_dir, "big.db"), True)
+        pass_db.bulk_insert(Password("nick%03d" % i, "user", "host%d" % i) for i in range(200))
+        # When:
+        paths = key_federated.split_database(pass_db, 4, chunk_size=10)
+        # Then the shards between them have all the passwords, and routing finds them:
+        assert [os.path.basename(path) for path in paths] == ["big-%d-of-4.db" % i for i in range(4)]
+        fed_db = FederatedPasswordDB(paths, False)
+        assert fed_db.count_passwords() == 200
+        assert list(fed_db.iter_password_rows()) == list(pass_db.iter_password_rows())
+        assert list(fed_db.iter_password_rows(limit=15, offset=90)) == list(pass_db.iter_password_rows(7, 15, 90))
+        assert list(fed_db.query(iteration_gt=0, host="host7", limit=5)) == list(pass_db.query(host="host7"))
+        assert list(fed_db.query(batch_size=3, host="host7", offset=1)) == []
+        assert [row[0] for row in pass_db.iter_password_rows(offset=198)] == ["nick198", "nick199"]
+        for i in range(0, 200, 7):
+            nick = "nick%03d" % i
+            assert fed_db.shards[key_federated.shard_index(nick, 4)].find_password(nick).hostname == "host%d" % i
+        fed_db.close_db()
+        pass_db.close_db()
+
+
+@raises(FileExistsError)
+def test_split_wont_overwrite():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pass_db = PasswordDB(os.path.join(tmp_dir, "big.db"), True)
+        key_federated.split_database(pass_db, 2)
+        key_federated.split_database(pass_db, 2)
+
+
+def test_get_data():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given one database that exists and one that doesn't:
+        paths = [os.path.join(tmp_dir, "ops.db"), os.path.join(tmp_dir, "new", "dev.db")]
+        pass_db = PasswordDB(paths[0], True)
+        pass_db.create_new_password(Password("ops/db"))
+        pass_db.close_db()
+        # When we decline, nothing's opened; when we accept, the missing one is created:
+        assert FederatedPasswordDB.get_data(lambda: False, lambda: None, paths) == (None, None)
+        fed_db, pass_dic = FederatedPasswordDB.get_data(lambda: True, lambda: None, paths)
+        # Then:
+        assert os.path.exists(paths[1])
+        assert isinstance(pass_dic, LazyPasswordDict)
+        assert "ops/db" in pass_dic and len(pass_dic) == 1
+        fed_db.close_db()
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Each KDF is deterministic and depends on the proto-password, salt and cost
+- The default KDF is the original calculation
+- Cost checks
+- Calibration
+"""
+
+import hashlib
+
+import nose
+from nose.tools import raises
+from keymaster import key_kdf
+from keymaster.key_password import Password
+
+
+_LOW_COSTS = {"sha512": 0, "pbkdf2-sha512": 1000, "scrypt": 10}
+
+
+def test_derive():
+    for kdf, cost in _LOW_COSTS.items():
+        # Given/when:
+        digest = key_kdf.derive(kdf, cost, b"proto", b"user@host1")
+        # Then:
+        assert len(digest) == 64
+        assert digest == key_kdf.derive(kdf, cost, b"proto", b"user@host1")
+        assert digest != key_kdf.derive(kdf, cost, b"proto2", b"user@host1")
+        assert digest != key_kdf.derive(kdf, cost, b"proto", b"user@host2")
+        if kdf != "sha512":
+            assert digest != key_kdf.derive(kdf, cost + 1, b"proto", b"user@host1")
+    assert key_kdf.derive("sha512", 0, b"proto", b"user@host1") == hashlib.sha512(b"protouser@host1").digest()
+
+
+def test_passwords_by_kdf():
+    # Given the same Password with each KDF:
+    pw_objs = [Password("nick", "user", "host", kdf=kdf, kdf_cost=cost) for kdf, cost in _LOW_COSTS.items()]
+    # When/then: the default is unchanged, the others all differ, and batches agree:
+    passwords = [pw_obj.calculate_password("proto") for pw_obj in pw_objs]
+    assert passwords[0] == Password("nick", "user", "host").calculate_password("proto")
+    assert len(set(passwords)) == len(passwords)
+    assert Password.calculate_passwords("proto", pw_objs) == passwords
+
+
+@raises(ValueError)
+def test_unknown_kdf():
+    key_kdf.check_cost("md5", 0)
+
+
+@raises(ValueError)
+def test_cost_too_low():
+    key_kdf.check_cost("pbkdf2-sha512", 10)
+
+
+def test_scrypt_cost_limit():
+    # Given the highest scrypt cost that's accepted:
+    max_cost = key_kdf._MAX_SCRYPT_COST
+    key_kdf.check_cost("scrypt", max_cost)
+    # Then hashlib accepts its memory limit (checked with a cheap N, since the real one needs 512 MiB):
+    hashlib.scrypt(b"proto", salt=b"user@host1", n=2, r=8, p=1, maxmem=key_kdf._scrypt_maxmem(max_cost))
+    # And the next cost up, whose memory limit hashlib would refuse, is rejected:
+    try:
+        key_kdf.check_cost("scrypt", max_cost + 1)
+        assert False, "accepted scrypt cost %d" % (max_cost + 1)
+    except ValueError:
+        pass
+
+
+def test_calibrate():
+    # Given/when:
+    cost, measured_ms = key_kdf.calibrate("pbkdf2-sha512", target_ms=5)
+    # Then:
+    key_kdf.check_cost("pbkdf2-sha512", cost)
+    assert measured_ms > 0
+    assert key_kdf.calibrate("scrypt", target_ms=1)[0] >= 10
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Nothing is recorded while metrics are off
+- Timings and counters for PasswordDB and password calculation
+- Spans in the trace file, with their parents
+- Generator spans, interleaved, abandoned and closed on another thread
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+import nose
+from keymaster import key_metrics
+from keymaster.key_password import Password
+from keymaster.key_password import PasswordDB
+
+
+def _use_db():
+    pass_db = PasswordDB(":memory:", True)
+    pass_db.create_new_password(Password("nick", "user", "host"))
+    pass_db.find_password("nick").calculate_password("proto")
+    assert list(pass_db.iter_nicks()) == ["nick"]
+    pass_db.close_db()
+
+
+def test_disabled():
+    # Given:
+    key_metrics.reset()
+    # When:
+    _use_db()
+    # Then:
+    assert key_metrics.snapshot() == {"counters": {}, "timings": {}}
+
+
+def test_enabled():
+    # Given:
+    key_metrics.reset()
+    key_metrics.enable()
+    # When:
+    try:
+        _use_db()
+        _use_db()
+    finally:
+        key_metrics.disable()
+    stats = key_metrics.snapshot()
+    # Then:
+    assert stats["timings"]["PasswordDB.create_new_password"]["count"] == 2
+    assert stats["timings"]["BasePassword.calculate_password"]["count"] == 2
+    assert stats["timings"]["PasswordDB.iter_nicks"]["count"] == 2
+    assert stats["timings"]["sqlite.commit"]["count"] >= 2
+    timing = stats["timings"]["PasswordDB.find_password"]
+    assert timing["min_ms"] <= timing["p50_ms"] <= timing["p95_ms"] <= timing["max_ms"]
+    assert stats["counters"]["sqlite.statements"] > 4
+    assert "PasswordDB.find_password" in key_metrics.format_summary(stats)
+    key_metrics.reset()
+
+
+def test_trace_file():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        trace_path = os.path.join(tmp_dir, "trace.jsonl")
+        key_metrics.enable(trace_path)
+        # When:
+        try:
+            PasswordDB.get_data(lambda: True, lambda: None, os.path.join(tmp_dir, "test.db"))[0].close_db()
+        finally:
+            key_metrics.disable()
+        # Then:
+        with open(trace_path) as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        parents = {span["name"]: span["parent"] for span in spans}
+        assert parents["PasswordDB.__init__"] == "PasswordDB.get_data"
+        assert parents["PasswordDB.get_data"] is None
+        assert all(span["duration_ms"] >= 0 for span in spans)
+    key_metrics.reset()
+
+
+@key_metrics.instrumented
+def _numbers(count):
+    yield from range(count)
+
+
+@key_metrics.instrumented
+def _call():
+    pass
+
+
+def test_interleaved_generators():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        trace_path = os.path.join(tmp_dir, "trace.jsonl")
+        key_metrics.enable(trace_path)
+        try:
+            # When two generators are interleaved, with a call while they're suspended:
+            first, second = _numbers(3), _numbers(3)
+            assert (next(first), next(second), next(first)) == (0, 0, 1)
+            with key_metrics.span("outer"):
+                _call()
+            assert list(first) == [2]
+            # And one is abandoned, then closed on another thread:
+            thread = threading.Thread(target=second.close)
+            thread.start()
+            thread.join()
+            _call()
+            stack = list(key_metrics._STATE.local.stack)
+        finally:
+            key_metrics.disable()
+        # Then the calls got the right parents, and the generators left nothing on the stack:
+        with open(trace_path) as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        assert [(span["name"], span["parent"]) for span in spans] == [
+            ("_call", "outer"), ("outer", None), ("_numbers", None), ("_numbers", None), ("_call", None)]
+        assert stack == []
+    key_metrics.reset()
+
+
+if __name__ == '__main__':
+    nose.main()
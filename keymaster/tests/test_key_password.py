@@ -5,9 +5,27 @@
 - Password usage, 32-bit, no special chars
 - Password usage, 64-bit, with special chars
 - Password equality
+- Batch password calculation
 - PasswordDB usage, basic functions
+- LazyPasswordDict usage
+- Schema migration of an old database, renaming duplicate nicknames
+- Bulk insert, including rollback on error
+- In-place update, including renames
+- Pooled connections shared by many threads
+- Closing a pool while a connection is in use
+- Timing out waiting for a connection from an exhausted pool
+- Paging through Passwords, and through nicknames containing some text
+- Looking up many nicknames at once
+- Filtered queries, and the indexes they use
+- FrozenPassword hashing, equality, immutability and pickling
 """
 
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+
 import nose
 import keymaster.key_password as pw
 
@@ -46,6 +64,24 @@ def test_pw_equality():
     assert pw1 != pw3
 
 
+def test_batch_calculation():
+    # Given:
+    passwords = [_get_basic_password(), _get_basic_password(True, 2), _get_basic_password(False, 3)]
+    proto_pw = "proto"
+    # When:
+    batch = pw.Password.calculate_passwords(proto_pw, passwords)
+    # Then:
+    assert batch == [password.calculate_password(proto_pw) for password in passwords]
+    assert pw.Password.calculate_passwords("", passwords)[:2] == ["5wjDnwdyj4uxZd6g", "$ifZ6kv@p9xmyf(1"]
+    assert pw.Password.calculate_passwords(proto_pw, []) == []
+    # And for every kind of start and finish (within, across and past the whole base 32 groups):
+    passwords = [pw.Password(_NICK, "user", "host", special_char, base, 1, "", start, finish)
+                 for base in (32, 64) for special_char in (False, True)
+                 for start in range(-2, 106, 5) for finish in range(-2, 110, 7)]
+    assert pw.Password.calculate_passwords(proto_pw, passwords) \
+        == [password.calculate_password(proto_pw) for password in passwords]
+
+
 def test_basic_pwdb_usage():
     # Empty DB:
     pdb = pw.PasswordDB(":memory:", True)
@@ -68,6 +104,304 @@ def test_basic_pwdb_usage():
     assert pdb.get_list_of_nicks() == []
 
 
+def test_lazy_password_dict():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    password1 = _get_basic_password()
+    password2 = pw.Password("another", "user2", "host2")
+    pdb.create_new_password(password1)
+    pdb.create_new_password(password2)
+    # When:
+    pdic = pw.LazyPasswordDict(pdb)
+    # Then lookups go to the db:
+    assert len(pdic) == 2
+    assert _NICK in pdic
+    assert "missing" not in pdic
+    assert pdic[_NICK] == password1
+    assert pdic.get("missing") is None
+    assert list(pdic) == ["another", _NICK]
+    assert list(pdic.items()) == [("another", password2), (_NICK, password1)]
+    # And deleting from the db and the dict removes the entry:
+    pdb.delete_password(_NICK)
+    del pdic[_NICK]
+    assert _NICK not in pdic
+    assert len(pdic) == 1
+
+
+def test_bulk_insert():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    passwords = [pw.Password("nick%03d" % i, "user", "host") for i in range(25)]
+    # When:
+    count = pdb.bulk_insert(iter(passwords), chunk_size=10)
+    # Then:
+    assert count == 25
+    assert pdb.get_list_of_nicks() == [password.nickname for password in passwords]
+    # And a duplicate in a later chunk rolls back the whole batch:
+    try:
+        pdb.bulk_insert([pw.Password("new")] * 2, chunk_size=1)
+        assert False, "duplicate nickname was inserted"
+    except sqlite3.IntegrityError:
+        pass
+    assert pdb.count_passwords() == 25
+
+
+def test_update_in_place():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.create_new_password(_get_basic_password())
+    pdb.create_new_password(pw.Password("other"))
+    renamed = pw.Password("renamed", "user2", "host2", iteration=2)
+    # When/then:
+    assert pdb.update_old_password(_NICK, renamed)
+    assert pdb.get_list_of_nicks() == ["other", "renamed"]
+    assert pdb.get_password_for_nick("renamed") == renamed
+    assert not pdb.update_old_password("missing", pw.Password("missing"))
+    assert pdb.get_list_of_nicks() == ["other", "renamed"]
+    # And renaming onto an existing nickname fails without changing anything:
+    try:
+        pdb.update_old_password("renamed", pw.Password("other"))
+        assert False, "duplicate nickname was inserted"
+    except sqlite3.IntegrityError:
+        pass
+    assert pdb.get_password_for_nick("renamed") == renamed
+
+
+def test_migrate_old_db():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given an unversioned database with a duplicated nickname:
+        db_path = os.path.join(tmp_dir, "old.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute(pw._CREATE_PASSWORDS_TABLE_SCHEMA)
+        insert_v0 = "insert into passwords values(?,?,?,?,?,?,?,?,?);"
+        conn.execute(insert_v0, (_NICK, "old", "host", False, 32, 1, "hint", 0, 15))
+        conn.execute(insert_v0, (_NICK, "user", "host", False, 32, 1, "hint", 0, 15))
+        conn.execute(insert_v0, ("other", "user", "host", False, 32, 1, "hint", 0, 15))
+        conn.commit()
+        conn.close()
+        # When we open it:
+        pdb = pw.PasswordDB(db_path, False)
+        # Then it's migrated, the newest row keeping a duplicated nickname and the older one renamed:
+        assert pdb.get_schema_version() == pw.SCHEMA_VERSION
+        assert pdb.get_list_of_nicks() == [_NICK, _NICK + " (2)", "other"]
+        assert pdb.get_password_for_nick(_NICK) == _get_basic_password()
+        assert pdb.get_password_for_nick(_NICK).kdf == "sha512"
+        assert pdb.get_password_for_nick(_NICK + " (2)") == pw.Password(_NICK + " (2)", "old", "host", False, 32,
+                                                                        1, "hint", 0, 15)
+        # And the db itself now refuses duplicate nicknames:
+        try:
+            pdb.create_new_password(_get_basic_password())
+            assert False, "duplicate nickname was inserted"
+        except sqlite3.IntegrityError:
+            pass
+        pdb.close_db()
+        # And re-opening doesn't migrate again:
+        assert pw.PasswordDB(db_path, False).get_list_of_nicks() == [_NICK, _NICK + " (2)", "other"]
+
+
+def test_migrate_old_db_with_taken_name():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given an unversioned database where the name for a duplicate's older row is taken:
+        db_path = os.path.join(tmp_dir, "old.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute(pw._CREATE_PASSWORDS_TABLE_SCHEMA)
+        insert_v0 = "insert into passwords values(?,?,?,?,?,?,?,?,?);"
+        for nick in (_NICK, _NICK, _NICK + " (2)"):
+            conn.execute(insert_v0, (nick, "user", "host", False, 32, 1, "hint", 0, 15))
+        conn.commit()
+        conn.close()
+        # When we open it:
+        try:
+            pw.PasswordDB(db_path, False)
+            assert False, "migrated with a taken name"
+        except sqlite3.IntegrityError:
+            pass
+        # Then the database is left as it was:
+        conn = sqlite3.connect(db_path)
+        assert conn.execute(pw._SQL_GET_SCHEMA_VERSION).fetchone()[0] == 0
+        assert conn.execute("select count(*) from passwords;").fetchone()[0] == 3
+        conn.close()
+
+
+def test_pooled_threads():
+    for in_memory in (False, True):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Given a pooled database (on disk or in memory) with a few passwords:
+            db_path = ":memory:" if in_memory else os.path.join(tmp_dir, "pooled.db")
+            pdb = pw.PasswordDB(db_path, True, pool_size=3)
+            pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(100))
+            errors = []
+            # When 8 threads read and write at once:
+            def _work(thread_num):
+                try:
+                    for i in range(20):
+                        assert pdb.get_password_for_nick("nick%d" % i).username == "user"
+                        pdb.create_new_password(pw.Password("t%d-%d" % (thread_num, i), "u", "h"))
+                        assert len(list(pdb.iter_nicks(batch_size=7))) >= 100 + i + 1
+                except Exception as exc:    # pylint: disable=broad-except
+                    errors.append(exc)
+            threads = [threading.Thread(target=_work, args=(n,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Then everything worked and was written, using no more than pool_size connections
+            # (plus the one the PasswordDB keeps open):
+            assert errors == []
+            assert pdb.count_passwords() == 100 + 8 * 20
+            assert len(pdb._pool._all) <= 3 + 1
+            pdb.close_db()
+
+
+def test_exhausted_pool():
+    # Given a pool whose only connection is held by a row iterator that was abandoned part-way:
+    pdb = pw.PasswordDB(":memory:", True, pool_size=1, timeout=0.2)
+    pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(100))
+    nicks = pdb.iter_nicks(batch_size=10)
+    next(nicks)
+    errors = []
+
+    def _count():
+        try:
+            pdb.count_passwords()
+        except sqlite3.OperationalError as err:
+            errors.append(err)
+    # When another thread wants a connection:
+    thread = threading.Thread(target=_count, daemon=True)
+    thread.start()
+    thread.join(10)
+    # Then it gives up after the timeout instead of waiting forever:
+    assert not thread.is_alive()
+    assert len(errors) == 1
+    # And once the iterator is closed, the connection is free again:
+    nicks.close()
+    assert pdb.count_passwords() == 100
+    pdb.close_db()
+
+
+def test_close_pool_in_use():
+    # Given a pooled database that another thread is reading from:
+    pdb = pw.PasswordDB(":memory:", True, pool_size=2)
+    pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(100))
+    nicks = pdb.iter_nicks(batch_size=10)
+    reading, closed, results = threading.Event(), threading.Event(), []
+
+    def _read():
+        results.append(next(nicks))
+        reading.set()
+        closed.wait()
+        results.extend(nicks)
+    thread = threading.Thread(target=_read)
+    thread.start()
+    reading.wait()
+    # When the database is closed:
+    pdb.close_db()
+    closed.set()
+    thread.join()
+    # Then the reader finishes with its connection, which is closed when it's returned:
+    assert len(results) == 100
+    assert pdb._pool._all == []
+    try:
+        pdb.count_passwords()
+        assert False, "used a closed pool"
+    except sqlite3.ProgrammingError:
+        pass
+
+
+def test_passwords_page():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host") for i in range(5))
+    # When/then:
+    assert [pw_obj.nickname for pw_obj in pdb.get_passwords_page(limit=2)] == ["nick0", "nick1"]
+    assert [pw_obj.nickname for pw_obj in pdb.get_passwords_page("nick1", 10)] == ["nick2", "nick3", "nick4"]
+    assert pdb.get_passwords_page("nick4") == []
+
+
+def test_nicks_page_containing():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password(nick) for nick in ("Bank", "mybank", "mail", "bankrupt", "other"))
+    # When/then only the nicknames containing the text (in any case) are paged through:
+    assert pdb.get_nicks_page(limit=2, containing="BANK") == ["Bank", "bankrupt"]
+    assert pdb.get_nicks_page("bankrupt", 2, containing="bank") == ["mybank"]
+    assert pdb.get_nicks_page(containing="") == pdb.get_list_of_nicks()
+    assert pdb.get_nicks_page(containing="nope") == []
+
+
+def test_find_passwords():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%d" % i, "user", "host%d" % i) for i in range(20))
+    # When:
+    found = pdb.find_passwords(["nick3", "nope", "nick17", "nick3"], chunk_size=2)
+    # Then:
+    assert found == {"nick3": pdb.find_password("nick3"), "nick17": pdb.find_password("nick17")}
+    assert pdb.find_passwords([]) == {}
+
+
+def test_query():
+    # Given:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.bulk_insert(pw.Password("nick%02d" % i, "user%d" % (i % 3), "host%d" % (i % 4), i % 2 == 0,
+                                (32, 64)[i % 5 == 0], 1 + i // 20) for i in range(50))
+    every = list(pdb.iter_password_objects())
+
+    def matching(pred):
+        return [pw_obj for pw_obj in every if pred(pw_obj)]
+    # When/then: each filter, and several together, match what filtering in Python does:
+    assert list(pdb.query(host="host1")) == matching(lambda p: p.hostname == "host1")
+    assert list(pdb.query(user="user2", special=False)) == matching(lambda p: p.username == "user2" and
+                                                                    not p.special_char)
+    assert list(pdb.query(base=64, special=True, host=None)) == matching(lambda p: p.base == 64 and p.special_char)
+    assert list(pdb.query(iteration_gt=2)) == matching(lambda p: p.iteration > 2)
+    assert list(pdb.query(host="host3", iteration_gt=1, limit=3, offset=1)) == \
+        matching(lambda p: p.hostname == "host3" and p.iteration > 1)[1:4]
+    assert list(pdb.query(host="nope")) == []
+    assert list(pdb.query()) == every
+    assert pdb.get_passwords_page("nick10", 2, user="user0") == matching(lambda p: p.username == "user0" and
+                                                                         p.nickname > "nick10")[:2]
+    # And they use the indexes:
+    for filters in ({"host": "host1"}, {"user": "user1"}, {"iteration_gt": 2}):
+        where, order_by, params = pw._compile_filters(filters)
+        plan = pdb.conn.execute("explain query plan " + pw._SQL_QUERY_PASS.format(where, order_by),
+                                params + [-1, 0]).fetchall()
+        assert "USING INDEX passwords_" in plan[0][3], plan
+    try:
+        list(pdb.query(hostname="host1"))
+        assert False, "unknown filter accepted"
+    except TypeError:
+        pass
+
+
+def test_frozen_password():
+    # Given:
+    password = _get_basic_password()
+    frozen = pw.FrozenPassword(*password.fields())
+    # Then it's equal to the Password, calculates the same, and can be hashed and pickled:
+    assert frozen == password and password == frozen
+    assert frozen != pw.FrozenPassword(*password.fields()[:8], finish=14)
+    assert str(frozen) == str(password)
+    assert frozen.calculate_password("proto") == password.calculate_password("proto")
+    assert len({frozen, pw.FrozenPassword(*password.fields())}) == 1
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+    # But it can't be changed:
+    for change in (lambda: setattr(frozen, "hint", "new"), lambda: delattr(frozen, "hint"),
+                   lambda: setattr(frozen, "extra", 1)):
+        try:
+            change()
+            assert False, "FrozenPassword was changed"
+        except AttributeError:
+            pass
+    # And the db's bulk reads return FrozenPasswords:
+    pdb = pw.PasswordDB(":memory:", True)
+    pdb.create_new_password(password)
+    assert isinstance(pdb.get_all_password_objects()[_NICK], pw.FrozenPassword)
+    assert pdb.get_all_password_objects() == {_NICK: password}
+    pdb.delete_password(frozen)
+    assert pdb.count_passwords() == 0
+
+
 def _get_basic_password(special=False, iteration_num=1):
     """Return a basic Password object based on whether to use special
     chars and the specified iteration number.
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Bare and explicit --profile arguments
+- Writing a profile, including when the block exits with an error
+"""
+
+import argparse
+from io import StringIO
+import os
+import pstats
+import sys
+import tempfile
+
+import nose
+from keymaster import key_profile
+
+
+def _parse(command_line):
+    parser = argparse.ArgumentParser()
+    key_profile.add_profile_arg(parser)
+    parser.add_argument("command", nargs="?")
+    return parser.parse_args(key_profile.expand_bare_profile_arg(command_line))
+
+
+def test_profile_args():
+    # When/then: a bare --profile doesn't take the next argument as its path:
+    assert vars(_parse(["--profile", "list"])) == {"profile": key_profile.DEFAULT_PROFILE_PATH, "command": "list"}
+    assert vars(_parse(["--profile=out.prof", "list"])) == {"profile": "out.prof", "command": "list"}
+    assert vars(_parse(["list"])) == {"profile": None, "command": "list"}
+
+
+def test_profiled():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        profile_path = os.path.join(tmp_dir, "test.prof")
+        save_stderr, sys.stderr = sys.stderr, StringIO()
+        # When a profiled block exits:
+        try:
+            with key_profile.profiled(profile_path):
+                sorted(range(1000))
+                sys.exit(1)
+        except SystemExit:
+            pass
+        finally:
+            sys.stderr = save_stderr
+        # Then the profile was still written:
+        stats = pstats.Stats(profile_path)
+        assert any(func[2] == "<built-in method builtins.sorted>" for func in stats.stats)
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Ranked fuzzy search by nickname, username and hostname
+- Keeping the index current with add and remove
+"""
+
+import nose
+from keymaster.key_password import Password
+from keymaster.key_search import NicknameIndex
+
+
+def _get_index():
+    """An index over a few Passwords."""
+    return NicknameIndex([Password("bank", "moy", "bigmoneybank.com"),
+                          Password("bank-old", "moy", "oldbank.com"),
+                          Password("fbi", "agent", "login.fbi.gov"),
+                          Password("whitehouse", "president", "whitehouse.gov")])
+
+
+def test_search_ranking():
+    # Given:
+    index = _get_index()
+    # When/then: exact and near-exact nicknames come first:
+    assert index.search("bank")[:2] == ["bank", "bank-old"]
+    assert index.search("whitehuose")[0] == "whitehouse"
+    # usernames and hostnames match too:
+    assert index.search("president")[0] == "whitehouse"
+    assert index.search("fbi.gov")[0] == "fbi"
+    # and we get at most num_matches:
+    assert len(index.search("bank", 1)) == 1
+    assert index.search("") == ["bank", "bank-old", "fbi", "whitehouse"]
+    assert index.search("zzzz") == []
+
+
+def test_add_and_remove():
+    # Given:
+    index = _get_index()
+    # When:
+    index.remove("bank")
+    index.add(Password("fbi", "agent", "newlogin.fbi.gov"))
+    index.add(Password("bank2", "moy", "bank2.com"))
+    # Then:
+    assert len(index) == 4
+    assert "bank" not in index.search("bank")
+    assert index.search("bank2")[0] == "bank2"
+    assert index.search("newlogin") == ["fbi"]
+    index.remove("not-there")
+
+
+if __name__ == '__main__':
+    nose.main()
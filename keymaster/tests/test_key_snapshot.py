@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Writing a snapshot and looking passwords up in it
+- PasswordDB uses its snapshot only while the database is unchanged
+- A new snapshot written over the old one is picked up
+- Files that aren't snapshots are rejected
+"""
+
+import os
+import tempfile
+
+import nose
+from nose.tools import raises
+from keymaster import key_metrics
+from keymaster import key_snapshot
+from keymaster.key_password import Password
+from keymaster.key_password import PasswordDB
+
+
+def _create_db(tmp_dir, count=10):
+    """A db (on disk, since snapshots need a file) with a few passwords, one with a non-ASCII nickname."""
+    pass_db = PasswordDB(os.path.join(tmp_dir, "passwords.db"), True)
+    pass_db.bulk_insert(Password("nick%d" % i, "user%d" % (i % 2), "host%d" % (i % 3), i % 2 == 0,
+                                 (32, 64)[i % 2], 1 + i % 4, "hint", 0, 15) for i in range(count))
+    pass_db.create_new_password(Password("ñick", "usér", "høst", kdf="scrypt", kdf_cost=10))
+    return pass_db
+
+
+def _snapshot_hits(func):
+    """Call func and count how many lookups it answered from a snapshot."""
+    key_metrics.reset()
+    key_metrics.enable()
+    try:
+        func()
+    finally:
+        key_metrics.disable()
+    return key_metrics.snapshot()["counters"].get("snapshot.hits", 0)
+
+
+def test_write_and_find():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        pass_db = _create_db(tmp_dir)
+        path = os.path.join(tmp_dir, "other.snapshot")
+        # When:
+        count = pass_db.write_snapshot(path)
+        snapshot = key_snapshot.Snapshot(path)
+        # Then the snapshot has the same rows, in order, and finds each one:
+        assert count == len(snapshot) == 11
+        assert list(snapshot.iter_rows()) == list(pass_db.iter_password_rows())
+        for row in pass_db.iter_password_rows():
+            assert snapshot.find(row[0]) == row
+        assert Password(*snapshot.find("ñick")) == pass_db.get_password_for_nick("ñick")
+        assert snapshot.find("nick") is None
+        assert snapshot.find("zzz") is None
+        assert snapshot.find("") is None
+        snapshot.close()
+        pass_db.close_db()
+
+
+def test_db_uses_fresh_snapshot():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given a db with a snapshot next to it:
+        pass_db = _create_db(tmp_dir)
+        pass_db.write_snapshot()
+        expected = pass_db.get_password_for_nick("nick3")
+        # When/then: lookups are answered from the snapshot:
+        assert _snapshot_hits(lambda: pass_db.find_password("nick3")) == 1
+        assert pass_db.find_password("nick3") == expected
+        assert pass_db.find_password("nope") is None
+        assert _snapshot_hits(lambda: pass_db.find_passwords(["nick3", "nope"])) == 1
+        assert pass_db.find_passwords(["nick3", "nope"]) == {"nick3": expected}
+        assert pass_db.count_passwords() == 11
+        # And a new PasswordDB for the same file finds the snapshot too:
+        other_db = PasswordDB(pass_db.db_name, False)
+        assert _snapshot_hits(lambda: other_db.find_password("nick3")) == 1
+        # But once the db changes (here through the other connection) they go back to SQLite:
+        other_db.update_old_password("nick3", Password("nick3", "new user", "new host"))
+        assert _snapshot_hits(lambda: pass_db.find_password("nick3")) == 0
+        assert pass_db.find_password("nick3").username == "new user"
+        other_db.delete_password("nick4")
+        assert pass_db.find_password("nick4") is None
+        assert pass_db.count_passwords() == 10
+        other_db.close_db()
+        pass_db.close_db()
+
+
+def test_new_snapshot_is_picked_up():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given a db whose snapshot is stale:
+        pass_db = _create_db(tmp_dir)
+        pass_db.write_snapshot()
+        pass_db.delete_password("nick1")
+        other_db = PasswordDB(pass_db.db_name, False)
+        assert _snapshot_hits(lambda: other_db.find_password("nick2")) == 0
+        # When another process writes a new one:
+        pass_db.write_snapshot()
+        # Then it's used:
+        assert _snapshot_hits(lambda: other_db.find_password("nick2")) == 1
+        assert other_db.find_password("nick1") is None
+        other_db.close_db()
+        pass_db.close_db()
+
+
+@raises(ValueError)
+def test_not_a_snapshot():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "passwords.db.snapshot")
+        with open(path, "wb") as out_file:
+            out_file.write(b"\0" * 100)
+        key_snapshot.Snapshot(path)
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# pylint: disable=missing-docstring
+
+"""Tests included:
+- Changes are stamped, and deletes and renames leave tombstones
+- Syncing two databases sends only what's changed since the last sync
+- Conflicts end the same way on every replica
+- Syncing through a directory
+- Copies with the same replica id
+"""
+
+import os
+import tempfile
+
+import nose
+from nose.tools import raises
+from keymaster import key_sync
+from keymaster.key_password import Password
+from keymaster.key_password import PasswordDB
+
+
+def _open(tmp_dir, name, count=0):
+    pass_db = PasswordDB(os.path.join(tmp_dir, name + ".db"), True)
+    pass_db.bulk_insert(Password("nick%d" % i, "user", "host") for i in range(count))
+    return pass_db
+
+
+def _rows(pass_db):
+    return list(pass_db.iter_password_rows())
+
+
+def test_change_log():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given:
+        pass_db = _open(tmp_dir, "a", count=3)
+        replica_id, seq = pass_db.get_sync_state()
+        # When:
+        pass_db.create_new_password(Password("new"))
+        pass_db.update_old_password("nick0", Password("renamed"))
+        pass_db.delete_password("nick1")
+        # Then each change is stamped after the bulk insert, with tombstones for the delete and rename:
+        changes = list(pass_db.iter_changes(seq))
+        assert [change[1:5] for change in changes] == [("new", 3, replica_id, 0), ("nick0", 4, replica_id, 1),
+                                                       ("renamed", 4, replica_id, 0), ("nick1", 5, replica_id, 1)]
+        assert changes[2][5] == pass_db.find_password("renamed").fields()
+        assert changes[1][5] is None
+        assert pass_db.get_sync_state()[1] == changes[-1][0]
+        assert len(list(pass_db.iter_changes())) == 5     # only the latest change to each nickname is kept
+        pass_db.close_db()
+
+
+def test_sync_two_dbs():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given two replicas with different passwords:
+        db_a, db_b = _open(tmp_dir, "a", count=100), _open(tmp_dir, "b")
+        db_b.create_new_password(Password("from_b"))
+        # When they sync, each gets the other's:
+        assert key_sync.sync_with_db(db_a, db_b) == (1, 1, 100, 100)
+        assert _rows(db_a) == _rows(db_b)
+        assert len(_rows(db_a)) == 101
+        # Then syncing again sends nothing, and later only the changes are sent:
+        assert key_sync.sync_with_db(db_b, db_a) == (0, 0, 0, 0)
+        db_a.delete_password("nick5")
+        db_b.update_old_password("nick6", Password("nick6", "new user"))
+        assert key_sync.sync(db_b, db_a.db_name) == (1, 1, 1, 1)
+        assert db_b.find_password("nick5") is None
+        assert db_a.find_password("nick6").username == "new user"
+        assert _rows(db_a) == _rows(db_b)
+        db_a.close_db()
+        db_b.close_db()
+
+
+def test_conflicts():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given three synced replicas:
+        dbs = [_open(tmp_dir, "a", count=5), _open(tmp_dir, "b"), _open(tmp_dir, "c")]
+        key_sync.sync_with_db(dbs[0], dbs[1])
+        key_sync.sync_with_db(dbs[0], dbs[2])
+        # When each changes the same password (and one deletes another that one updates):
+        for pos, pass_db in enumerate(dbs):
+            pass_db.update_old_password("nick1", Password("nick1", "user%d" % pos))
+        dbs[0].delete_password("nick2")
+        dbs[1].update_old_password("nick2", Password("nick2", "still here"))
+        # Then after syncing in any order they all agree:
+        key_sync.sync_with_db(dbs[2], dbs[1])
+        key_sync.sync_with_db(dbs[1], dbs[0])
+        key_sync.sync_with_db(dbs[0], dbs[2])
+        key_sync.sync_with_db(dbs[2], dbs[1])
+        assert _rows(dbs[0]) == _rows(dbs[1]) == _rows(dbs[2])
+        winner = max(dbs, key=lambda pass_db: pass_db.get_sync_state()[0])
+        assert dbs[0].find_password("nick1").username == "user%d" % dbs.index(winner)
+        for pass_db in dbs:
+            pass_db.close_db()
+
+
+def test_sync_through_dir():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given a sync directory and three replicas:
+        sync_dir = os.path.join(tmp_dir, "sync")
+        os.mkdir(sync_dir)
+        db_a, db_b, db_c = _open(tmp_dir, "a", count=10), _open(tmp_dir, "b"), _open(tmp_dir, "c")
+        # When they each sync (a twice, to get the others' changes):
+        db_b.create_new_password(Password("from_b"))
+        assert key_sync.sync(db_a, sync_dir) == (0, 0, 10, None)
+        assert key_sync.sync(db_b, sync_dir) == (10, 10, 1, None)
+        assert key_sync.sync(db_c, sync_dir) == (11, 11, 0, None)
+        assert key_sync.sync(db_a, sync_dir) == (1, 1, 0, None)
+        # Then they all agree, and later syncs only read and write what's changed:
+        assert _rows(db_a) == _rows(db_b) == _rows(db_c)
+        db_c.delete_password("nick3")
+        assert key_sync.sync(db_c, sync_dir) == (0, 0, 1, None)
+        assert key_sync.sync(db_a, sync_dir) == (1, 1, 0, None)
+        assert db_a.find_password("nick3") is None
+        for pass_db in (db_a, db_b, db_c):
+            pass_db.close_db()
+
+
+def test_copied_db():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Given a copy of a replica's file:
+        db_a = _open(tmp_dir, "a", count=3)
+        db_a.close_db()
+        with open(os.path.join(tmp_dir, "a.db"), "rb") as in_file, \
+                open(os.path.join(tmp_dir, "copy.db"), "wb") as out_file:
+            out_file.write(in_file.read())
+        db_a, db_copy = PasswordDB(os.path.join(tmp_dir, "a.db"), False), PasswordDB(out_file.name, False)
+        # When/then: they can't sync until the copy gets a new replica id:
+        try:
+            key_sync.sync_with_db(db_copy, db_a)
+            assert False, "synced replicas with the same id"
+        except ValueError:
+            pass
+        db_copy.new_replica_id()
+        db_copy.create_new_password(Password("new"))
+        assert key_sync.sync_with_db(db_copy, db_a)[2:] == (1, 1)     # the copied rows came from db_a
+        assert _rows(db_a) == _rows(db_copy)
+        db_a.close_db()
+        db_copy.close_db()
+
+
+@raises(FileNotFoundError)
+def test_missing_peer():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_sync.sync(_open(tmp_dir, "a"), os.path.join(tmp_dir, "nope.db"))
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -8,6 +8,7 @@ pylint --max-line-length=120 --extension-pkg-whitelist=PyQt5 key_qt_edit.py
 
 import sys
 from PyQt5 import QtCore, QtWidgets
+from keymaster.key_kdf import DEFAULT_KDF
 from keymaster.key_password import Password
 from keymaster.ui.ui_edit import Ui_edit_form
 
@@ -22,6 +23,7 @@ class EditController(QtWidgets.QDialog):
         self.ui = Ui_edit_form()
         self.ui.setupUi(self)
         self.orig_nick = ""
+        self.kdf, self.kdf_cost = DEFAULT_KDF, None     # not on the form, but kept when updating
         self.update_flag = False
         self.dirty_flag = False
         self.setWindowTitle("Create new password object")
@@ -43,6 +45,7 @@ class EditController(QtWidgets.QDialog):
 
     def clear(self):
         self.orig_nick = ""
+        self.kdf, self.kdf_cost = DEFAULT_KDF, None
         self.ui.lineedit_nickname.clear()
         self.ui.lineedit_username.clear()
         self.ui.lineedit_hostname.clear()
@@ -101,6 +104,7 @@ class EditController(QtWidgets.QDialog):
     def populate_form_from_password(self, pw_obj):
         """Populate myself with info from existing Password object."""
         self.orig_nick = pw_obj.nickname
+        self.kdf, self.kdf_cost = pw_obj.kdf, pw_obj.kdf_cost
         self.ui.lineedit_nickname.setText(pw_obj.nickname)
         self.ui.lineedit_username.setText(pw_obj.username)
         self.ui.lineedit_hostname.setText(pw_obj.hostname)
@@ -123,7 +127,9 @@ class EditController(QtWidgets.QDialog):
             int(self.ui.spinbox_iteration.value()),
             str(self.ui.lineedit_hint.text()),
             int(self.ui.spinbox_substring_start.value()),
-            int(self.ui.spinbox_substring_end.value()))
+            int(self.ui.spinbox_substring_end.value()),
+            self.kdf,
+            self.kdf_cost)
 
 
 def main():
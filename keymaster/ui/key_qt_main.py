@@ -7,10 +7,14 @@ pylint --max-line-length=120 --extension-pkg-whitelist=PyQt5 key_qt_main.py
 """
 
 import argparse
+from bisect import bisect_left
 import sys
 
+from PyQt5 import QtCore
 from PyQt5 import QtWidgets
 
+from keymaster import key_profile
+from keymaster.key_cache import DerivationCache
 from keymaster.key_password import DEFAULT_DB_PATH
 from keymaster.key_password import PasswordDB
 from keymaster.ui.key_qt_edit import EditController
@@ -20,37 +24,123 @@ from keymaster.ui.ui_main import Ui_main_form
 _AVAILABLE_BASES = ["32", "64"]
 _NICKNAMES_LIST_HEADER = "--Please select one of the following--"
 _SELECTION_ERROR = "Please select a valid entry from the list of passwords."
+_NICKNAMES_PAGE_SIZE = 500
+_MAX_FILTERED_NICKNAMES = 200   # completions shown for what's typed; typing more narrows them down
+_CACHE_EXPIRY_INTERVAL_MS = 1000
+
+
+class PasswordListModel(QtCore.QAbstractListModel):
+    """Sorted list of the nicknames in a PasswordDB, fetched a page at a time
+    as views scroll through it.  Creates and deletes are applied a row at a
+    time with add_nickname and remove_nickname.
+
+    With containing (see set_containing), it's just the first page of the
+    nicknames that contain that text, as found by the database.  (This is for
+    a QCompleter, which fetches everything its model has.)
+    """
+    def __init__(self, pass_db, page_size=_NICKNAMES_PAGE_SIZE, parent=None, containing=None):
+        super().__init__(parent)
+        self.pass_db = pass_db
+        self.page_size = page_size
+        self.containing = containing
+        self._nicks = []
+        self._total = pass_db.count_passwords()
+        self.fetchMore(QtCore.QModelIndex())
+
+    def total(self):
+        """Number of nicknames, including any not fetched yet (and any that don't contain containing)."""
+        return self._total
+
+    def set_containing(self, containing):
+        """Start again with just the nicknames that contain containing (or all of them if it's None)."""
+        self.beginResetModel()
+        self.containing, self._nicks = containing, []
+        self.endResetModel()
+        self.fetchMore(QtCore.QModelIndex())
+
+    def rowCount(self, parent=QtCore.QModelIndex()):   # pylint: disable=invalid-name
+        return 0 if parent.isValid() else len(self._nicks)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if index.isValid() and role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return self._nicks[index.row()]
+        return None
+
+    def canFetchMore(self, parent):                     # pylint: disable=invalid-name
+        return not parent.isValid() and self.containing is None and len(self._nicks) < self._total
+
+    def fetchMore(self, parent):                        # pylint: disable=invalid-name
+        if parent.isValid():
+            return
+        after = self._nicks[-1] if self._nicks else None
+        page = self.pass_db.get_nicks_page(after, self.page_size, self.containing)
+        if page:
+            self.beginInsertRows(QtCore.QModelIndex(), len(self._nicks), len(self._nicks) + len(page) - 1)
+            self._nicks.extend(page)
+            self.endInsertRows()
+        elif self.containing is None:   # someone else deleted passwords; we've got them all
+            self._total = len(self._nicks)
+
+    def add_nickname(self, nickname):
+        """Add a nickname that's just been created in the db."""
+        pos = bisect_left(self._nicks, nickname)
+        all_fetched = not self.canFetchMore(QtCore.QModelIndex())
+        self._total += 1
+        if pos < len(self._nicks) or all_fetched:  # else it's past what we've fetched, and fetchMore will get it
+            self.beginInsertRows(QtCore.QModelIndex(), pos, pos)
+            self._nicks.insert(pos, nickname)
+            self.endInsertRows()
+
+    def remove_nickname(self, nickname):
+        """Remove a nickname that's just been deleted from the db."""
+        pos = bisect_left(self._nicks, nickname)
+        self._total -= 1
+        if pos < len(self._nicks) and self._nicks[pos] == nickname:
+            self.beginRemoveRows(QtCore.QModelIndex(), pos, pos)
+            del self._nicks[pos]
+            self.endRemoveRows()
 
 
 class MainController(QtWidgets.QDialog):
     """Handle communication between the main Qt form and the database."""
-    def __init__(self, app):
+    def __init__(self, app, cache_ttl=0):
         super().__init__()
         self.app = app
         self.ui = Ui_main_form()
         self.edit_form = EditController()
         self.pass_db, self.passwords_dic = None, None
+        self.nicknames_model, self.nicknames_filter = None, None
+        self.derivation_cache, self._cache_timer = None, None
+        if cache_ttl:
+            self.derivation_cache = DerivationCache(cache_ttl)
+            self._cache_timer = QtCore.QTimer(self)
+            self._cache_timer.timeout.connect(self.derivation_cache.expire)
+            self._cache_timer.start(_CACHE_EXPIRY_INTERVAL_MS)
 
     def start(self, pass_db, pass_dic):
         """Real initialization: ui, passwords-list, connect callbacks"""
         self.ui.setupUi(self)
         self.edit_form.start()
-        self._connect_callbacks()
         self.pass_db, self.passwords_dic = pass_db, pass_dic
-        self._populate_pw_nicknames_list()
+        self._setup_pw_nicknames_list()
+        self._connect_callbacks()
+        self._update_pw_nicknames_list()
 
     @staticmethod
-    def create(app, pass_db=None, pass_dic=None, db_path=None):
-        """We're given either (in prod) a db_path that we use to get a pass_db
-        and pass_dic, or (in test) a pre-built pass_db and pass_dic."""
-        main_form = MainController(app)
-        if db_path is not None:
-            pass_db, pass_dic = main_form._get_data(db_path)
+    def create(app, pass_db=None, pass_dic=None, db_paths=None, cache_ttl=0):
+        """We're given either (in prod) db_paths (one or more) that we use to get a pass_db
+        and pass_dic, or (in test) a pre-built pass_db and pass_dic.
+        If cache_ttl is non-zero, calculated passwords are cached for that many seconds."""
+        main_form = MainController(app, cache_ttl)
+        if db_paths is not None:
+            pass_db, pass_dic = main_form._get_data(db_paths)
         main_form.start(pass_db, pass_dic)
         return main_form
 
-    def _get_data(self, db_path):
-        """Create communications methods for the back-end get_data and call it."""
+    def _get_data(self, db_paths):
+        """Create communications methods for the back-end get_data and call it
+        (for a FederatedPasswordDB if we're given several databases).
+        """
         def ask_to_create_new():
             """Ask user if we want to create a new password db."""
             msg_box = QtWidgets.QMessageBox()
@@ -67,11 +157,36 @@ class MainController(QtWidgets.QDialog):
             msg_box.setText("Error opening passwords db.  Exiting.")
             msg_box.setStandardButtons(QtWidgets.QMessageBox.Ok)
             msg_box.exec_()
-        return PasswordDB.get_data(ask_to_create_new, error_getting_db, db_path)
-
-    def _populate_pw_nicknames_list(self):
-        """Populate the main drop-down containing all password nicknames.
-        According to how many items there are, decide which buttons
+        if len(db_paths) > 1:
+            from keymaster.key_federated import FederatedPasswordDB
+            return FederatedPasswordDB.get_data(ask_to_create_new, error_getting_db, db_paths)
+        return PasswordDB.get_data(ask_to_create_new, error_getting_db, db_paths[0])
+
+    def _setup_pw_nicknames_list(self):
+        """Show the nicknames model in the main drop-down.  Typing in the drop-down
+        filters the nicknames shown by its completer (in a second model, whose
+        matches the database finds).
+        """
+        combobox = self.ui.combobox_password_nicknames
+        self.nicknames_model = PasswordListModel(self.pass_db, parent=self)
+        self.nicknames_filter = PasswordListModel(self.pass_db, _MAX_FILTERED_NICKNAMES, self, containing="")
+        combobox.setEditable(True)
+        combobox.setInsertPolicy(QtWidgets.QComboBox.NoInsert)
+        # The completer goes in first: otherwise the combobox makes one for the
+        # nicknames model, which would fetch all of them.
+        completer = QtWidgets.QCompleter(self.nicknames_filter, self)
+        completer.setCompletionMode(QtWidgets.QCompleter.UnfilteredPopupCompletion)
+        combobox.setCompleter(completer)
+        combobox.setModel(self.nicknames_model)
+        combobox.lineEdit().setPlaceholderText(_NICKNAMES_LIST_HEADER)
+
+    def _filter_pw_nicknames(self, text):
+        """Show only (the first _MAX_FILTERED_NICKNAMES) nicknames containing text."""
+        self.nicknames_filter.set_containing(text)
+
+    def _update_pw_nicknames_list(self):
+        """After the nicknames have changed, reset the selection to the single
+        password (if there's only one) or to the header, and decide which buttons
         on the form need to be enabled.
         """
         def _set_widgets_enabled(state):
@@ -80,24 +195,22 @@ class MainController(QtWidgets.QDialog):
                            self.ui.button_get, self.ui.button_hint,
                            self.ui.button_update, self.ui.button_delete]:
                 widget.setEnabled(state)
-        nicknames = sorted(self.passwords_dic.keys())
-        self.ui.combobox_password_nicknames.clear()
-        if len(nicknames) > 1:  # add header and nicknames
-            self.ui.combobox_password_nicknames.addItems([_NICKNAMES_LIST_HEADER])
-        self.ui.combobox_password_nicknames.addItems(nicknames)
-        if nicknames:   # have passwords, can do stuff with them
+        self.nicknames_filter.set_containing(self.nicknames_filter.containing)
+        num_passwords = self.nicknames_model.total()
+        self.ui.combobox_password_nicknames.setCurrentIndex(0 if num_passwords == 1 else -1)
+        if num_passwords:   # have passwords, can do stuff with them
             _set_widgets_enabled(True)
             self.ui.combobox_password_nicknames.setFocus()
-        else:           # no passwords yet, can only create new
+        else:               # no passwords yet, can only create new
             _set_widgets_enabled(False)
             self.ui.button_new.setFocus()
 
-
     def _connect_callbacks(self):
         """Connect ui events to callbacks."""
         self.ui.lineedit_enter_proto.returnPressed.connect(self.get_password)
         self.ui.checkbox_show_password.stateChanged.connect(self.toggle_show_password)
         self.ui.combobox_password_nicknames.currentIndexChanged.connect(self._clear_both)
+        self.ui.combobox_password_nicknames.lineEdit().textEdited.connect(self._filter_pw_nicknames)
         self.ui.button_get.clicked.connect(self.get_password)
         self.ui.button_hint.clicked.connect(self.get_hint)
         self.ui.button_new.clicked.connect(self.create_or_update_password)
@@ -105,9 +218,9 @@ class MainController(QtWidgets.QDialog):
         self.ui.button_delete.clicked.connect(self.delete_password)
 
     def _get_selected(self):
-        """Figure out which password-nick they selected."""
+        """Figure out which password-nick they selected (or typed)."""
         selected_text = str(self.ui.combobox_password_nicknames.currentText())
-        if selected_text != _NICKNAMES_LIST_HEADER:
+        if selected_text in self.passwords_dic:
             return(self.ui.combobox_password_nicknames.currentIndex(), selected_text)
         return(0, None)
 
@@ -139,7 +252,10 @@ class MainController(QtWidgets.QDialog):
             self._display_error(_SELECTION_ERROR)
             return
         proto_pw_1 = str(self.ui.lineedit_enter_proto.text())
-        password = self.passwords_dic[selection].calculate_password(proto_pw_1)
+        if self.derivation_cache is None:
+            password = self.passwords_dic[selection].calculate_password(proto_pw_1)
+        else:
+            password = self.derivation_cache.calculate_password(self.passwords_dic[selection], proto_pw_1)
         self._display_message("Password copied to clipboard:", password)
         self.app.clipboard().setText(password)
         self.ui.combobox_password_nicknames.setFocus()
@@ -184,16 +300,18 @@ class MainController(QtWidgets.QDialog):
                 edit_return = self.edit_form.exec_()
                 if not edit_return:
                     return None, None
-                # Check for valid data: can't have either a blank nickname or one that already exists.
+                # Check for valid data: can't have either a blank nickname or one that already exists
+                # (other than the one we're updating).
                 nickname = str(self.edit_form.ui.lineedit_nickname.text())
                 nickname_is_blank = nickname == ''
-                nickname_already_exists = nickname in self.passwords_dic
-                bad_data_entered = nickname_is_blank or (nickname_already_exists and not is_update)
+                is_unchanged_nickname = is_update and nickname == orig_nickname
+                nickname_already_exists = nickname in self.passwords_dic and not is_unchanged_nickname
+                bad_data_entered = nickname_is_blank or nickname_already_exists
                 if bad_data_entered:
                     msg_box = QtWidgets.QMessageBox()
                     if nickname_is_blank:
                         msg_box.setText('Nickname cannot be blank. Please try again.')
-                    if nickname_already_exists and not is_update:
+                    if nickname_already_exists:
                         msg_box.setText(nickname + ' already exists in password database. Please try again.')
                     msg_box.setStandardButtons(QtWidgets.QMessageBox.Ok)
                     msg_box.setFont(self.font())
@@ -208,10 +326,12 @@ class MainController(QtWidgets.QDialog):
         if is_update:
             self.pass_db.update_old_password(orig_nickname, password)
             del self.passwords_dic[orig_nickname]
+            self.nicknames_model.remove_nickname(orig_nickname)
         else:
             self.pass_db.create_new_password(password)
         self.passwords_dic[password.nickname] = password
-        self._populate_pw_nicknames_list()
+        self.nicknames_model.add_nickname(password.nickname)
+        self._update_pw_nicknames_list()
         self._clear_both()
         return
 
@@ -241,12 +361,15 @@ class MainController(QtWidgets.QDialog):
         if confirmed or confirm_deletion(selection):
             self.pass_db.delete_password(selection)
             del self.passwords_dic[selection]
-            self._populate_pw_nicknames_list()
+            self.nicknames_model.remove_nickname(selection)
+            self._update_pw_nicknames_list()
             self._display_message("STATUS:", selection + " has been deleted.")
 
     def reject(self):
         """User is dismissing the form.  Close up shop before closing app."""
         self.app.clipboard().setText('')
+        if self.derivation_cache is not None:
+            self.derivation_cache.wipe()
         self.pass_db.close_db()
         super().reject()
 
@@ -261,18 +384,23 @@ class MainController(QtWidgets.QDialog):
 def parse_args(command_line):
     """See if user wants a non-default database."""
     parser = argparse.ArgumentParser(description="Manage passwords easily and securely")
-    parser.add_argument("-d", "--db-path", default=DEFAULT_DB_PATH,
-                        help="Alternate passwords-database path")
-    return parser.parse_args(command_line)
+    parser.add_argument("-d", "--db-path", action="append", default=None,
+                        help="Alternate passwords-database path (repeat to use several databases as one)")
+    parser.add_argument("--cache-ttl", type=float, default=0,
+                        help="Seconds to cache calculated passwords for (default: don't cache)")
+    key_profile.add_profile_arg(parser)
+    return parser.parse_args(key_profile.expand_bare_profile_arg(command_line))
 
 
 def main():
     """Really, pylint?"""
     app = QtWidgets.QApplication(sys.argv)
     args = parse_args(sys.argv[1:])
-    main_form = MainController.create(app, db_path=args.db_path)
-    main_form.show()
-    sys.exit(app.exec_())
+    with key_profile.profiled(args.profile):    # until the form is closed
+        main_form = MainController.create(app, db_paths=args.db_path or [DEFAULT_DB_PATH], cache_ttl=args.cache_ttl)
+        main_form.show()
+        exit_code = app.exec_()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
@@ -115,3 +115,17 @@ def test_update():
     assert form.update_flag
     assert form.result() == 1
     assert password == Password(new_nick, new_user, host, iteration=iteration, hint=hint)
+
+
+def test_update_keeps_kdf():
+    """The form has no KDF fields, but updating keeps the password's KDF (and clearing resets it)."""
+    # Given:
+    form = EditController()
+    form.start()
+    form.populate_form_from_password(Password("nick", "user", "host", kdf="scrypt", kdf_cost=12))
+    # When/then:
+    form.ui.lineedit_hint.setText("new hint")
+    assert form.create_password_from_form() == Password("nick", "user", "host", hint="new hint",
+                                                        kdf="scrypt", kdf_cost=12)
+    form.clear()
+    assert form.create_password_from_form().kdf == "sha512"
@@ -8,10 +8,13 @@ import nose
 
 from PyQt5 import QtWidgets
 from PyQt5.QtTest import QTest
+from PyQt5.QtCore import QModelIndex
 from PyQt5.QtCore import Qt
 from keymaster.key_password import Password
 from keymaster.key_password import PasswordDB
 from keymaster.ui.key_qt_main import MainController
+from keymaster.ui.key_qt_main import PasswordListModel
+from keymaster.ui.key_qt_main import parse_args
 
 APP = QtWidgets.QApplication(sys.argv)
 
@@ -63,6 +66,30 @@ def test_get():
     assert len(form.ui.label_resp_body.text()) == FINISH2 + 1 - START2
 
 
+def test_get_cached():
+    """With a derivation cache, a repeated get gives the same password, and closing wipes the cache."""
+    # Given:
+    form = MainController.create(APP, *_get_test_db(), cache_ttl=60)
+    form.ui.combobox_password_nicknames.setCurrentText(NICK2)
+    # When we get the password twice:
+    QTest.mouseClick(form.ui.button_get, Qt.LeftButton)
+    first = form.ui.label_resp_body.text()
+    QTest.mouseClick(form.ui.button_get, Qt.LeftButton)
+    # Then:
+    assert form.ui.label_resp_body.text() == first == form.passwords_dic[NICK2].calculate_password("")
+    assert len(form.derivation_cache) == 1
+    form.reject()
+    assert len(form.derivation_cache) == 0
+
+
+def test_parse_args():
+    """Qt options, including a bare --profile."""
+    args = parse_args(["--profile", "--cache-ttl", "30"])
+    assert (args.profile, args.cache_ttl) == ("keymaster.prof", 30)
+    assert parse_args([]).profile is None
+    assert parse_args(["-d", "ops.db", "-d", "dev.db"]).db_path == ["ops.db", "dev.db"]
+
+
 def test_delete():
     """Use the test db and verify deleting one password."""
     # Given:
@@ -78,6 +105,76 @@ def test_delete():
     assert NICK1 in form.passwords_dic
 
 
+def test_delete_updates_list():
+    """Deleting one of two passwords leaves the other selected."""
+    # Given:
+    form = MainController.create(APP, *_get_test_db())
+    assert form.ui.combobox_password_nicknames.currentText() == ""
+    # When:
+    form.ui.combobox_password_nicknames.setCurrentText(NICK2)
+    form.delete_password(confirmed=True)
+    # Then:
+    assert form.nicknames_model.rowCount() == 1
+    assert form.ui.combobox_password_nicknames.currentText() == NICK1
+
+
+def test_filter():
+    """Typing in the drop-down filters the nicknames."""
+    # Given:
+    form = MainController.create(APP, *_get_test_db())
+    # When:
+    form.ui.combobox_password_nicknames.lineEdit().textEdited.emit("K2")
+    # Then:
+    assert form.nicknames_filter.rowCount() == 1
+    assert form.nicknames_filter.index(0, 0).data() == NICK2
+
+
+def test_filter_fetches_from_db():
+    """Filtering a big db gets the matches from the db, without fetching all the nicknames."""
+    # Given:
+    pass_db = PasswordDB(":memory:", True)
+    pass_db.bulk_insert(Password("nick%04d" % i) for i in range(2000))
+    form = MainController.create(APP, pass_db, {})
+    # When:
+    form.ui.combobox_password_nicknames.lineEdit().textEdited.emit("K19")
+    # Then we have the matches, and just the first page of the full list:
+    assert [form.nicknames_filter.index(row, 0).data() for row in range(form.nicknames_filter.rowCount())] \
+        == ["nick%04d" % i for i in range(1900, 2000)]
+    assert form.nicknames_model.rowCount() < 2000
+    # And a filter only ever gets the first page of matches:
+    model = PasswordListModel(pass_db, page_size=30, containing="k19")
+    assert model.rowCount() == 30 and not model.canFetchMore(QModelIndex())
+    model.set_containing("K199")
+    assert model.rowCount() == 10
+
+
+def test_list_model():
+    """Fetch nicknames a page at a time, adding and removing as we go."""
+    # Given:
+    pass_db = PasswordDB(":memory:", True)
+    pass_db.bulk_insert(Password("nick%02d" % i) for i in range(0, 10, 2))
+    # When:
+    model = PasswordListModel(pass_db, page_size=2)
+    # Then only the first page is fetched:
+    assert (model.rowCount(), model.total()) == (2, 5)
+    assert model.canFetchMore(QModelIndex())
+    # And adding within or past the fetched rows works:
+    model.add_nickname("nick01")
+    model.add_nickname("nick09")
+    assert [model.index(row).data() for row in range(model.rowCount())] == ["nick00", "nick01", "nick02"]
+    pass_db.bulk_insert([Password("nick01"), Password("nick09")])
+    # And so does removing:
+    model.remove_nickname("nick02")
+    model.remove_nickname("nick04")
+    pass_db.delete_password("nick02")
+    pass_db.delete_password("nick04")
+    while model.canFetchMore(QModelIndex()):
+        model.fetchMore(QModelIndex())
+    assert [model.index(row).data() for row in range(model.rowCount())] == ["nick00", "nick01", "nick06",
+                                                                            "nick08", "nick09"]
+    assert model.total() == 5
+
+
 @nose.tools.nottest # figure out how to handle the edit-form
 def test_create():
     """Create a new password."""